@@ -1,11 +1,27 @@
 from libcpp cimport bool
+from libcpp.string cimport string
 from cython.operator cimport dereference as deref
 
 
+# the kernel calls that take a while (booleans, sweeps, meshing, file and
+# BRep I/O) run without the GIL, so that independent shapes can be built
+# from several threads. those calls only get OCC objects, copied out of
+# Shapes beforehand, and their C++ exceptions are translated to python
+# ones once the GIL is back. the meshing calls store triangulations in
+# faces, so shapes that share geometry shouldn't be meshed concurrently.
+
 ctypedef double Standard_Real
 ctypedef char* Standard_CString
 
 
+cdef extern from "Standard.hxx":
+    # OCC's memory manager and exception handling are only thread-safe in
+    # reentrant mode
+    void SetReentrant "Standard::SetReentrant" (bool)
+
+SetReentrant(True)
+
+
 cdef extern from "Precision.hxx" namespace "Precision":
     Standard_Real Confusion()
     Standard_Real PConfusion()
@@ -23,7 +39,7 @@ cdef extern from "gp_Pnt.hxx":
         Standard_Real Y()
         Standard_Real Z()
 
-cdef extern from "gp_Vec.hxx":
+cdef extern from "gp_Vec.hxx" nogil:
     cdef cppclass gp_Vec:
         gp_Vec()
         gp_Vec(Standard_Real, Standard_Real, Standard_Real)
@@ -60,13 +76,21 @@ cdef extern from "gp_Trsf.hxx":
         gp_Trsf()
         void SetRotation(gp_Ax1, Standard_Real)
         void SetTranslation(gp_Vec)
+        gp_Trsf Multiplied(gp_Trsf)
 
 cdef extern from "gp_GTrsf.hxx":
     cdef cppclass gp_GTrsf:
         gp_GTrsf()
         gp_GTrsf(gp_Mat, gp_XYZ)
+        gp_GTrsf(gp_Trsf)
         void SetVectorialPart(gp_Mat)
         void SetTranslationPart(gp_XYZ)
+        gp_GTrsf Multiplied(gp_GTrsf)
+
+cdef extern from "TopLoc_Location.hxx":
+    cdef cppclass TopLoc_Location:
+        TopLoc_Location()
+        TopLoc_Location(gp_Trsf)
 
 cdef extern from "TColgp_Array2OfPnt.hxx":
     cdef cppclass TColgp_Array2OfPnt:
@@ -76,7 +100,7 @@ cdef extern from "TColgp_Array1OfPnt2d.hxx":
     cdef cppclass TColgp_Array1OfPnt2d:
         TColgp_Array1OfPnt2d(int, int)
 
-cdef extern from "gp.hxx" namespace "gp":
+cdef extern from "gp.hxx" namespace "gp" nogil:
     gp_Pnt Origin()
     gp_Dir DX()
     gp_Dir DY()
@@ -109,6 +133,32 @@ cdef class GenTransform:
             0, sy, 0,
             0, 0, sz))
 
+cdef gp_GTrsf toGTrsf(transform):
+    if isinstance(transform, Transform):
+        return gp_GTrsf((<Transform>transform).obj)
+    else:
+        return (<GenTransform>transform).obj
+
+def composeTransforms(first, second):
+    """
+    Return a transform that applies first, then second. Two Transforms make
+    a Transform; anything with a GenTransform makes a GenTransform.
+    """
+
+    cdef Transform transform
+    cdef GenTransform gtransform
+
+    # Multiplied() applies its argument first
+    if isinstance(first, Transform) and isinstance(second, Transform):
+        transform = Transform()
+        transform.obj = (<Transform>second).obj.Multiplied(
+            (<Transform>first).obj)
+        return transform
+
+    gtransform = GenTransform()
+    gtransform.obj = toGTrsf(second).Multiplied(toGTrsf(first))
+    return gtransform
+
 
 cdef extern from "gp_Circ.hxx":
     cdef cppclass gp_Circ:
@@ -264,6 +314,7 @@ cdef extern from "TopoDS_Shape.hxx":
         TopAbs_ShapeEnum ShapeType()
         TopoDS_Shape Oriented(TopAbs_Orientation)
         TopoDS_Shape EmptyCopied()
+        TopoDS_Shape Moved(TopLoc_Location)
 
 cdef extern from "TopoDS_Edge.hxx":
     cdef cppclass TopoDS_Edge(TopoDS_Shape):
@@ -332,9 +383,9 @@ cdef extern from "BRep_Builder.hxx":
         void Add(TopoDS_Shape, TopoDS_Shape)
         void Remove(TopoDS_Shape, TopoDS_Shape)
 
-cdef extern from "BRepBuilderAPI_MakeShape.hxx":
+cdef extern from "BRepBuilderAPI_MakeShape.hxx" nogil:
     cdef cppclass BRepBuilderAPI_MakeShape:
-        const TopoDS_Shape &Shape()
+        const TopoDS_Shape &Shape() except +
 
 cdef extern from "BRepBuilderAPI_MakeEdge.hxx":
     cdef cppclass BRepBuilderAPI_MakeEdge(BRepBuilderAPI_MakeShape):
@@ -357,6 +408,14 @@ cdef extern from "BRepBuilderAPI_MakeWire.hxx":
 
         void Add(TopoDS_Edge)
 
+cdef extern from "BRepBuilderAPI_MakePolygon.hxx":
+    cdef cppclass BRepBuilderAPI_MakePolygon(BRepBuilderAPI_MakeShape):
+        BRepBuilderAPI_MakePolygon()
+        void Add(gp_Pnt)
+        void Close()
+        bool IsDone()
+        TopoDS_Wire Wire()
+
 cdef extern from "BRepBuilderAPI_MakeFace.hxx":
     cdef cppclass BRepBuilderAPI_MakeFace(BRepBuilderAPI_MakeShape):
         BRepBuilderAPI_MakeFace()
@@ -372,48 +431,63 @@ cdef extern from "BRepBuilderAPI_MakeSolid.hxx":
         BRepBuilderAPI_MakeSolid(TopoDS_CompSolid)
 
 
-cdef extern from "BRepAlgoAPI_Fuse.hxx":
-    cdef cppclass BRepAlgoAPI_Fuse(BRepBuilderAPI_MakeShape):
+cdef extern from "TopTools_ListOfShape.hxx":
+    cdef cppclass TopTools_ListOfShape:
+        TopTools_ListOfShape()
+        void Append(TopoDS_Shape)
+
+cdef extern from "BRepAlgoAPI_BooleanOperation.hxx" nogil:
+    cdef cppclass BRepAlgoAPI_BooleanOperation(BRepBuilderAPI_MakeShape):
+        void SetArguments(TopTools_ListOfShape)
+        void SetTools(TopTools_ListOfShape)
+        void Build() except +
+        bool IsDone()
+
+cdef extern from "BRepAlgoAPI_Fuse.hxx" nogil:
+    cdef cppclass BRepAlgoAPI_Fuse(BRepAlgoAPI_BooleanOperation):
+        BRepAlgoAPI_Fuse()
         BRepAlgoAPI_Fuse(TopoDS_Shape, TopoDS_Shape)
 
-cdef extern from "BRepAlgoAPI_Cut.hxx":
-    cdef cppclass BRepAlgoAPI_Cut(BRepBuilderAPI_MakeShape):
+cdef extern from "BRepAlgoAPI_Cut.hxx" nogil:
+    cdef cppclass BRepAlgoAPI_Cut(BRepAlgoAPI_BooleanOperation):
+        BRepAlgoAPI_Cut()
         BRepAlgoAPI_Cut(TopoDS_Shape, TopoDS_Shape)
 
-cdef extern from "BRepAlgoAPI_Common.hxx":
-    cdef cppclass BRepAlgoAPI_Common(BRepBuilderAPI_MakeShape):
+cdef extern from "BRepAlgoAPI_Common.hxx" nogil:
+    cdef cppclass BRepAlgoAPI_Common(BRepAlgoAPI_BooleanOperation):
+        BRepAlgoAPI_Common()
         BRepAlgoAPI_Common(TopoDS_Shape, TopoDS_Shape)
 
-cdef extern from "BRepBuilderAPI_Transform.hxx":
+cdef extern from "BRepBuilderAPI_Transform.hxx" nogil:
     cdef cppclass BRepBuilderAPI_Transform(BRepBuilderAPI_MakeShape):
-        BRepBuilderAPI_Transform(TopoDS_Shape, gp_Trsf, bool)
+        BRepBuilderAPI_Transform(TopoDS_Shape, gp_Trsf, bool) except +
 
-cdef extern from "BRepBuilderAPI_GTransform.hxx":
+cdef extern from "BRepBuilderAPI_GTransform.hxx" nogil:
     cdef cppclass BRepBuilderAPI_GTransform(BRepBuilderAPI_MakeShape):
-        BRepBuilderAPI_GTransform(TopoDS_Shape, gp_GTrsf, bool)
+        BRepBuilderAPI_GTransform(TopoDS_Shape, gp_GTrsf, bool) except +
 
 
-cdef extern from "BRepPrimAPI_MakeRevol.hxx":
+cdef extern from "BRepPrimAPI_MakeRevol.hxx" nogil:
     cdef cppclass BRepPrimAPI_MakeRevol(BRepBuilderAPI_MakeShape):
         BRepPrimAPI_MakeRevol(TopoDS_Shape, gp_Ax1, Standard_Real D,
-            bool Copy)
-        BRepPrimAPI_MakeRevol(TopoDS_Shape, gp_Ax1, bool Copy)
+            bool Copy) except +
+        BRepPrimAPI_MakeRevol(TopoDS_Shape, gp_Ax1, bool Copy) except +
 
-cdef extern from "BRepPrimAPI_MakePrism.hxx":
+cdef extern from "BRepPrimAPI_MakePrism.hxx" nogil:
     cdef cppclass BRepPrimAPI_MakePrism(BRepBuilderAPI_MakeShape):
-        BRepPrimAPI_MakePrism(TopoDS_Shape, gp_Vec, bool Copy)
+        BRepPrimAPI_MakePrism(TopoDS_Shape, gp_Vec, bool Copy) except +
 
-cdef extern from "BRepOffsetAPI_MakePipeShell.hxx":
+cdef extern from "BRepOffsetAPI_MakePipeShell.hxx" nogil:
     cdef cppclass BRepOffsetAPI_MakePipeShell(BRepBuilderAPI_MakeShape):
         BRepOffsetAPI_MakePipeShell(TopoDS_Wire Spine)
         bool SetMode(TopoDS_Shape SpineSupport)
-        void Add(TopoDS_Shape Profile)
+        void Add(TopoDS_Shape Profile) except +
         void SetTolerance(Standard_Real Tol3d)
         void SetTolerance(Standard_Real Tol3d, Standard_Real BoundTol)
         void SetTolerance(Standard_Real Tol3d, Standard_Real BoundTol,
             Standard_Real TolAngular)
-        void Build()
-        bool MakeSolid()
+        void Build() except +
+        bool MakeSolid() except +
 
 
 cdef extern from "BRepClass_FaceExplorer.hxx":
@@ -436,9 +510,10 @@ cdef extern from "BRepTopAdaptor_FClass2d.hxx":
         TopAbs_State PerformInfinitePoint()
         TopAbs_State Perform(gp_Pnt2d, bool)
 
-cdef extern from "BRepMesh_IncrementalMesh.hxx":
+cdef extern from "BRepMesh_IncrementalMesh.hxx" nogil:
     cdef cppclass BRepMesh_IncrementalMesh:
-        BRepMesh_IncrementalMesh(TopoDS_Shape, Standard_Real tol)
+        BRepMesh_IncrementalMesh(TopoDS_Shape, Standard_Real tol,
+            bool relative, Standard_Real angularTol, bool inParallel) except +
 
 cdef extern from "Bnd_Box.hxx":
     cdef cppclass Bnd_Box:
@@ -446,11 +521,23 @@ cdef extern from "Bnd_Box.hxx":
         void Get(Standard_Real &xmin, Standard_Real &ymin, Standard_Real &zmin,
             Standard_Real &xmax, Standard_Real &ymax, Standard_Real &zmax)
         Standard_Real GetGap()
+        bool IsVoid()
 
 cdef extern from "BRepBndLib.hxx":
     void AddToBBox "BRepBndLib::Add" (TopoDS_Shape, Bnd_Box)
 
 
+cdef TopoDS_Shape takeShape(BRepBuilderAPI_MakeShape *maker) nogil except *:
+    """
+    Return maker's shape, and delete maker.
+    """
+
+    try:
+        return maker.Shape()
+    finally:
+        del maker
+
+
 cdef class Shape:
     cdef TopoDS_Shape obj
 
@@ -484,13 +571,13 @@ cdef class Shape:
         return Compound(self.obj)
 
     def __add__(Shape self, Shape b):
-        return Shape().setFromMaker(BRepAlgoAPI_Fuse(self.obj, b.obj))
+        return boolean('add', [self], [b])
     
     def __sub__(Shape self, Shape b):
-        return Shape().setFromMaker(BRepAlgoAPI_Cut(self.obj, b.obj))
+        return boolean('sub', [self], [b])
 
     def __mul__(Shape self, Shape b):
-        return Shape().setFromMaker(BRepAlgoAPI_Common(self.obj, b.obj))
+        return boolean('mul', [self], [b])
 
     @property
     def shapeType(self):
@@ -523,33 +610,68 @@ cdef class Shape:
             yield Shape().set_(explorer.Current())
             explorer.Next()
 
+    cdef TopoDS_Shape transformed(self, gp_Trsf trsf, bool copy) except *:
+        cdef TopoDS_Shape shape = self.obj
+        with nogil:
+            return takeShape(new BRepBuilderAPI_Transform(shape, trsf, copy))
+
+    cdef TopoDS_Shape gtransformed(self, gp_GTrsf gtrsf, bool copy) except *:
+        cdef TopoDS_Shape shape = self.obj
+        with nogil:
+            return takeShape(new BRepBuilderAPI_GTransform(shape, gtrsf, copy))
+
     def applyTransform(Shape self, Transform transform):
-        self.setFromMaker(BRepBuilderAPI_Transform(
-            # False = don't copy
-            self.obj, transform.obj, False))
+        # False = don't copy
+        self.obj = self.transformed(transform.obj, False)
 
     def applyGTransform(Shape self, GenTransform gtransform):
-        self.setFromMaker(BRepBuilderAPI_GTransform(
-            # False = don't copy
-            self.obj, gtransform.obj, False))
+        # False = don't copy
+        self.obj = self.gtransformed(gtransform.obj, False)
 
     def withTransform(Shape self, Transform transform):
-        return Shape().setFromMaker(BRepBuilderAPI_Transform(
-            # True = make a copy
-            self.obj, transform.obj, True))
+        # True = make a copy
+        return Shape().set_(self.transformed(transform.obj, True))
 
     def withGTransform(Shape self, GenTransform gtransform):
-        return Shape().setFromMaker(BRepBuilderAPI_GTransform(
-            # True = make a copy
-            self.obj, gtransform.obj, True))
+        # True = make a copy
+        return Shape().set_(self.gtransformed(gtransform.obj, True))
+
+    def withLocation(Shape self, Transform transform):
+        """
+        Return this shape placed by transform, without copying it: the new
+        shape refers to the same geometry, with a different location.
+        Transforms are rigid, so that's always possible.
+        """
+
+        return Shape().set_(self.obj.Moved(TopLoc_Location(transform.obj)))
 
     def revolve(Shape self, float angle):
-        return Shape().setFromMaker(BRepPrimAPI_MakeRevol(
-            self.obj, OY(), angle, True))
+        cdef TopoDS_Shape profile = self.obj
+        cdef TopoDS_Shape result
+        with nogil:
+            result = takeShape(new BRepPrimAPI_MakeRevol(
+                profile, OY(), angle, True))
+        return Shape().set_(result)
 
     def extrudeStraight(Shape self, float h):
-        return Shape().setFromMaker(BRepPrimAPI_MakePrism(
-            self.obj, gp_Vec(0, 0, h), True))
+        cdef TopoDS_Shape profile = self.obj
+        cdef TopoDS_Shape result
+        with nogil:
+            result = takeShape(new BRepPrimAPI_MakePrism(
+                profile, gp_Vec(0, 0, h), True))
+        return Shape().set_(result)
+
+    def extrudeTwisted(Shape self, double h, double twist, double tolerance):
+        """
+        Extrude this shape's faces to height h, twisting them by twist
+        radians around the z axis. Holes are swept along with the faces.
+        """
+
+        cdef TopoDS_Shape profile = self.obj
+        cdef TopoDS_Shape result
+        with nogil:
+            result = _twistExtrude(profile, h, twist, tolerance)
+        return Shape().set_(result)
 
     def extrudeAlongSurface(Shape self, Shape spine, Shape normalSurf,
         float tolerance, bool cap=True):
@@ -570,20 +692,23 @@ cdef class Shape:
         cdef BRepOffsetAPI_MakePipeShell *maker
         maker = new BRepOffsetAPI_MakePipeShell(spineWire)
 
+        cdef TopoDS_Shape profile = self.obj
+        cdef TopoDS_Shape result
         try:
             if not maker.SetMode(normalSurf.face()):
                 raise ValueError(
                     "failed setting twisted surface-normal for PipeShell")
 
-            maker.Add(self.obj)
+            with nogil:
+                maker.Add(profile)
 
-            maker.SetTolerance(tolerance, tolerance)
+                maker.SetTolerance(tolerance, tolerance)
 
-            maker.Build()
-            maker.MakeSolid()
-            return Shape().setFromMaker(deref(maker))
+                maker.Build()
+                maker.MakeSolid()
+                result = maker.Shape()
+            return Shape().set_(result)
         finally:
-            # TODO: ensure that relevant C++ exceptions are caught, too
             del maker
 
     def oriented(self, TopAbs_Orientation orient):
@@ -599,8 +724,69 @@ cdef class Shape:
         return (BRepTopAdaptor_FClass2d(newface.face(), PConfusion())
             .PerformInfinitePoint() != TopAbs_OUT)
 
-    def tesselate(self, tolerance):
-        BRepMesh_IncrementalMesh(self.obj, tolerance)
+    def tesselate(self, double tolerance, double angularTolerance=0.5,
+            bool parallel=False):
+        """
+        Mesh this shape's faces, with at most tolerance distance and
+        angularTolerance radians between the mesh and the surface. With
+        parallel, faces are meshed concurrently.
+        """
+
+        cdef TopoDS_Shape shape = self.obj
+        with nogil:
+            # False = tolerance is absolute
+            BRepMesh_IncrementalMesh(shape, tolerance, False,
+                angularTolerance, parallel)
+
+    def triangulate(self, double tolerance, double angularTolerance=0.5,
+            bool parallel=False, bool faceIds=False, bool mesh=True):
+        """
+        Mesh this shape (see tesselate()), and return its mesh as numpy
+        arrays: vertices, (N, 3) float64, and triangles, (M, 3) int32
+        indices into vertices. Vertices are shared by the triangles of
+        each face, but not between faces. With faceIds, also returns an
+        (M,) int32 array of the index of each triangle's face. Without
+        mesh, the faces' existing meshes are returned as they are, and
+        faces with none are skipped.
+
+        The mesh is copied straight from the faces' triangulations into
+        the arrays.
+        """
+
+        import numpy as np
+
+        cdef TopoDS_Shape shape = self.obj
+        cdef MeshSize size
+        with nogil:
+            if mesh:
+                size = _meshShape(shape, tolerance, angularTolerance,
+                    parallel)
+            else:
+                size = _triangulationSize(shape)
+
+        vertices = np.empty((size.nodes, 3), np.float64)
+        triangles = np.empty((size.triangles, 3), np.intc)
+        triangleFaces = np.empty(size.triangles if faceIds else 0, np.intc)
+
+        cdef double[:, ::1] vertexView = vertices
+        cdef int[:, ::1] triangleView = triangles
+        cdef int[::1] faceView = triangleFaces
+        cdef double *vertexPtr = NULL
+        cdef int *trianglePtr = NULL
+        cdef int *facePtr = NULL
+        if size.nodes > 0:
+            vertexPtr = &vertexView[0, 0]
+        if size.triangles > 0:
+            trianglePtr = &triangleView[0, 0]
+            if faceIds:
+                facePtr = &faceView[0]
+
+        with nogil:
+            _copyTriangulation(shape, vertexPtr, trianglePtr, facePtr)
+
+        if faceIds:
+            return vertices, triangles, triangleFaces
+        return vertices, triangles
 
     def contains2DPoint(self, point):
         """
@@ -626,15 +812,24 @@ cdef class Shape:
         finally:
             del explorer
 
-    def getBoundingBox(self):
-        # TODO: this doesn't take into account the object's position,
-            # and possibly not the orientation, either
+    def getBoundingBox(self, bool enlarged=False):
+        """
+        Return ((xmin, ymin, zmin), (xmax, ymax, zmax)), or None if the shape
+        is empty.
+
+        If enlarged is True, the box includes OCC's tolerance gap, so that
+        it's sure to contain the whole shape.
+        """
+
         cdef Standard_Real xmin, ymin, zmin, xmax, ymax, zmax
 
         cdef Bnd_Box bbox
         AddToBBox(self.obj, bbox)
+        if bbox.IsVoid():
+            return None
+
         bbox.Get(xmin, ymin, zmin, xmax, ymax, zmax)
-        cdef Standard_Real gap = bbox.GetGap()
+        cdef Standard_Real gap = 0 if enlarged else bbox.GetGap()
 
         return ((xmin + gap, ymin + gap, zmin + gap),
             (xmax - gap, ymax - gap, zmax - gap))
@@ -672,6 +867,108 @@ def face(wires):
         maker.Add((<Shape?>wireShape).wire())
     return Shape().setFromMaker(maker)
 
+cdef gp_Pnt bufferPoint(const double[:, ::1] points, Py_ssize_t i):
+    if points.shape[1] == 2:
+        return gp_Pnt(points[i, 0], points[i, 1], 0)
+    else:
+        return gp_Pnt(points[i, 0], points[i, 1], points[i, 2])
+
+cdef TopoDS_Wire polygonWire(const double[:, ::1] points,
+    const Py_ssize_t[::1] path) except *:
+
+    cdef BRepBuilderAPI_MakePolygon maker
+    cdef Py_ssize_t i, n
+
+    if path is None:
+        for i in xrange(points.shape[0]):
+            maker.Add(bufferPoint(points, i))
+
+    else:
+        n = path.shape[0]
+        # the loop is closed anyway
+        if n > 1 and path[n - 1] == path[0]:
+            n -= 1
+
+        for i in xrange(n):
+            maker.Add(bufferPoint(points, path[i]))
+
+    maker.Close()
+    if not maker.IsDone():
+        raise ValueError("polygon needs at least 2 distinct points")
+
+    return maker.Wire()
+
+def polygon(const double[:, ::1] points not None, paths=None):
+    """
+    Make a face bounded by polygons. points is a C-contiguous float64 array
+    of shape (N, 2) or (N, 3) (or anything else with the same buffer
+    layout), and is read in place. paths are arrays of indices into points,
+    of type intp: the first is the outer loop, and the rest are holes. If
+    paths is None, all the points make a single loop. Loops are closed
+    automatically.
+    """
+
+    if points.shape[1] not in (2, 3):
+        raise ValueError("points must have 2 or 3 columns")
+
+    if paths is None:
+        paths = [None]
+
+    pathIter = iter(paths)
+    # as in face(), the first wire has to be passed to the constructor
+    cdef BRepBuilderAPI_MakeFace maker = BRepBuilderAPI_MakeFace(
+        polygonWire(points, next(pathIter)))
+    for path in pathIter:
+        maker.Add(polygonWire(points, path))
+
+    return Shape().setFromMaker(maker)
+
+cdef TopTools_ListOfShape shapeList(shapes):
+    cdef TopTools_ListOfShape lst
+    for shape in shapes:
+        lst.Append((<Shape?>shape).obj)
+    return lst
+
+def boolean(op, arguments, tools):
+    """
+    Run a boolean operation on several shapes at once: all arguments and
+    tools go into a single general fuse, instead of a chain of pairwise
+    operations.
+
+    op is 'add' (union of arguments and tools), 'sub' (arguments minus
+    tools) or 'mul' (common part of arguments and tools).
+    """
+
+    cdef BRepAlgoAPI_BooleanOperation *maker
+    if op == 'add':
+        maker = new BRepAlgoAPI_Fuse()
+    elif op == 'sub':
+        maker = new BRepAlgoAPI_Cut()
+    elif op == 'mul':
+        maker = new BRepAlgoAPI_Common()
+    else:
+        raise ValueError("unknown boolean operation {0!r}".format(op))
+
+    cdef TopTools_ListOfShape argumentList, toolList
+    cdef TopoDS_Shape result
+    cdef bool done
+    try:
+        argumentList = shapeList(arguments)
+        toolList = shapeList(tools)
+        with nogil:
+            maker.SetArguments(argumentList)
+            maker.SetTools(toolList)
+            maker.Build()
+            done = maker.IsDone()
+            if done:
+                result = maker.Shape()
+    finally:
+        del maker
+
+    if not done:
+        raise RuntimeError("boolean operation {0!r} failed".format(op))
+    return Shape().set_(result)
+
 def compSolidToSolid(Shape compSolidShape):
     return Shape().setFromMaker(BRepBuilderAPI_MakeSolid(
         compSolidShape.compSolid()))
@@ -757,16 +1054,75 @@ def torus(*args):
         return Shape().setFromMaker(BRepPrimAPI_MakeTorus(r1, r2, angle))
 
 
-cdef extern from "_ycad_helpers.h":
-    cdef extern void _writeSTL "writeSTL" (TopoDS_Shape, Standard_CString,
-        Standard_Real)
-
-    cdef extern void _readSTL "readSTL" (TopoDS_Shape &, Standard_CString)
-
-def writeSTL(Shape shape, bytes path, double tol):
-    _writeSTL(shape.obj, path, tol)
+cdef extern from "_ycad_helpers.h" nogil:
+    cdef struct STLStats:
+        size_t parts
+        size_t placements
+        size_t uniqueTriangles
+        size_t triangles
+
+    cdef struct MeshSize:
+        size_t nodes
+        size_t triangles
+
+    cdef extern MeshSize _meshShape "meshShape" (TopoDS_Shape, Standard_Real,
+        Standard_Real, bool) except +
+    cdef extern MeshSize _triangulationSize "triangulationSize" (
+        TopoDS_Shape) except +
+    cdef extern void _copyTriangulation "copyTriangulation" (TopoDS_Shape,
+        double *, int *, int *) except +
+
+    cdef extern STLStats _writeSTL "writeSTL" (TopoDS_Shape, Standard_CString,
+        Standard_Real, Standard_Real, int) except +
+
+    cdef extern void _readSTL "readSTL" (TopoDS_Shape &, Standard_CString) \
+        except +
+
+    cdef extern TopoDS_Shape _twistExtrude "twistExtrude" (TopoDS_Shape,
+        Standard_Real, Standard_Real, Standard_Real) except +
+
+    cdef extern string _shapeToBRep "shapeToBRep" (TopoDS_Shape) except +
+    cdef extern void _shapeFromBRep "shapeFromBRep" (TopoDS_Shape &,
+        string) except +
+
+def writeSTL(Shape shape, bytes path, double tol, double angularTol=0.5,
+        int numThreads=1):
+    """
+    Write shape to a binary STL file. Parts placed more than once are only
+    meshed once, and distinct parts are meshed by numThreads threads.
+    tol and angularTol bound the mesh's distance and angle from the
+    surfaces. Returns a dict of counts: parts (distinct solids, shells or
+    faces), placements, uniqueTriangles (meshed) and triangles (written).
+    """
+
+    cdef TopoDS_Shape obj = shape.obj
+    cdef Standard_CString cpath = path
+    cdef STLStats stats
+    with nogil:
+        stats = _writeSTL(obj, cpath, tol, angularTol, numThreads)
+    return stats
 
 def readSTL(bytes path):
-    s = Shape()
-    _readSTL(s.obj, path)
-    return s
+    cdef Standard_CString cpath = path
+    cdef TopoDS_Shape obj
+    with nogil:
+        _readSTL(obj, cpath)
+    return Shape().set_(obj)
+
+def shapeToBRep(Shape shape):
+    """
+    Serialize shape to bytes, in OCC's binary BRep format.
+    """
+
+    cdef TopoDS_Shape obj = shape.obj
+    cdef string data
+    with nogil:
+        data = _shapeToBRep(obj)
+    return data
+
+def shapeFromBRep(bytes data):
+    cdef string cdata = data
+    cdef TopoDS_Shape obj
+    with nogil:
+        _shapeFromBRep(obj, cdata)
+    return Shape().set_(obj)
@@ -1,14 +1,434 @@
 #include "_ycad_helpers.h"
+#include <sstream>
+#include <fstream>
+#include <stdexcept>
+#include <vector>
+#include <algorithm>
+#include <cstring>
+#include <cmath>
+#include <stdint.h>
+#include <gp.hxx>
+#include <gp_Pnt.hxx>
+#include <gp_Pnt2d.hxx>
+#include <gp_Trsf.hxx>
+#include <gp_Vec.hxx>
+#include <BRep_Builder.hxx>
+#include <BRep_Tool.hxx>
+#include <BRepBuilderAPI_MakeEdge.hxx>
+#include <BRepBuilderAPI_MakeFace.hxx>
+#include <BRepBuilderAPI_MakeWire.hxx>
+#include <BRepBuilderAPI_Sewing.hxx>
+#include <BRepBuilderAPI_Transform.hxx>
+#include <BRepLib.hxx>
+#include <BRepMesh_IncrementalMesh.hxx>
+#include <BRepOffsetAPI_MakePipeShell.hxx>
+#include <GCE2d_MakeSegment.hxx>
+#include <Geom_BezierSurface.hxx>
+#include <OSD_Thread.hxx>
+#include <Poly_Triangulation.hxx>
+#include <Precision.hxx>
+#include <Standard_Atomic.hxx>
+#include <Standard_Failure.hxx>
+#include <TColgp_Array2OfPnt.hxx>
+#include <TopExp.hxx>
+#include <TopExp_Explorer.hxx>
+#include <TopLoc_Location.hxx>
+#include <TopoDS.hxx>
+#include <TopoDS_Compound.hxx>
+#include <TopoDS_Edge.hxx>
+#include <TopoDS_Face.hxx>
+#include <TopoDS_Iterator.hxx>
+#include <TopoDS_Shell.hxx>
+#include <TopoDS_Solid.hxx>
+#include <TopoDS_Wire.hxx>
+#include <TopTools_DataMapOfShapeInteger.hxx>
+#include <TopTools_IndexedMapOfShape.hxx>
 
 
-void writeSTL(const TopoDS_Shape &shape, Standard_CString path,
-    Standard_Real deflection)
+// triangles of a part, in its own coordinates: 9 floats (3 vertices) each
+typedef std::vector<float> TriangleList;
+
+// collect the parts of shape: the shapes inside its compounds. each is
+// located, and refers to the same TShape as the other placements of the
+// same part.
+static void collectPlacements(const TopoDS_Shape &shape,
+    std::vector<TopoDS_Shape> &placements)
+{
+    if (shape.ShapeType() != TopAbs_COMPOUND) {
+        placements.push_back(shape);
+        return;
+    }
+
+    // children get their parents' locations and orientations
+    for (TopoDS_Iterator it(shape); it.More(); it.Next()) {
+        collectPlacements(it.Value(), placements);
+    }
+}
+
+static void meshPart(const TopoDS_Shape &part, Standard_Real deflection,
+    Standard_Real angularDeflection, bool inParallel, TriangleList &triangles)
+{
+    // false = deflection is absolute, not relative to edge sizes
+    BRepMesh_IncrementalMesh mesher(part, deflection, false,
+        angularDeflection, inParallel);
+
+    for (TopExp_Explorer exp(part, TopAbs_FACE); exp.More(); exp.Next()) {
+        const TopoDS_Face &face = TopoDS::Face(exp.Current());
+
+        TopLoc_Location loc;
+        Handle(Poly_Triangulation) triangulation =
+            BRep_Tool::Triangulation(face, loc);
+        if (triangulation.IsNull()) {
+            continue;
+        }
+
+        const gp_Trsf &trsf = loc.Transformation();
+        const TColgp_Array1OfPnt &nodes = triangulation->Nodes();
+        const Poly_Array1OfTriangle &faceTriangles =
+            triangulation->Triangles();
+        bool reversed = (face.Orientation() == TopAbs_REVERSED);
+
+        for (int i = faceTriangles.Lower(); i <= faceTriangles.Upper(); i++) {
+            Standard_Integer n[3];
+            faceTriangles(i).Get(n[0], n[1], n[2]);
+            if (reversed) {
+                std::swap(n[1], n[2]);
+            }
+
+            for (int j = 0; j < 3; j++) {
+                gp_Pnt p = nodes(n[j]).Transformed(trsf);
+                triangles.push_back(p.X());
+                triangles.push_back(p.Y());
+                triangles.push_back(p.Z());
+            }
+        }
+    }
+}
+
+// mesh shape, and count the nodes and triangles that copyTriangulation()
+// will copy
+MeshSize meshShape(const TopoDS_Shape &shape, Standard_Real deflection,
+    Standard_Real angularDeflection, bool inParallel)
+{
+    BRepMesh_IncrementalMesh mesher(shape, deflection, false,
+        angularDeflection, inParallel);
+
+    return triangulationSize(shape);
+}
+
+// count the nodes and triangles of the meshes shape's faces already have
+MeshSize triangulationSize(const TopoDS_Shape &shape)
+{
+    MeshSize size = {0, 0};
+    for (TopExp_Explorer exp(shape, TopAbs_FACE); exp.More(); exp.Next()) {
+        TopLoc_Location loc;
+        Handle(Poly_Triangulation) triangulation =
+            BRep_Tool::Triangulation(TopoDS::Face(exp.Current()), loc);
+        if (!triangulation.IsNull()) {
+            size.nodes += triangulation->NbNodes();
+            size.triangles += triangulation->Triangles().Length();
+        }
+    }
+
+    return size;
+}
+
+// copy the meshes of shape's faces, in shape's coordinates: their nodes to
+// vertices (3 doubles each), their triangles to triangles (3 indices into
+// vertices each, counter-clockwise seen from outside), and the index of
+// each triangle's face, in TopExp_Explorer's order, to faceIds. the arrays
+// must have the room counted by meshShape(). faceIds may be NULL.
+void copyTriangulation(const TopoDS_Shape &shape, double *vertices,
+    int *triangles, int *faceIds)
 {
-    StlAPI_Writer writer;
-    writer.ASCIIMode() = false;
-    writer.RelativeMode() = false;
-    writer.SetDeflection(deflection);
-    writer.Write(shape, path);
+    int faceId = 0;
+    int nodeOffset = 0;
+
+    for (TopExp_Explorer exp(shape, TopAbs_FACE); exp.More();
+            exp.Next(), faceId++) {
+        const TopoDS_Face &face = TopoDS::Face(exp.Current());
+
+        TopLoc_Location loc;
+        Handle(Poly_Triangulation) triangulation =
+            BRep_Tool::Triangulation(face, loc);
+        if (triangulation.IsNull()) {
+            continue;
+        }
+
+        const gp_Trsf &trsf = loc.Transformation();
+        const TColgp_Array1OfPnt &nodes = triangulation->Nodes();
+        const Poly_Array1OfTriangle &faceTriangles =
+            triangulation->Triangles();
+        bool reversed = (face.Orientation() == TopAbs_REVERSED);
+
+        for (int i = nodes.Lower(); i <= nodes.Upper(); i++) {
+            gp_Pnt p = nodes(i).Transformed(trsf);
+            *vertices++ = p.X();
+            *vertices++ = p.Y();
+            *vertices++ = p.Z();
+        }
+
+        for (int i = faceTriangles.Lower(); i <= faceTriangles.Upper(); i++) {
+            Standard_Integer n[3];
+            faceTriangles(i).Get(n[0], n[1], n[2]);
+            if (reversed) {
+                std::swap(n[1], n[2]);
+            }
+
+            for (int j = 0; j < 3; j++) {
+                *triangles++ = nodeOffset + n[j] - nodes.Lower();
+            }
+            if (faceIds != NULL) {
+                *faceIds++ = faceId;
+            }
+        }
+
+        nodeOffset += nodes.Length();
+    }
+}
+
+// the parts meshed by a group of threads, given by their indices in parts.
+// each thread takes the next part that nobody has taken yet, until there are
+// none left.
+struct MeshJob
+{
+    const std::vector<TopoDS_Shape> *parts;
+    const std::vector<int> *partIndices;
+    std::vector<TriangleList> *partTriangles;
+    Standard_Real deflection;
+    Standard_Real angularDeflection;
+    volatile int nextPart;
+    // the first error in any of the threads, since exceptions can't cross
+    // threads
+    volatile int failed;
+    std::string error;
+};
+
+static Standard_Address meshPartsThread(Standard_Address data)
+{
+    MeshJob &job = *(MeshJob *)data;
+    int numParts = (int)job.partIndices->size();
+
+    while (!job.failed) {
+        int next = Standard_Atomic_Increment(&job.nextPart) - 1;
+        if (next >= numParts) {
+            break;
+        }
+
+        int i = (*job.partIndices)[next];
+
+        try {
+            meshPart((*job.parts)[i], job.deflection, job.angularDeflection,
+                false, (*job.partTriangles)[i]);
+        } catch (Standard_Failure &e) {
+            if (Standard_Atomic_Increment(&job.failed) == 1) {
+                job.error = e.GetMessageString();
+            }
+        } catch (std::exception &e) {
+            if (Standard_Atomic_Increment(&job.failed) == 1) {
+                job.error = e.what();
+            }
+        } catch (...) {
+            if (Standard_Atomic_Increment(&job.failed) == 1) {
+                job.error = "unknown exception";
+            }
+        }
+    }
+
+    return NULL;
+}
+
+// find the parts that share faces or edges with other parts, e.g. solids
+// of a compound that a boolean left touching each other. meshing stores
+// triangulations in the faces and polygons in the edges - in their TShapes,
+// whatever their locations - so such parts can't be meshed concurrently.
+static std::vector<bool> findSharingParts(
+    const std::vector<TopoDS_Shape> &parts)
+{
+    std::vector<bool> sharing(parts.size(), false);
+    // the first part using each face and edge
+    TopTools_DataMapOfShapeInteger owners;
+    const TopAbs_ShapeEnum subShapeTypes[] = {TopAbs_FACE, TopAbs_EDGE};
+
+    for (size_t i = 0; i < parts.size(); i++) {
+        for (int t = 0; t < 2; t++) {
+            TopTools_IndexedMapOfShape subShapes;
+            TopExp::MapShapes(parts[i], subShapeTypes[t], subShapes);
+
+            for (int j = 1; j <= subShapes.Extent(); j++) {
+                TopoDS_Shape subShape =
+                    subShapes(j).Located(TopLoc_Location());
+                if (!owners.IsBound(subShape)) {
+                    owners.Bind(subShape, (Standard_Integer)i);
+                } else if (owners.Find(subShape) != (Standard_Integer)i) {
+                    sharing[i] = true;
+                    sharing[owners.Find(subShape)] = true;
+                }
+            }
+        }
+    }
+
+    return sharing;
+}
+
+// mesh parts, numThreads at a time. parts that share faces or edges with
+// other parts are meshed one by one once the threads are done. a single part
+// is meshed with the mesher's own parallel mode instead, which meshes its
+// faces concurrently.
+static void meshParts(const std::vector<TopoDS_Shape> &parts,
+    Standard_Real deflection, Standard_Real angularDeflection, int numThreads,
+    std::vector<TriangleList> &partTriangles)
+{
+    partTriangles.resize(parts.size());
+
+    if (parts.size() == 1 || numThreads <= 1) {
+        for (size_t i = 0; i < parts.size(); i++) {
+            meshPart(parts[i], deflection, angularDeflection,
+                numThreads > 1, partTriangles[i]);
+        }
+        return;
+    }
+
+    std::vector<bool> sharing = findSharingParts(parts);
+    std::vector<int> independentParts;
+    for (size_t i = 0; i < parts.size(); i++) {
+        if (!sharing[i]) {
+            independentParts.push_back((int)i);
+        }
+    }
+
+    MeshJob job;
+    job.parts = &parts;
+    job.partIndices = &independentParts;
+    job.partTriangles = &partTriangles;
+    job.deflection = deflection;
+    job.angularDeflection = angularDeflection;
+    job.nextPart = 0;
+    job.failed = 0;
+
+    numThreads = std::min(numThreads, (int)independentParts.size());
+    std::vector<OSD_Thread> threads(numThreads,
+        OSD_Thread(meshPartsThread));
+    for (int i = 0; i < numThreads; i++) {
+        threads[i].Run(&job);
+    }
+    for (int i = 0; i < numThreads; i++) {
+        threads[i].Wait();
+    }
+
+    if (job.failed) {
+        throw std::runtime_error("meshing failed: " + job.error);
+    }
+
+    for (size_t i = 0; i < parts.size(); i++) {
+        if (sharing[i]) {
+            meshPart(parts[i], deflection, angularDeflection, true,
+                partTriangles[i]);
+        }
+    }
+}
+
+// write a binary STL file. parts that are placed more than once (i.e. whose
+// placements share a TShape) are only meshed once, and their triangles are
+// transformed to each placement. distinct parts are meshed by numThreads
+// threads.
+STLStats writeSTL(const TopoDS_Shape &shape, Standard_CString path,
+    Standard_Real deflection, Standard_Real angularDeflection,
+    int numThreads)
+{
+    STLStats stats = {0, 0, 0, 0};
+
+    std::vector<TopoDS_Shape> placements;
+    collectPlacements(shape, placements);
+
+    // parts by their untransformed shapes
+    TopTools_DataMapOfShapeInteger partIndices;
+    std::vector<TopoDS_Shape> parts;
+    std::vector<int> placementParts;
+
+    for (size_t i = 0; i < placements.size(); i++) {
+        TopoDS_Shape part = placements[i].Located(TopLoc_Location())
+            .Oriented(TopAbs_FORWARD);
+
+        if (!partIndices.IsBound(part)) {
+            partIndices.Bind(part, (Standard_Integer)parts.size());
+            parts.push_back(part);
+        }
+
+        placementParts.push_back(partIndices.Find(part));
+    }
+
+    std::vector<TriangleList> partTriangles;
+    meshParts(parts, deflection, angularDeflection, numThreads,
+        partTriangles);
+
+    for (size_t i = 0; i < parts.size(); i++) {
+        stats.uniqueTriangles += partTriangles[i].size() / 9;
+    }
+    for (size_t i = 0; i < placements.size(); i++) {
+        stats.triangles += partTriangles[placementParts[i]].size() / 9;
+    }
+
+    stats.parts = parts.size();
+    stats.placements = placements.size();
+
+    std::ofstream out(path, std::ios::out | std::ios::binary);
+    if (!out) {
+        throw std::runtime_error(std::string("can't write to ") + path);
+    }
+
+    char header[80];
+    std::memset(header, 0, sizeof(header));
+    std::strncpy(header, "binary STL written by ycad", sizeof(header));
+    out.write(header, sizeof(header));
+
+    uint32_t numTriangles = (uint32_t)stats.triangles;
+    out.write((const char *)&numTriangles, sizeof(numTriangles));
+
+    for (size_t i = 0; i < placements.size(); i++) {
+        const TriangleList &triangles = partTriangles[placementParts[i]];
+        const gp_Trsf &trsf = placements[i].Location().Transformation();
+        bool reversed = (placements[i].Orientation() == TopAbs_REVERSED);
+
+        for (size_t t = 0; t < triangles.size(); t += 9) {
+            gp_Pnt p[3];
+            for (int j = 0; j < 3; j++) {
+                p[j] = gp_Pnt(triangles[t + j * 3], triangles[t + j * 3 + 1],
+                    triangles[t + j * 3 + 2]).Transformed(trsf);
+            }
+
+            if (reversed) {
+                std::swap(p[1], p[2]);
+            }
+
+            gp_Vec normal = gp_Vec(p[0], p[1]).Crossed(gp_Vec(p[0], p[2]));
+            if (normal.Magnitude() > gp::Resolution()) {
+                normal.Normalize();
+            } else {
+                normal = gp_Vec(0, 0, 0);
+            }
+
+            // normal, 3 vertices, and a 2-byte attribute count
+            float record[12] = {
+                (float)normal.X(), (float)normal.Y(), (float)normal.Z(),
+            };
+            for (int j = 0; j < 3; j++) {
+                record[3 + j * 3] = (float)p[j].X();
+                record[3 + j * 3 + 1] = (float)p[j].Y();
+                record[3 + j * 3 + 2] = (float)p[j].Z();
+            }
+
+            uint16_t attributes = 0;
+            out.write((const char *)record, sizeof(record));
+            out.write((const char *)&attributes, sizeof(attributes));
+        }
+    }
+
+    if (!out) {
+        throw std::runtime_error(std::string("error writing to ") + path);
+    }
+
+    return stats;
 }
 
 // no need for this method - cython could handle it -
@@ -18,3 +438,161 @@ void readSTL(TopoDS_Shape &shape, Standard_CString path)
     StlAPI_Reader reader;
     reader.Read(shape, path);
 }
+
+// serialize shapes in OCC's binary BRep format, as BinTools::Write/Read do
+std::string shapeToBRep(const TopoDS_Shape &shape)
+{
+    BinTools_ShapeSet shapeSet;
+    shapeSet.Add(shape);
+
+    std::ostringstream stream(std::ios::out | std::ios::binary);
+    shapeSet.Write(stream);
+    shapeSet.Write(shape, stream);
+    return stream.str();
+}
+
+void shapeFromBRep(TopoDS_Shape &shape, const std::string &data)
+{
+    BinTools_ShapeSet shapeSet;
+
+    std::istringstream stream(data, std::ios::in | std::ios::binary);
+    shapeSet.Read(stream);
+    shapeSet.Read(shape, stream, shapeSet.NbShapes());
+}
+
+
+// sweeps profiles up the z axis, twisting them around it. the twist comes
+// from an auxiliary surface whose normal turns along the spine; it only
+// depends on the height and twist, so one is shared by all the wires of all
+// the faces of a profile.
+class TwistSweeper
+{
+public:
+    TwistSweeper(Standard_Real height, Standard_Real twist,
+        Standard_Real tolerance)
+        : tolerance(tolerance)
+    {
+        // split the twist into segments of at most 90 degrees
+        int numSegments = (int)std::floor(
+            std::fabs(twist) / (M_PI / 2) + Precision::Angular()) + 1;
+
+        TColgp_Array2OfPnt poles(1, 2, 1, numSegments + 1);
+        for (int i = 0; i <= numSegments; i++) {
+            Standard_Real z = height * i / numSegments;
+            Standard_Real angle = twist * i / numSegments;
+            poles(1, i + 1) = gp_Pnt(0, 0, z);
+            poles(2, i + 1) = gp_Pnt(std::cos(angle), std::sin(angle), z);
+        }
+
+        Handle(Geom_Surface) surface = new Geom_BezierSurface(poles);
+        auxFace = BRepBuilderAPI_MakeFace(surface, 0, 1, 0, 1,
+            Precision::Confusion()).Face();
+
+        TopoDS_Edge spineEdge = BRepBuilderAPI_MakeEdge(
+            GCE2d_MakeSegment(gp_Pnt2d(0, 0), gp_Pnt2d(0, 1)).Value(),
+            surface).Edge();
+        spine = BRepBuilderAPI_MakeWire(spineEdge).Wire();
+
+        gp_Trsf rotation, translation;
+        rotation.SetRotation(gp::OZ(), twist);
+        translation.SetTranslation(gp_Vec(0, 0, height));
+        top = translation.Multiplied(rotation);
+    }
+
+    // sweep wire. if solid, the ends are capped.
+    TopoDS_Shape sweep(const TopoDS_Shape &wire, bool solid)
+    {
+        BRepOffsetAPI_MakePipeShell pipe(spine);
+        if (!pipe.SetMode(auxFace)) {
+            throw std::runtime_error(
+                "failed setting twisted surface-normal for PipeShell");
+        }
+
+        pipe.Add(wire);
+        pipe.SetTolerance(tolerance, tolerance);
+        pipe.Build();
+        if (!pipe.IsDone()) {
+            throw std::runtime_error("twisted sweep failed");
+        }
+
+        if (solid) {
+            pipe.MakeSolid();
+        }
+
+        return pipe.Shape();
+    }
+
+    // sweep face, holes included
+    TopoDS_Shape sweepFace(const TopoDS_Face &face)
+    {
+        TopoDS_Shape fwdFace = face.Oriented(TopAbs_FORWARD);
+
+        std::vector<TopoDS_Shape> wires;
+        for (TopExp_Explorer exp(fwdFace, TopAbs_WIRE); exp.More();
+                exp.Next()) {
+            wires.push_back(exp.Current());
+        }
+
+        if (wires.size() == 1) {
+            return sweep(wires[0], true);
+        }
+
+        // sweep the sides of the outer wire and the holes, and sew them to
+        // the face at the bottom and its twisted copy at the top. that's
+        // much cheaper than cutting the holes out with a boolean.
+        BRepBuilderAPI_Sewing sewing(tolerance);
+        sewing.Add(fwdFace);
+        sewing.Add(BRepBuilderAPI_Transform(fwdFace, top, true).Shape());
+        for (size_t i = 0; i < wires.size(); i++) {
+            sewing.Add(sweep(wires[i], false));
+        }
+
+        sewing.Perform();
+
+        TopExp_Explorer shells(sewing.SewedShape(), TopAbs_SHELL);
+        if (!shells.More()) {
+            throw std::runtime_error("sewing twisted sweep failed");
+        }
+
+        TopoDS_Shell shell = TopoDS::Shell(shells.Current());
+        shells.Next();
+        if (shells.More()) {
+            throw std::runtime_error("twisted sweep isn't closed");
+        }
+
+        BRep_Builder builder;
+        TopoDS_Solid solid;
+        builder.MakeSolid(solid);
+        builder.Add(solid, shell);
+        if (!BRepLib::OrientClosedSolid(solid)) {
+            throw std::runtime_error("twisted sweep isn't closed");
+        }
+
+        return solid;
+    }
+
+private:
+    Standard_Real tolerance;
+    TopoDS_Face auxFace;
+    TopoDS_Wire spine;
+    // places the bottom of the sweep at the top
+    gp_Trsf top;
+};
+
+// extrude profile (a face, or a compound of faces, in the XY plane) to
+// height, twisting it by twist radians around the z axis.
+TopoDS_Shape twistExtrude(const TopoDS_Shape &profile, Standard_Real height,
+    Standard_Real twist, Standard_Real tolerance)
+{
+    TwistSweeper sweeper(height, twist, tolerance);
+
+    BRep_Builder builder;
+    TopoDS_Compound result;
+    builder.MakeCompound(result);
+
+    for (TopExp_Explorer exp(profile, TopAbs_FACE); exp.More(); exp.Next()) {
+        builder.Add(result, sweeper.sweepFace(TopoDS::Face(exp.Current())));
+    }
+
+    return result;
+}
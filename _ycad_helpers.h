@@ -1,9 +1,44 @@
+#include <string>
 #include <TopoDS_Shape.hxx>
-#include <StlAPI_Writer.hxx>
 #include <StlAPI_Reader.hxx>
+#include <BinTools_ShapeSet.hxx>
 
 
-void writeSTL(const TopoDS_Shape &shape, Standard_CString path,
-    Standard_Real deflection);
+struct STLStats
+{
+    // distinct parts (solids, shells or faces that aren't in compounds),
+    // and their placements in the shape
+    size_t parts;
+    size_t placements;
+    // triangles meshed, once per part, and written, once per placement
+    size_t uniqueTriangles;
+    size_t triangles;
+};
+
+// numbers of mesh nodes and triangles in all of a shape's faces
+struct MeshSize
+{
+    size_t nodes;
+    size_t triangles;
+};
+
+MeshSize meshShape(const TopoDS_Shape &shape, Standard_Real deflection,
+    Standard_Real angularDeflection, bool inParallel);
+
+MeshSize triangulationSize(const TopoDS_Shape &shape);
+
+void copyTriangulation(const TopoDS_Shape &shape, double *vertices,
+    int *triangles, int *faceIds);
+
+STLStats writeSTL(const TopoDS_Shape &shape, Standard_CString path,
+    Standard_Real deflection, Standard_Real angularDeflection,
+    int numThreads);
+
+TopoDS_Shape twistExtrude(const TopoDS_Shape &profile, Standard_Real height,
+    Standard_Real twist, Standard_Real tolerance);
 
 void readSTL(TopoDS_Shape &shape, Standard_CString path);
+
+std::string shapeToBRep(const TopoDS_Shape &shape);
+
+void shapeFromBRep(TopoDS_Shape &shape, const std::string &data);
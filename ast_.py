@@ -4,14 +4,33 @@ from __future__ import print_function, division
 from io import StringIO
 import operator
 import itertools
-import grammar
-from runtime import ReturnException, Module, Block, builtins
+import loader
+from runtime import ReturnException, NotVectorizable, Module, Block, builtins
+from lazyimport import LazyModule
 
+# imports numpy
+bulkeval = LazyModule('bulkeval')
+
+# nodes can be run in two ways: the eval()/exec_() methods walk the tree
+# directly, while compile() turns a node into a Python closure taking ctx,
+# with child nodes, operators and constants bound ahead of time. the compiled
+# closures are what normally runs; the tree-walker is kept as a reference.
 
 class Expr(object):
+    # source location, set by the parser
+    lineno = None
+    col = None
+
     def eval(self, ctx):
         raise NotImplementedError
 
+    def compile(self):
+        raise NotImplementedError
+
+    @property
+    def isConstant(self):
+        return False
+
 class LiteralExpr(Expr):
     def __init__(self, value):
         self.value = value
@@ -27,6 +46,18 @@ class LiteralExpr(Expr):
 
         return val
 
+    @property
+    def isConstant(self):
+        # vectors aren't, because each evaluation creates a new list
+        return not isinstance(self.value, Expr)
+
+    def compile(self):
+        if isinstance(self.value, Expr):
+            return self.value.compile()
+
+        value = self.value
+        return lambda ctx: value
+
 class VarNameExpr(Expr):
     def __init__(self, name):
         self.name = name
@@ -35,7 +66,10 @@ class VarNameExpr(Expr):
         return self.name
 
     def eval(self, ctx):
-        return ctx.getVar(self.name)
+        return self.binding.get(ctx)
+
+    def compile(self):
+        return self.binding.makeGetter()
 
 class SubscriptExpr(Expr):
     def __init__(self, arrayExpr, subscriptExpr):
@@ -51,6 +85,11 @@ class SubscriptExpr(Expr):
         subscript = int(self.subscriptExpr.eval(ctx))
         return array[subscript]
 
+    def compile(self):
+        arrayCode = self.arrayExpr.compile()
+        subscriptCode = self.subscriptExpr.compile()
+        return lambda ctx: arrayCode(ctx)[int(subscriptCode(ctx))]
+
 class FuncCallExpr(Expr):
     def __init__(self, funcName, posParams, namedParams, block):
         self.funcName = funcName
@@ -74,18 +113,63 @@ class FuncCallExpr(Expr):
     def call(self, ctx, funcObj):
         """Evaluate params in context, and pass them to funcObj."""
 
+        if ctx.bulk and not getattr(funcObj, 'broadcasts', False):
+            raise NotVectorizable(self.funcName)
+
         args = [expr.eval(ctx) for expr in self.posParams]
 
         kwargs = dict((nameExpr.name, valExpr.eval(ctx))
             for (nameExpr, valExpr) in self.namedParams)
 
-        if self.block is None:
+        if self.block is not None:
+            kwargs['block'] = Block(self.block)
+
+        if ctx.profiler is None:
+            return funcObj(ctx, *args, **kwargs)
+
+        with ctx.profiler.region('call', ctx.srcPath, self, self.funcName):
             return funcObj(ctx, *args, **kwargs)
-        else:
-            return funcObj(ctx, *args, block=Block(self.block), **kwargs)
 
     def eval(self, ctx):
-        return self.call(ctx, ctx.getVar(self.funcName))
+        return self.call(ctx, self.binding.get(ctx))
+
+    def compileCall(self, getFuncCode):
+        """
+        Compile a call to the function returned by getFuncCode(ctx), with
+        this expression's params.
+        """
+
+        argCodes = [expr.compile() for expr in self.posParams]
+        kwargCodes = [(nameExpr.name, valExpr.compile())
+            for (nameExpr, valExpr) in self.namedParams]
+
+        # Blocks don't hold any state of their own, so one will do for all
+        # calls
+        block = None if self.block is None else Block(self.block.compiled())
+
+        funcName = self.funcName
+
+        def call(ctx):
+            funcObj = getFuncCode(ctx)
+            if ctx.bulk and not getattr(funcObj, 'broadcasts', False):
+                raise NotVectorizable(funcName)
+
+            args = [code(ctx) for code in argCodes]
+
+            kwargs = {name: code(ctx) for (name, code) in kwargCodes}
+            if block is not None:
+                kwargs['block'] = block
+
+            if ctx.profiler is None:
+                return funcObj(ctx, *args, **kwargs)
+
+            with ctx.profiler.region('call', ctx.srcPath, self, funcName):
+                return funcObj(ctx, *args, **kwargs)
+
+        return call
+
+    def compile(self):
+        return self.compileCall(self.binding.makeGetter())
 
 # no attributes yet:
 #class AttrAccessExpr(Expr): pass
@@ -94,9 +178,55 @@ class VectorExpr(Expr):
     def __init__(self, exprs):
         self.exprs = exprs
 
+    def __repr__(self):
+        return '[{0}]'.format(', '.join(repr(expr) for expr in self.exprs))
+
     def eval(self, ctx):
         return [expr.eval(ctx) for expr in self.exprs]
 
+    def compile(self):
+        codes = [expr.compile() for expr in self.exprs]
+        return lambda ctx: [code(ctx) for code in codes]
+
+class ComprehensionExpr(Expr):
+    def __init__(self, expr, iterator, iterableExpr):
+        self.expr = expr
+        self.iterator = iterator.name
+        self.iterableExpr = iterableExpr
+
+    def __repr__(self):
+        return '[{0!r} for {1} in {2!r}]'.format(
+            self.expr, self.iterator, self.iterableExpr)
+
+    def eval(self, ctx):
+        return self.map(ctx, self.iterableExpr.eval(ctx), self.expr.eval,
+            self.binding.set)
+
+    def compile(self):
+        iterableCode = self.iterableExpr.compile()
+        exprCode = self.expr.compile()
+        setVar = self.binding.makeSetter()
+        return lambda ctx: self.map(ctx, iterableCode(ctx), exprCode, setVar)
+
+    def map(self, ctx, iterable, exprCode, setVar):
+        """
+        Return a list of exprCode's value for each item in iterable.
+        """
+
+        # evaluate all items at once if we can
+        if not ctx.bulk:
+            try:
+                return bulkeval.mapBulk(ctx, iterable, exprCode, setVar)
+            except NotVectorizable:
+                pass
+
+        values = []
+        for item in iterable:
+            setVar(ctx, item)
+            values.append(exprCode(ctx))
+
+        return values
+
 class UnaryOpExpr(Expr):
     OPS = {
             '-' : operator.neg,
@@ -107,10 +237,22 @@ class UnaryOpExpr(Expr):
         self.op = op
         self.expr = expr
 
+    def __repr__(self):
+        return '{0}{1}{2!r}'.format(
+            self.op, ' ' if self.op.isalpha() else '', self.expr)
+
     def eval(self, ctx):
         value = self.expr.eval(ctx)
         return (self.OPS[self.op])(value)
 
+    def compile(self):
+        code = self.expr.compile()
+        if self.op == '-':
+            return lambda ctx: -code(ctx)
+        else:
+            opFunc = self.OPS[self.op]
+            return lambda ctx: opFunc(code(ctx))
+
 class BinaryOpExpr(Expr):
     OPS = {
             '^' :  operator.pow,
@@ -133,11 +275,64 @@ class BinaryOpExpr(Expr):
         self.op = op
         self.exprs = exprs
 
+    def __repr__(self):
+        return '({0})'.format(
+            ' {0} '.format(self.op).join(repr(expr) for expr in self.exprs))
+
     def eval(self, ctx):
         opFunc = self.OPS[self.op]
         values = [expr.eval(ctx) for expr in self.exprs]
         return reduce(opFunc, values)
 
+    # python operators for OPS, for inlining into compiled code. 'and' and
+    # 'or' are bitwise, like operator.and_/or_.
+    PY_OPS = {
+            '^' : '**', '*' : '*', '/' : '/', '%' : '%', '+' : '+', '-' : '-',
+            '<' : '<', '<=' : '<=', '==' : '==', '!=' : '!=', '>' : '>',
+            '>=' : '>=', 'and' : '&', 'or' : '|',
+        }
+
+    _codeMakers = {}
+
+    @classmethod
+    def _getCodeMaker(cls, op, isConstA, isConstB):
+        """
+        Return a function that takes two operands - compiled code, or constant
+        values if isConstA/isConstB - and returns compiled code applying op to
+        them.
+        """
+
+        key = (op, isConstA, isConstB)
+        try:
+            return cls._codeMakers[key]
+        except KeyError:
+            pass
+
+        src = 'lambda a, b: lambda ctx: {0} {1} {2}'.format(
+            'a' if isConstA else 'a(ctx)',
+            cls.PY_OPS[op],
+            'b' if isConstB else 'b(ctx)')
+
+        # dont_inherit, so that '/' is compiled without this module's
+        # 'division' future import, and behaves like operator.div
+        maker = eval(compile(src, '<ycad {0} op>'.format(op), 'eval', 0, True))
+        cls._codeMakers[key] = maker
+        return maker
+
+    def compile(self):
+        # same left-to-right reduction as eval()
+        expr = self.exprs[0]
+        isConstA = expr.isConstant
+        a = expr.value if isConstA else expr.compile()
+
+        for expr in self.exprs[1:]:
+            isConstB = expr.isConstant
+            b = expr.value if isConstB else expr.compile()
+            a = self._getCodeMaker(self.op, isConstA, isConstB)(a, b)
+            isConstA = False
+
+        return a
+
 class MethodCallExpr(Expr):
     def __init__(self, expr, funcCallExpr):
         self.expr = expr
@@ -151,11 +346,46 @@ class MethodCallExpr(Expr):
         method = getattr(baseObj, self.funcCallExpr.funcName)
         return self.funcCallExpr.call(ctx, method)
 
+    def compile(self):
+        baseCode = self.expr.compile()
+        methodName = self.funcCallExpr.funcName
+        return self.funcCallExpr.compileCall(
+            lambda ctx: getattr(baseCode(ctx), methodName))
+
 
 class Stmt(object):
+    # source location, set by the parser
+    lineno = None
+    col = None
+
     def exec_(self, ctx):
         raise NotImplementedError
 
+    def compile(self):
+        raise NotImplementedError
+
+    def compiled(self):
+        return CompiledStmt(self)
+
+class CompiledStmt(Stmt):
+    """
+    Wraps a statement's compiled code, so that it can be run anywhere the
+    statement itself could be (e.g. in a runtime.Block).
+    """
+
+    def __init__(self, stmt):
+        self.stmt = stmt
+        self.code = stmt.compile()
+
+    def __repr__(self):
+        return repr(self.stmt)
+
+    def exec_(self, ctx):
+        self.code(ctx)
+
+    def compile(self):
+        return self.code
+
 class BlockStmt(Stmt):
     def __init__(self, stmts):
         self.stmts = stmts
@@ -166,8 +396,28 @@ class BlockStmt(Stmt):
                 repr(stmt) for stmt in self.stmts))
 
     def exec_(self, ctx):
-        for stmt in self.stmts:
-            stmt.exec_(ctx)
+        profiler = ctx.profiler
+        if profiler is None:
+            for stmt in self.stmts:
+                stmt.exec_(ctx)
+        else:
+            for stmt in self.stmts:
+                profiler.execStmt(stmt, ctx)
+
+    def compile(self):
+        stmts = self.stmts
+        codes = [stmt.compile() for stmt in stmts]
+
+        def execBlock(ctx):
+            profiler = ctx.profiler
+            if profiler is None:
+                for code in codes:
+                    code(ctx)
+            else:
+                for stmt, code in zip(stmts, codes):
+                    profiler.execStmt(stmt, ctx, code)
+
+        return execBlock
 
 class AssignStmt(Stmt):
     def __init__(self, lvalue, rvalue):
@@ -181,7 +431,15 @@ class AssignStmt(Stmt):
         if not isinstance(self.lvalue, VarNameExpr):
             raise NotImplementedError
 
-        ctx.setVar(self.lvalue.name, self.rvalue.eval(ctx))
+        self.binding.set(ctx, self.rvalue.eval(ctx))
+
+    def compile(self):
+        if not isinstance(self.lvalue, VarNameExpr):
+            raise NotImplementedError
+
+        setVar = self.binding.makeSetter()
+        code = self.rvalue.compile()
+        return lambda ctx: setVar(ctx, code(ctx))
 
 class ExprStmt(Stmt):
     def __init__(self, expr):
@@ -194,6 +452,10 @@ class ExprStmt(Stmt):
         val = self.expr.eval(ctx)
         ctx.sendToBlock(val)
 
+    def compile(self):
+        code = self.expr.compile()
+        return lambda ctx: ctx.sendToBlock(code(ctx))
+
 class IfStmt(Stmt):
     def __init__(self, condsAndBlocks, elseBlock=None):
         self.condsAndBlocks = condsAndBlocks
@@ -224,7 +486,28 @@ class IfStmt(Stmt):
             if self.elseBlock is not None:
                 self.elseBlock.exec_(ctx)
 
+    def compile(self):
+        condsAndCodes = [(cond.compile(), block.compile())
+            for (cond, block) in self.condsAndBlocks]
+        elseCode = (None if self.elseBlock is None
+            else self.elseBlock.compile())
+
+        def execIf(ctx):
+            for condCode, blockCode in condsAndCodes:
+                if condCode(ctx):
+                    blockCode(ctx)
+                    break
+
+            else:
+                if elseCode is not None:
+                    elseCode(ctx)
+
+        return execIf
+
 class FuncDefStmt(Stmt):
+    # set by memo.analyze() when the program is loaded
+    memoizable = False
+
     def __init__(self, funcName, paramsList, block):
         self.funcName = funcName.name
         self.paramsList = [(nameExpr.name, defaultExpr)
@@ -236,56 +519,116 @@ class FuncDefStmt(Stmt):
             .format(self, repr(self.block)))
 
     def exec_(self, ctx):
-        # create a new scope for the function
-        ctx.pushScope()
-        scopeChain = ctx.curScopeChain
-        ctx.popScope()
+        defaults = [(name, None if default is None else default.eval)
+            for (name, default) in self.paramsList]
+        self.defineFunc(ctx, self.block, defaults)
+
+    def compile(self):
+        body = self.block.compiled()
+        defaults = [(name, None if default is None else default.compile())
+            for (name, default) in self.paramsList]
+        return lambda ctx: self.defineFunc(ctx, body, defaults)
+
+    def defineFunc(self, ctx, body, defaults):
+        """
+        Define the function in ctx. body is the statement to run for each
+        call, and defaults is a list of (name, code) pairs with a function
+        evaluating each param's default value, or None if it has none.
+        """
+
+        layout = self.layout
+        params = [(name, slot, default) for ((name, default), slot)
+            in zip(defaults, layout.paramSlots)]
+
+        # the func runs in the module it was defined in, with the variables
+        # it uses from enclosing funcs
+        globals_ = ctx.globals
+        capturedCells = layout.captureCells(ctx)
+        srcPath = ctx.srcPath
+        funcMemo = ctx.funcMemo if self.memoizable else None
 
         def func(ctx, *args, **kwargs):
             assert len(args) + len(kwargs) <= self.paramsList, "Too many params!"
 
-            ctx.pushScope(scopeChain)
+            frame = layout.newFrame(capturedCells)
 
-            paramsIter = iter(self.paramsList)
+            prevGlobals = ctx.globals
+            prevFrame = ctx.frame
+            prevSrcPath = ctx.srcPath
+            ctx.globals = globals_
+            ctx.frame = frame
+            ctx.srcPath = srcPath
 
-            # put args first in zip() so that when args ends before paramsIter,
-            # we don't accidentally consume an extra param from paramsIter
-            for arg, (name, _) in zip(args, paramsIter):
-                # TODO: scope; new combination
-                ctx.setVar(name, arg)
-
-            namedParamsLeft = dict(paramsIter)
-            for argName, val in kwargs.iteritems():
-                namedParamsLeft.pop(argName)
-                ctx.setVar(argName, val)
-
-            for name, default in namedParamsLeft.iteritems():
-                # default is a parsed expression, or None if no default value
-                if default is None:
-                    raise ValueError(
-                        "Parameter '{0}' got no value in call to func {1}!"
-                        .format(name, self.funcName))
-
-                ctx.setVar(name, default.eval(ctx))
-
-            
             try:
-                # run block with a default 'add' combination
-                defaultResult = builtins['add'](ctx, block=Block(self.block))
+                paramsIter = iter(params)
+
+                # put args first in zip() so that when args ends before
+                # paramsIter, we don't accidentally consume an extra param
+                # from paramsIter
+                for arg, (_, slot, _) in zip(args, paramsIter):
+                    # TODO: new combination
+                    layout.setSlot(frame, slot, arg)
+
+                namedParamsLeft = dict((name, (slot, default))
+                    for (name, slot, default) in paramsIter)
+                for argName, val in kwargs.iteritems():
+                    slot, _ = namedParamsLeft.pop(argName)
+                    layout.setSlot(frame, slot, val)
+
+                for name, (slot, default) in namedParamsLeft.iteritems():
+                    # default evaluates the default value, or is None if none
+                    if default is None:
+                        raise ValueError(
+                            "Parameter '{0}' got no value in call to func {1}!"
+                            .format(name, self.funcName))
+
+                    layout.setSlot(frame, slot, default(ctx))
+
+                # comprehensions evaluated in bulk pass arrays of items,
+                # which aren't worth keying on
+                memoKey = None
+                if funcMemo is not None and not ctx.bulk:
+                    memoKey = funcMemo.makeKey(self,
+                        [layout.getSlot(frame, slot)
+                            for (_, slot, _) in params])
+
+                if memoKey is not None:
+                    result = funcMemo.get(memoKey)
+                    if result is not funcMemo.MISSING:
+                        return result
+
+                    prevSideEffects = ctx.sideEffects
+
+                # run block with a default 'add' combination. if it doesn't
+                # return anything else, the combination is the result.
+                if ctx.profiler is None:
+                    result = builtins['add'](ctx, block=Block(body))
+                else:
+                    with ctx.profiler.region('func', srcPath, self,
+                            self.funcName):
+                        result = builtins['add'](ctx, block=Block(body))
 
             except ReturnException as e:
-                return e.value
+                result = e.value
 
             finally:
-                ctx.popScope()
+                ctx.globals = prevGlobals
+                ctx.frame = prevFrame
+                ctx.srcPath = prevSrcPath
+
+            if memoKey is not None:
+                funcMemo.put(memoKey, result,
+                    ctx.sideEffects != prevSideEffects)
 
-            # if haven't returned anything else, return the combination
-            return defaultResult
+            return result
 
 
         func.func_name = self.funcName
+        # its body is safe to run with comprehension item arrays, see
+        # ComprehensionExpr
+        func.broadcasts = True
 
-        ctx.setVar(self.funcName, func)
+        self.binding.set(ctx, func)
 
 class ReturnStmt(Stmt):
     def __init__(self, expr):
@@ -297,6 +640,14 @@ class ReturnStmt(Stmt):
     def exec_(self, ctx):
         raise ReturnException(self.expr.eval(ctx))
 
+    def compile(self):
+        code = self.expr.compile()
+
+        def execReturn(ctx):
+            raise ReturnException(code(ctx))
+
+        return execReturn
+
 class ForStmt(Stmt):
     def __init__(self, lvalue, iterableExpr, block):
         self.lvalue = lvalue.name
@@ -310,9 +661,21 @@ class ForStmt(Stmt):
     def exec_(self, ctx):
         iterable = self.iterableExpr.eval(ctx)
         for i in iterable:
-            ctx.setVar(self.lvalue, i)
+            self.binding.set(ctx, i)
             self.block.exec_(ctx)
 
+    def compile(self):
+        setVar = self.binding.makeSetter()
+        iterableCode = self.iterableExpr.compile()
+        blockCode = self.block.compile()
+
+        def execFor(ctx):
+            for i in iterableCode(ctx):
+                setVar(ctx, i)
+                blockCode(ctx)
+
+        return execFor
+
 class ImportStmt(Stmt):
     def __init__(self, pkgPath):
         self.pkgPath = pkgPath
@@ -334,15 +697,19 @@ class ImportStmt(Stmt):
             pass
 
         modulePath = ctx.findModuleInPath(moduleName)
-        program = grammar.parseFile(modulePath)
+        program = loader.loadFile(modulePath)
         scope, moduleObj = ctx.execProgram(modulePath, program,
             moduleObjName='module.' + moduleName)
         module = Module(scope)
-        ctx.setVar(moduleName, module)
+        self.binding.set(ctx, module)
 
         # cache for next time
         ctx.modules[moduleName] = module
 
+    def compile(self):
+        # imports only run once per module, nothing to gain from compiling
+        return self.exec_
+
 
 class Program(BlockStmt):
     # essentially a block, but has a different __repr__
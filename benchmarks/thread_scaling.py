@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import _ycad
+
+
+# measures how well kernel calls scale across Python threads, now that they
+# release the GIL. each job builds, meshes and writes a shape of its own - a
+# plate drilled with a grid of holes - so the jobs share nothing, and should
+# scale with the number of threads up to the number of cores. the jobs run
+# on a single thread first, then on each of the given thread counts.
+
+TOLERANCE = 0.01
+ANGULAR_TOLERANCE = 0.5
+
+
+def drilledPlate(index, holesPerSide):
+    # vary the size a little, so that no two jobs build the same shape
+    size = 100. + index
+    pitch = size / holesPerSide
+
+    holes = []
+    for i in xrange(holesPerSide):
+        for j in xrange(holesPerSide):
+            transform = _ycad.Transform()
+            transform.setTranslation(((i + .5) * pitch, (j + .5) * pitch, -1))
+            holes.append(
+                _ycad.cylinder(pitch / 3., 12).withTransform(transform))
+
+    return _ycad.boolean('sub', [_ycad.box(size, size, 10)], holes)
+
+def runJob(args):
+    index, holesPerSide, outputDir = args
+    shape = drilledPlate(index, holesPerSide)
+    path = os.path.join(outputDir, 'plate{0}.stl'.format(index))
+    _ycad.writeSTL(shape, path, TOLERANCE, ANGULAR_TOLERANCE)
+
+def timeJobs(numJobs, numThreads, holesPerSide, outputDir):
+    jobs = [(i, holesPerSide, outputDir) for i in xrange(numJobs)]
+
+    startTime = time.time()
+    if numThreads == 1:
+        for job in jobs:
+            runJob(job)
+    else:
+        pool = ThreadPool(numThreads)
+        try:
+            pool.map(runJob, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return time.time() - startTime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--jobs", type=int, default=16,
+        help="number of independent shapes to build, mesh and write")
+    parser.add_argument("-t", "--threads", type=int, nargs='+',
+        default=[2, 4],
+        help="thread counts to compare with a single thread")
+    parser.add_argument("--holes", type=int, default=8,
+        help="holes per side of each plate. more holes make each job "
+            "slower")
+    args = parser.parse_args()
+
+    outputDir = tempfile.mkdtemp()
+    try:
+        baseTime = timeJobs(args.jobs, 1, args.holes, outputDir)
+        print('{0} jobs, 1 thread: {1:.2f}s'.format(args.jobs, baseTime))
+
+        for numThreads in args.threads:
+            elapsed = timeJobs(args.jobs, numThreads, args.holes, outputDir)
+            print('{0} jobs, {1} threads: {2:.2f}s (speedup {3:.2f}x)'.format(
+                args.jobs, numThreads, elapsed, baseTime / elapsed))
+    finally:
+        shutil.rmtree(outputDir)
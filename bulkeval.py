@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division
+import numpy as np
+from runtime import NotVectorizable
+
+
+# evaluating a comprehension's expression just once, for all of its items, by
+# setting the iterator to an array of them. this only works for numeric
+# items, and expressions that only do arithmetic and call funcs that can take
+# arrays (builtins and ycad funcs marked as 'broadcasts'). calls to anything
+# else raise NotVectorizable before they happen, so there are no side effects
+# to undo when falling back to evaluating the items one by one.
+
+
+class BulkArray(np.ndarray):
+    # marks arrays holding one value per item of a comprehension, as opposed
+    # to arrays that are values in their own right. numpy operations on
+    # these return BulkArrays, too.
+    pass
+
+
+def _stack(value, numItems):
+    """
+    Convert the value of a comprehension's expression, evaluated with
+    BulkArrays, to an array whose first axis corresponds to the items.
+    """
+
+    if isinstance(value, BulkArray):
+        if value.shape[:1] != (numItems,):
+            raise NotVectorizable
+        return value.view(np.ndarray)
+
+    if isinstance(value, list):
+        if not value:
+            raise NotVectorizable
+        return np.stack([_stack(elem, numItems) for elem in value], axis=1)
+
+    if isinstance(value, (int, long, float)):
+        # same for all items
+        return np.repeat(value, numItems)
+
+    raise NotVectorizable
+
+def mapBulk(ctx, iterable, exprCode, setVar):
+    """
+    Return the same list as evaluating exprCode with setVar() for each item
+    in iterable would, or raise NotVectorizable.
+    """
+
+    items = np.asarray(iterable)
+    if (items.ndim != 1 or items.dtype.kind not in 'biuf'
+            or len(items) == 0):
+        raise NotVectorizable
+
+    setVar(ctx, items.view(BulkArray))
+    ctx.bulk = True
+
+    try:
+        with np.errstate(all='raise'):
+            result = _stack(exprCode(ctx), len(items))
+
+    except (ArithmeticError, AttributeError, LookupError, TypeError,
+            ValueError):
+        raise NotVectorizable
+
+    finally:
+        ctx.bulk = False
+
+    # leave the iterator as the loop would
+    setVar(ctx, iterable[-1])
+    return result.tolist()
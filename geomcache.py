@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+from collections import Counter
+import hashlib
+import os
+import tempfile
+import _ycad
+import loader
+
+
+# building shapes (booleans especially) is slow, so the shapes of expensive
+# objects are kept in an on-disk cache across runs. each Object3D gets a key:
+# a hash of how it was constructed - its primitive's params, the transforms
+# applied to it, the operation that made it and the keys of its operands.
+# objects whose keys are unchanged since a previous run are read back from
+# the cache instead of being rebuilt, so after editing a model, only the
+# branches of the CSG tree that were affected by the edit are recomputed.
+#
+# entries are stored in OCC's binary BRep format. the cache is bounded in
+# size; the least recently used entries are removed by trim().
+
+# bump this whenever the way shapes are built changes, so that stale cache
+# entries are ignored
+GEOMETRY_VERSION = 3
+
+# module-wide settings, set by ycad.py according to command-line options
+cacheDir = loader.DEFAULT_CACHE_DIR
+useCache = True
+maxBytes = 1024 * 1024 * 1024
+
+stats = Counter()
+
+
+def _normalize(value):
+    """
+    Convert value to something with a stable repr: numbers to floats (so
+    that e.g. numpy floats and ints hash the same as python ones), vectors
+    and arrays to tuples.
+    """
+
+    if isinstance(value, (bool, basestring)) or value is None:
+        return value
+
+    if hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        value = value.tolist()
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(elem) for elem in value)
+
+    return float(value)
+
+def makeKey(*parts):
+    """
+    Return a key for an object built from parts: numbers, strings, vectors,
+    and keys of other objects. Returns None if any part is None, i.e. if it
+    depends on an object with no key.
+    """
+
+    if any(part is None for part in parts):
+        return None
+
+    digest = hashlib.sha1()
+    digest.update('{0}\0'.format(GEOMETRY_VERSION))
+    digest.update(repr(tuple(_normalize(part) for part in parts)))
+    return digest.hexdigest()
+
+def fileKey(path):
+    """
+    Return a key for the contents of the file at path.
+    """
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return makeKey('file', digest.hexdigest())
+
+
+def _entriesDir():
+    return os.path.join(cacheDir, 'geometry')
+
+def _entryPath(key):
+    return os.path.join(_entriesDir(), key + '.brep')
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    try:
+        shape = _ycad.shapeFromBRep(data)
+    except Exception:
+        # corrupt entry. treat it as a miss, it'll be overwritten.
+        return None
+
+    try:
+        # mark it as recently used, for trim()
+        os.utime(path, None)
+    except OSError:
+        pass
+
+    return shape
+
+def _write(path, shape):
+    data = _ycad.shapeToBRep(shape)
+
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # write to a temp file and rename it, so that concurrent runs never
+        # see a partially-written entry
+        fd, tmpPath = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmpPath, path)
+
+    except (IOError, OSError):
+        # the cache is only an optimization
+        stats['write errors'] += 1
+
+def lookup(key):
+    """
+    Return the shape with key from the cache, or None if it isn't there (or
+    if key is None).
+    """
+
+    if key is None or not useCache:
+        return None
+
+    shape = _read(_entryPath(key))
+    if shape is None:
+        stats['misses'] += 1
+    else:
+        stats['hits'] += 1
+    return shape
+
+def store(key, shape):
+    if key is not None and useCache and shape is not None:
+        _write(_entryPath(key), shape)
+
+def trim():
+    """
+    Remove the least recently used entries until the cache is no bigger
+    than maxBytes.
+    """
+
+    dirname = _entriesDir()
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return
+
+    entries = []
+    totalSize = 0
+    for name in names:
+        path = os.path.join(dirname, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        entries.append((st.st_mtime, st.st_size, path))
+        totalSize += st.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if totalSize <= maxBytes:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        totalSize -= size
+        stats['evictions'] += 1
+
+def statsReport():
+    return 'Geometry cache: {0} hits, {1} misses, {2} evictions'.format(
+        stats['hits'], stats['misses'], stats['evictions'])
@@ -10,6 +10,22 @@ from ast_ import *
 ParserElement.enablePackrat()
 
 
+def setLocation(node, s, loc):
+    node.lineno = lineno(loc, s)
+    node.col = col(loc, s)
+    return node
+
+def located(parseAction):
+    """
+    Wrap a parse action that builds an ast_ node, so that the node records
+    where in the source it came from.
+    """
+
+    def wrapper(s, loc, toks):
+        return setLocation(parseAction(s, loc, toks), s, loc)
+
+    return wrapper
+
 def oneOfKeywords(keywords):
     return MatchFirst(map(Keyword, keywords.split()))
 
@@ -30,8 +46,11 @@ UNITS = {
     'inch' : 25.4,
 }
 
+# units directly follow numbers (5mm), so they can't be Keywords, which don't
+# match right after an identifier character such as a digit. they still
+# mustn't be the start of a longer identifier (5mmx).
 unit = MatchFirst(
-    CaselessKeyword(unitName).setName(unitName)
+    Regex(r'(?i){0}(?![A-Za-z0-9_])'.format(unitName)).setName(unitName)
         .setParseAction(replaceWith(unitValue))
     for (unitName, unitValue)
     in UNITS.iteritems())
@@ -43,7 +62,7 @@ numberWithUnit = (number + Optional(unit)).setName("number with optional unit")
 numberWithUnit.setParseAction(lambda s,loc,toks: toks[0] if len(toks) == 1 else [toks[0]*toks[1]])
 
 vectorLiteral = surround("[]", Optional(delimitedList(literal))).setName("vector literal")
-vectorLiteral.setParseAction(lambda s,loc,toks: VectorExpr(toks.asList()))
+vectorLiteral.setParseAction(located(lambda s,loc,toks: VectorExpr(toks.asList())))
 
 boolLiteral = oneOfKeywords('true false').setName("boolean literal")
 boolLiteral.setParseAction(lambda s,loc,toks: eval(toks[0].title()))
@@ -52,27 +71,28 @@ stringLiteral = QuotedString(quoteChar='"', escChar='\\', escQuote='\\"').setNam
 
 literal << (numberWithUnit | vectorLiteral | boolLiteral | stringLiteral)
 literal.setName("literal")
-literal.setParseAction(lambda s,loc,toks: LiteralExpr(toks[0]))
+literal.setParseAction(located(lambda s,loc,toks: LiteralExpr(toks[0])))
 
 
 expr = Forward()
 stmt = Forward()
 
 block = surround("{}", ZeroOrMore(stmt), commit=True).setName("block")
-block.setParseAction(lambda s,loc,toks: BlockStmt(toks.asList()))
+block.setParseAction(located(lambda s,loc,toks: BlockStmt(toks.asList())))
 
 
 identifier = Word(alphas + "_", alphanums + "_").setName("identifier")
 
 varName = identifier.copy()
-varName.setParseAction(lambda s,loc,toks: VarNameExpr(toks[0]))
+varName.setParseAction(located(lambda s,loc,toks: VarNameExpr(toks[0])))
 
 # TODO: attrAccess = varName + OneOrMore("." + varName)
 
 vector = surround("[]", Optional(delimitedList(expr)), commit=True).setName("vector expression")
-vector.setParseAction(lambda s,loc,toks: VectorExpr(toks.asList()))
+vector.setParseAction(located(lambda s,loc,toks: VectorExpr(toks.asList())))
 
-unaryOpParseAction = lambda s,loc,toks: UnaryOpExpr(toks[0][0], toks[0][1])
+unaryOpParseAction = located(
+    lambda s,loc,toks: UnaryOpExpr(toks[0][0], toks[0][1]))
 
 def binaryOpParseAction(s, loc, toks):
     toks = toks[0]      # toks are grouped. ignore it.
@@ -81,7 +101,7 @@ def binaryOpParseAction(s, loc, toks):
     while toks:
         op = toks.pop(0)
         expr2 = toks.pop(0)
-        expr = BinaryOpExpr(op, [expr, expr2])
+        expr = setLocation(BinaryOpExpr(op, [expr, expr2]), s, loc)
 
     return expr
 
@@ -97,9 +117,11 @@ def compareOpParseAction(s, loc, toks):
         a = toks.pop(0)
         op = toks.pop(0)
         b = toks[0]
-        comparisons.append(BinaryOpExpr(op, [a, b]))
+        comparisons.append(setLocation(BinaryOpExpr(op, [a, b]), s, loc))
 
-    return reduce(lambda a,b: BinaryOpExpr('and', [a,b]), comparisons)
+    return reduce(
+        lambda a,b: setLocation(BinaryOpExpr('and', [a,b]), s, loc),
+        comparisons)
 
 
 namedParam = Group(varName("paramName") + Suppress("=") - expr("paramValue"))
@@ -118,9 +140,11 @@ funcCall = (
     | (identifier("funcName") + surround("()", paramList, commit=True)
         + Optional(block("block"))))
 funcCall.setName("function call")
-funcCall.setParseAction(
-    lambda s,loc,toks: FuncCallExpr(toks.funcName, toks.get("posParams", []),
-        toks.get("namedParams", []), toks.get("block", None)))
+funcCall.setParseAction(located(
+    lambda s,loc,toks: FuncCallExpr(toks.funcName,
+        list(toks.get("posParams", [])),
+        [tuple(p) for p in toks.get("namedParams", [])],
+        toks.get("block", None))))
 
 
 # put expr in a Group so that mathAtomParseAction() doesn't confuse it with
@@ -128,16 +152,26 @@ funcCall.setParseAction(
 # TODO: find a better way to do this
 subscript = Group(surround("[]", expr))
 
-mathAtom = ((literal | funcCall | varName | vector)
+# list comprehension, e.g. [x * 2 for x in xs]
+comprehension = surround("[]", expr("expr")
+    + Keyword("for").suppress() - varName("iterator")
+    + Keyword("in").suppress() - expr("iterable"))
+comprehension.setName("comprehension")
+comprehension.setParseAction(located(
+    lambda s,loc,toks: ComprehensionExpr(toks.expr, toks.iterator,
+        toks.iterable)))
+
+mathAtom = ((literal | funcCall | varName | comprehension | vector)
     + ZeroOrMore((Suppress(".") + funcCall) | subscript))
 mathAtom.setName("math atom")
 
 def mathAtomParseAction(s, loc, toks):
     def buildExpr(a, b):
         if isinstance(b, FuncCallExpr):
-            return MethodCallExpr(a, b)
+            expr = MethodCallExpr(a, b)
         else:
-            return SubscriptExpr(a, b[0])
+            expr = SubscriptExpr(a, b[0])
+        return setLocation(expr, s, loc)
 
     return reduce(buildExpr, toks)
 
@@ -151,9 +185,10 @@ expr << operatorPrecedence(
         (oneOf("* / %"), 2, opAssoc.LEFT, binaryOpParseAction),
         (oneOf("+ -"), 2, opAssoc.LEFT, binaryOpParseAction),
         (oneOf("< <= == != > >="), 2, opAssoc.LEFT, compareOpParseAction),
-        ("not", 1, opAssoc.RIGHT, unaryOpParseAction),      # boolean negation
-        ("and", 2, opAssoc.LEFT, binaryOpParseAction),
-        ("or", 2, opAssoc.LEFT, binaryOpParseAction),
+        # keywords, so that e.g. 'notch' isn't parsed as 'not ch'
+        (Keyword("not"), 1, opAssoc.RIGHT, unaryOpParseAction),     # boolean negation
+        (Keyword("and"), 2, opAssoc.LEFT, binaryOpParseAction),
+        (Keyword("or"), 2, opAssoc.LEFT, binaryOpParseAction),
     ])
 expr.setName("math expression")
 
@@ -161,7 +196,8 @@ expr.setName("math expression")
 
 assignment = varName("lvalue") + Suppress("=") - expr("rvalue")
 assignment.setName("assignment statement")
-assignment.setParseAction(lambda s,loc,toks: AssignStmt(toks.lvalue, toks.rvalue))
+assignment.setParseAction(
+    located(lambda s,loc,toks: AssignStmt(toks.lvalue, toks.rvalue)))
 
 # TODO: allow named params but only after positional params
 paramDef = varName("paramName") + Optional(
@@ -174,14 +210,14 @@ funcDef = (Keyword("func").suppress() - varName("funcName")
         commit=True)
     + block("block"))
 funcDef.setName("func statement")
-funcDef.setParseAction(
-    lambda s,loc,toks: FuncDefStmt(toks.funcName, toks.params, toks.block))
+funcDef.setParseAction(located(
+    lambda s,loc,toks: FuncDefStmt(toks.funcName, toks.params, toks.block)))
 
 
 def _makeSimpleStmt(keyword, stmtCls):
     stmt = Keyword(keyword).suppress() - expr
     stmt.setName("{0} statement".format(keyword))
-    stmt.setParseAction(lambda s,loc,toks: stmtCls(toks[0]))
+    stmt.setParseAction(located(lambda s,loc,toks: stmtCls(toks[0])))
     return stmt
 
 returnStmt = _makeSimpleStmt('return', ReturnStmt)
@@ -196,24 +232,25 @@ def ifStmtAction(s, loc, toks):
     elseBlock = toks.pop() if len(toks) % 2 == 1 else None
     condsAndBlocks = zip(*([iter(toks)] * 2))
     return IfStmt(condsAndBlocks, elseBlock)
-ifStmt.setParseAction(ifStmtAction)
+ifStmt.setParseAction(located(ifStmtAction))
 
 forStmt = (Keyword("for").suppress() - varName("iterator")
     + Keyword("in").suppress() - expr("iterable")
     + block("block"))
 forStmt.setName("for statement")
-forStmt.setParseAction(
-    lambda s,loc,toks: ForStmt(toks.iterator, toks.iterable, toks.block))
+forStmt.setParseAction(located(
+    lambda s,loc,toks: ForStmt(toks.iterator, toks.iterable, toks.block)))
 
 # TODO: implement
 part = Keyword("part") - stringLiteral("partName") - block("block")
 part.setName("part statement")
 
-exprStmt = expr.copy().addParseAction(lambda s,loc,toks: ExprStmt(toks[0]))
+exprStmt = expr.copy().addParseAction(
+    located(lambda s,loc,toks: ExprStmt(toks[0])))
 exprStmt.setName("expression statement")
 
 importStmt = Keyword("import").suppress() - delimitedList(identifier, delim='.')
-importStmt.setParseAction(lambda s,loc,toks: ImportStmt(toks.asList()))
+importStmt.setParseAction(located(lambda s,loc,toks: ImportStmt(toks.asList())))
 
 stmt << ~FollowedBy(Literal("}") | StringEnd()) + (block | funcDef
     | assignment | simpleStmt | ifStmt | forStmt | part | importStmt | exprStmt)
@@ -226,6 +263,12 @@ program.setName("program")
 program.ignore(pythonStyleComment)
 program.ignore(cStyleComment)
 
+# don't expand tabs, so that node locations match the source
+program.parseWithTabs()
+
+
+def parseString(source):
+    return Program(program.parseString(source).asList())
 
 def parseFile(filename):
     return Program(program.parseFile(filename).asList())
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is slow to import (numpy, cairo, etc.). The
+    real module is imported on first attribute access, so programs that never
+    use it never pay for it.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy module {0!r}>'.format(self._name)
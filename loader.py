@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+from collections import Counter
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import zlib
+import memo
+import optimizer
+import resolver
+
+
+# parsing is slow, so parsed programs are kept in an on-disk cache, keyed by
+# a hash of the source text and of GRAMMAR_VERSION. unchanged files (including
+# library modules from the include dir) are unpickled instead of re-parsed.
+
+# bump this whenever grammar.py or the node classes in ast_.py change in a way
+# that affects parsed trees, so that stale cache entries are ignored
+GRAMMAR_VERSION = 4
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ycad')
+
+# module-wide settings, set by ycad.py according to command-line options
+cacheDir = DEFAULT_CACHE_DIR
+useCache = True
+# parser engine: 'pyparsing' (grammar.py) or 'rd' (rdparser.py). both produce
+# the same trees, but the hand-written 'rd' is much faster on big sources.
+parser = 'pyparsing'
+# run the optimizer pass on loaded programs
+optimize = True
+
+stats = Counter()
+
+
+def _cachePath(source):
+    digest = hashlib.sha1()
+    digest.update('{0}\0{1}\0'.format(GRAMMAR_VERSION, parser))
+    digest.update(source)
+    return os.path.join(cacheDir, 'parse', digest.hexdigest() + '.pickle.z')
+
+def _readCache(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.loads(zlib.decompress(f.read()))
+    except IOError:
+        return None
+    except Exception:
+        # corrupt or incompatible entry. treat it as a miss, it'll be
+        # overwritten.
+        return None
+
+def _writeCache(path, program):
+    data = zlib.compress(pickle.dumps(program, pickle.HIGHEST_PROTOCOL))
+
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # write to a temp file and rename it, so that concurrent runs never
+        # see a partially-written entry
+        fd, tmpPath = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmpPath, path)
+
+    except (IOError, OSError):
+        # the cache is only an optimization
+        stats['write errors'] += 1
+
+def _parse(source):
+    # grammar takes a while to build, so only import it when we actually
+    # need to parse something
+    if parser == 'rd':
+        import rdparser
+        return rdparser.parseString(source)
+    else:
+        import grammar
+        return grammar.parseString(source)
+
+def parseFile(filename):
+    with open(filename, 'rb') as f:
+        source = f.read()
+
+    if not useCache:
+        return _parse(source)
+
+    path = _cachePath(source)
+    program = _readCache(path)
+    if program is not None:
+        stats['hits'] += 1
+        return program
+
+    stats['misses'] += 1
+    program = _parse(source)
+    _writeCache(path, program)
+    return program
+
+def loadFile(filename):
+    """
+    Parse a source file, and prepare the program to be run.
+    """
+
+    program = parseFile(filename)
+    if optimize:
+        optimizer.optimize(program)
+    resolver.resolve(program)
+    memo.analyze(program)
+    return program
+
+def statsReport():
+    return 'Parse cache: {0} hits, {1} misses'.format(
+        stats['hits'], stats['misses'])
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+from collections import Counter, OrderedDict
+import sys
+import ast_
+import runtime
+from resolver import assignedNames, children
+
+
+# memoization of ycad func calls. a func is memoizable if its result depends
+# only on its params: it captures no variables from enclosing funcs, and every
+# global it might read is either never assigned in its module, or assigned
+# exactly once, by a top-level statement. a func that calls a func that isn't
+# memoizable isn't memoizable either, since the callee's result can change
+# between calls. that's decided when the program is loaded, see analyze().
+#
+# calls to memoizable funcs are keyed on the values of their params (after
+# defaults are applied), and repeated calls return the first call's result.
+# shapes are shared between calls; that's safe because transforms and
+# booleans always make new Object3Ds. lists and arrays are copied, since
+# they can be modified in place.
+#
+# side effects (print()) are detected at run time. a call that has any isn't
+# cached, and its func is never memoized again.
+
+# module-wide settings, set by ycad.py according to command-line options.
+# maximum number of cached calls. 0 disables memoization.
+maxEntries = 1024
+
+stats = Counter()
+
+
+def _neededGlobals(funcDef):
+    """
+    Return the names of the globals funcDef's body (including nested funcs)
+    might read. Locals can fall back to the global of the same name if
+    they're read before being assigned, so they're included, too. Only params
+    are always set.
+    """
+
+    needed = set()
+
+    def visitFunc(funcDef, scopes):
+        params = set(name for (name, _) in funcDef.paramsList)
+        localNames = params.union(assignedNames(funcDef.block))
+        scopes = scopes + [(params, localNames)]
+
+        for _, default in funcDef.paramsList:
+            if default is not None:
+                visit(default, scopes)
+
+        visit(funcDef.block, scopes)
+
+    def visit(node, scopes):
+        if isinstance(node, ast_.VarNameExpr):
+            name = node.name
+        elif isinstance(node, ast_.FuncCallExpr):
+            name = node.funcName
+        else:
+            name = None
+
+        if name is not None:
+            for params, localNames in reversed(scopes):
+                if name in localNames:
+                    if name not in params:
+                        needed.add(name)
+                    break
+            else:
+                needed.add(name)
+
+        if isinstance(node, ast_.FuncDefStmt):
+            visitFunc(node, scopes)
+
+        for child in children(node):
+            visit(child, scopes)
+
+    visitFunc(funcDef, [])
+    return needed
+
+def _funcDefs(node):
+    """
+    Yield all FuncDefStmts in node, including nested ones.
+    """
+
+    if isinstance(node, ast_.FuncDefStmt):
+        yield node
+        for funcDef in _funcDefs(node.block):
+            yield funcDef
+
+    for child in children(node):
+        for funcDef in _funcDefs(child):
+            yield funcDef
+
+def analyze(program):
+    """
+    Mark each func defined in program (a resolved module) as memoizable or
+    not. Modifies the tree in place, and returns it.
+    """
+
+    assignCounts = Counter(assignedNames(program))
+
+    topLevelCounts = Counter()
+    for stmt in program.stmts:
+        if isinstance(stmt, ast_.AssignStmt):
+            topLevelCounts[stmt.lvalue.name] += 1
+        elif isinstance(stmt, ast_.FuncDefStmt):
+            topLevelCounts[stmt.funcName] += 1
+        elif isinstance(stmt, ast_.ImportStmt):
+            topLevelCounts[stmt.pkgPath[0]] += 1
+
+    def isStable(name):
+        count = assignCounts[name]
+        if count == 0:
+            return True
+
+        # a global that shadows a builtin isn't stable, because it reads as
+        # the builtin until it's assigned
+        return (count == 1 and topLevelCounts[name] == 1
+            and name not in runtime.builtins)
+
+    funcDefs = list(_funcDefs(program))
+    neededGlobals = dict((funcDef, _neededGlobals(funcDef))
+        for funcDef in funcDefs)
+    for funcDef in funcDefs:
+        funcDef.memoizable = (not funcDef.layout.closure
+            and all(isStable(name) for name in neededGlobals[funcDef]))
+
+    # a stable global named by a top-level func statement always refers to
+    # that func. callers of funcs that aren't memoizable aren't memoizable
+    # either, so propagate that along calls until nothing changes.
+    topLevelFuncs = dict((stmt.funcName, stmt) for stmt in program.stmts
+        if isinstance(stmt, ast_.FuncDefStmt))
+    changed = True
+    while changed:
+        changed = False
+        for funcDef in funcDefs:
+            if funcDef.memoizable and any(
+                    not topLevelFuncs[name].memoizable
+                    for name in neededGlobals[funcDef]
+                    if name in topLevelFuncs):
+                funcDef.memoizable = False
+                changed = True
+
+    return program
+
+
+class _Unhashable(Exception):
+    pass
+
+def _freeze(value):
+    """
+    Return a hashable key for value. Numbers are keyed with their type, since
+    e.g. 1 and 1.0 divide differently. Shapes, funcs and modules are keyed by
+    identity.
+    """
+
+    # bool before int, since it's a subclass
+    if isinstance(value, bool):
+        return (bool, value)
+
+    if isinstance(value, (int, long, float, basestring)):
+        return (type(value), value)
+
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(elem) for elem in value))
+
+    # if numpy isn't loaded yet, there can't be any arrays
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return (numpy.ndarray, value.dtype.str, value.shape, value.tostring())
+
+    if (value is None or callable(value)
+            or isinstance(value, (runtime.Object3D, runtime.Module))):
+        # the key holds a reference to value, so its id isn't reused while
+        # the entry is cached
+        return (id(value), value)
+
+    raise _Unhashable
+
+def _copyMutable(value):
+    """
+    Copy the lists and arrays in value, sharing everything else.
+    """
+
+    if isinstance(value, list):
+        return [_copyMutable(elem) for elem in value]
+
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.copy()
+
+    return value
+
+
+class FuncMemo(object):
+    """
+    An LRU cache of func call results, for one Context.
+    """
+
+    MISSING = object()
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        # funcs whose calls had side effects
+        self._impure = set()
+
+    def makeKey(self, funcDef, paramValues):
+        """
+        Return the key for a call of funcDef with paramValues, or None if
+        the call can't be memoized.
+        """
+
+        if funcDef in self._impure:
+            return None
+
+        try:
+            return (funcDef, tuple(_freeze(value) for value in paramValues))
+        except _Unhashable:
+            stats['uncacheable'] += 1
+            return None
+
+    def get(self, key):
+        """
+        Return the cached result for key, or MISSING.
+        """
+
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            stats['misses'] += 1
+            return self.MISSING
+
+        # re-insert, to mark it as the most recently used
+        self._entries[key] = value
+        stats['hits'] += 1
+        return _copyMutable(value)
+
+    def put(self, key, value, hadSideEffects):
+        if hadSideEffects:
+            funcDef, _ = key
+            self._impure.add(funcDef)
+            stats['uncacheable'] += 1
+            return
+
+        self._entries[key] = _copyMutable(value)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            stats['evictions'] += 1
+
+
+def statsReport():
+    return ('Func memo: {0} hits, {1} misses, {2} uncacheable, '
+        '{3} evictions'.format(stats['hits'], stats['misses'],
+            stats['uncacheable'], stats['evictions']))
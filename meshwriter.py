@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import tempfile
+import zipfile
+import _ycad
+from lazyimport import LazyModule
+
+
+# writes meshes in indexed formats - OBJ, PLY and 3MF - which list each
+# vertex once and refer to it from the triangles, instead of repeating it in
+# every triangle like STL does.
+#
+# the shape is meshed once, and then read face by face. vertices are welded
+# across faces by hashing their positions, rounded to WELD_QUANTUM, so each
+# vertex is written once and triangles that share an edge share its
+# vertices. triangles aren't kept in memory: they're spooled to a temporary
+# file as they're read, and copied from it to the output in chunks. only the
+# welded vertices (which all formats write before the triangles) stay in
+# memory until the end.
+
+np = LazyModule('numpy')
+
+# vertices closer than this (in mm) are welded together
+WELD_QUANTUM = 1e-5
+
+# triangles converted to the output format at once
+_CHUNK_TRIANGLES = 1 << 16
+
+# module-wide settings, set by ycad.py according to command-line options.
+# write vertex normals (OBJ and PLY), averaged from the normals of the
+# triangles around each vertex, weighted by their areas
+vertexNormals = False
+
+
+class _WeldedMesh(object):
+    """
+    Collects faces' meshes into a single mesh with welded vertices, keeping
+    the vertices in memory and spooling the triangles to a temporary file.
+    """
+
+    def __init__(self, normals=False):
+        # vertex indices by quantized position
+        self._indices = {}
+        self.vertices = np.empty((1024, 3), np.float64)
+        self._withNormals = normals
+        self.normals = None
+        self.numTriangles = 0
+        self.triangleFile = tempfile.TemporaryFile()
+
+    @property
+    def numVertices(self):
+        return len(self._indices)
+
+    def _grow(self, numVertices):
+        capacity = len(self.vertices)
+        if numVertices <= capacity:
+            return
+
+        while capacity < numVertices:
+            capacity *= 2
+
+        vertices = np.empty((capacity, 3), np.float64)
+        vertices[:len(self.vertices)] = self.vertices
+        self.vertices = vertices
+
+    def addFace(self, vertices, triangles):
+        if len(triangles) == 0:
+            return
+
+        keys = np.round(vertices / WELD_QUANTUM).astype(np.int64).tostring()
+        keySize = 3 * 8
+        indices = self._indices
+        # setdefault numbers new positions in order of appearance
+        remap = np.array(
+            [indices.setdefault(keys[i:i + keySize], len(indices))
+                for i in xrange(0, len(keys), keySize)],
+            np.int64)
+
+        self._grow(len(indices))
+        self.vertices[remap] = vertices
+
+        triangles = remap[triangles]
+        # welding collapses triangles smaller than WELD_QUANTUM
+        triangles = triangles[(triangles[:, 0] != triangles[:, 1])
+            & (triangles[:, 1] != triangles[:, 2])
+            & (triangles[:, 2] != triangles[:, 0])]
+
+        self.triangleFile.write(triangles.astype('<i4').tostring())
+        self.numTriangles += len(triangles)
+
+    def finish(self):
+        """
+        Trim the vertex array, compute the normals, and rewind the triangle
+        file.
+        """
+
+        self.vertices = self.vertices[:self.numVertices]
+        if self._withNormals:
+            self.normals = self._vertexNormals()
+
+        self.triangleFile.seek(0)
+
+    def _vertexNormals(self):
+        normals = np.zeros((self.numVertices, 3), np.float64)
+
+        self.triangleFile.seek(0)
+        for triangles in self.triangleChunks():
+            corners = self.vertices[triangles]
+            # the cross product's length is twice the triangle's area
+            areaNormals = np.cross(corners[:, 1] - corners[:, 0],
+                corners[:, 2] - corners[:, 0])
+            for i in xrange(3):
+                for axis in xrange(3):
+                    normals[:, axis] += np.bincount(triangles[:, i],
+                        areaNormals[:, axis], minlength=self.numVertices)
+
+        lengths = np.sqrt((normals**2).sum(axis=1))
+        lengths[lengths == 0] = 1
+        return normals / lengths[:, np.newaxis]
+
+    def triangleChunks(self):
+        """
+        Yield the triangles in (n, 3) int32 arrays.
+        """
+
+        chunkBytes = _CHUNK_TRIANGLES * 3 * 4
+        while True:
+            data = self.triangleFile.read(chunkBytes)
+            if not data:
+                return
+            yield np.fromstring(data, '<i4').reshape(-1, 3)
+
+    def close(self):
+        self.triangleFile.close()
+
+
+def _writeRows(f, rowFormat, rows):
+    """
+    Write each row of a 2D array formatted by rowFormat (with the row's
+    elements as arguments), a chunk of rows at a time.
+    """
+
+    for start in xrange(0, len(rows), _CHUNK_TRIANGLES):
+        chunk = rows[start:start + _CHUNK_TRIANGLES]
+        f.write((rowFormat * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def _writeOBJ(mesh, f):
+    f.write(b'# written by ycad\n')
+    _writeRows(f, b'v %.9g %.9g %.9g\n', mesh.vertices)
+
+    if mesh.normals is None:
+        faceFormat = b'f %d %d %d\n'
+    else:
+        _writeRows(f, b'vn %.6g %.6g %.6g\n', mesh.normals)
+        faceFormat = b'f %d//%d %d//%d %d//%d\n'
+
+    for triangles in mesh.triangleChunks():
+        # OBJ indices start at 1
+        triangles = triangles + 1
+        if mesh.normals is not None:
+            triangles = np.repeat(triangles, 2, axis=1)
+        _writeRows(f, faceFormat, triangles)
+
+def _writePLY(mesh, f):
+    vertexFields = [(b'x', b'<f4'), (b'y', b'<f4'), (b'z', b'<f4')]
+    if mesh.normals is not None:
+        vertexFields += [(b'nx', b'<f4'), (b'ny', b'<f4'), (b'nz', b'<f4')]
+
+    header = [b'ply', b'format binary_little_endian 1.0',
+        b'comment written by ycad',
+        b'element vertex {0}'.format(mesh.numVertices)]
+    header += [b'property float {0}'.format(name) for name, _ in vertexFields]
+    header += [b'element face {0}'.format(mesh.numTriangles),
+        b'property list uchar int vertex_indices', b'end_header']
+    f.write(b'\n'.join(header) + b'\n')
+
+    vertexRecords = np.empty(mesh.numVertices, vertexFields)
+    for i, name in enumerate([b'x', b'y', b'z']):
+        vertexRecords[name] = mesh.vertices[:, i]
+        if mesh.normals is not None:
+            vertexRecords[b'n' + name] = mesh.normals[:, i]
+    f.write(vertexRecords.tostring())
+
+    faceRecord = np.dtype([(b'count', b'u1'), (b'indices', b'<i4', (3,))])
+    for triangles in mesh.triangleChunks():
+        faceRecords = np.empty(len(triangles), faceRecord)
+        faceRecords[b'count'] = 3
+        faceRecords[b'indices'] = triangles
+        f.write(faceRecords.tostring())
+
+_3MF_CONTENT_TYPES = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+ <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+ <Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>
+'''
+
+_3MF_RELS = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+ <Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>
+'''
+
+def _write3MF(mesh, f):
+    # the model goes into a zip file, and ZipFile.write() compresses files
+    # from disk without reading them into memory, so write it to a
+    # temporary file first
+    tmpDir = tempfile.mkdtemp()
+    try:
+        modelPath = os.path.join(tmpDir, '3dmodel.model')
+        with open(modelPath, 'wb') as model:
+            model.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<model unit="millimeter" xml:lang="en-US"\n'
+                b'  xmlns="http://schemas.microsoft.com/3dmanufacturing/'
+                b'core/2015/02">\n'
+                b' <resources>\n'
+                b'  <object id="1" type="model">\n'
+                b'   <mesh>\n'
+                b'    <vertices>\n')
+            _writeRows(model, b'     <vertex x="%.9g" y="%.9g" z="%.9g"/>\n',
+                mesh.vertices)
+            model.write(b'    </vertices>\n'
+                b'    <triangles>\n')
+            for triangles in mesh.triangleChunks():
+                _writeRows(model,
+                    b'     <triangle v1="%d" v2="%d" v3="%d"/>\n', triangles)
+            model.write(b'    </triangles>\n'
+                b'   </mesh>\n'
+                b'  </object>\n'
+                b' </resources>\n'
+                b' <build>\n'
+                b'  <item objectid="1"/>\n'
+                b' </build>\n'
+                b'</model>\n')
+
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as package:
+            package.writestr('[Content_Types].xml', _3MF_CONTENT_TYPES)
+            package.writestr('_rels/.rels', _3MF_RELS)
+            package.write(modelPath, '3D/3dmodel.model')
+    finally:
+        shutil.rmtree(tmpDir)
+
+# writers by output file extension. 3MF has no vertex normals.
+_WRITERS = {
+    '.obj': (_writeOBJ, True),
+    '.ply': (_writePLY, True),
+    '.3mf': (_write3MF, False),
+}
+
+def isIndexedFormat(path):
+    return os.path.splitext(path)[1].lower() in _WRITERS
+
+def write(shape, path, tolerance, angularTolerance=0.5, parallel=False):
+    """
+    Mesh shape, and write it to path, in the format given by its extension
+    (see isIndexedFormat()). Returns a dict of counts: faces, vertices and
+    triangles (written).
+    """
+
+    writeFunc, hasNormals = _WRITERS[os.path.splitext(path)[1].lower()]
+
+    shape.tesselate(tolerance, angularTolerance, parallel)
+
+    mesh = _WeldedMesh(normals=vertexNormals and hasNormals)
+    try:
+        numFaces = 0
+        for face in shape.descendants(_ycad.TopAbs_FACE):
+            vertices, triangles = face.triangulate(tolerance,
+                angularTolerance, mesh=False)
+            mesh.addFace(vertices, triangles)
+            numFaces += 1
+
+        mesh.finish()
+        with open(path, 'wb') as f:
+            writeFunc(mesh, f)
+
+        counts = dict(faces=numFaces, vertices=mesh.numVertices,
+            triangles=mesh.numTriangles)
+    finally:
+        mesh.close()
+
+    return counts
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+from collections import Counter
+import ast_
+import runtime
+from resolver import assignedNames
+
+
+# an optimization pass over parsed programs, run when they're loaded (before
+# resolver.resolve()). it:
+#
+# * folds constant subexpressions, e.g. '10cm + 7cm' or 'cos(30)'.
+# * propagates scalar variables that are assigned a constant exactly once, at
+#   the top level of their scope, into the code that follows the assignment.
+# * evaluates calls to pure numeric funcs with constant arguments. a func is
+#   pure if its body is only assignments followed by a return, using nothing
+#   but its params, numeric builtins and other pure funcs.
+# * removes if branches whose conditions are constant.
+#
+# the tree is modified in place.
+
+# builtins with no side effects, that can be evaluated at load time
+PURE_BUILTINS = frozenset('''
+    pi e cos sin tan acos asin atan atan2 abs ceil exp floor ln log max min
+    pow round sign sqrt
+    '''.split())
+
+# how deep pure func calls may nest before we give up on evaluating them
+MAX_INLINE_DEPTH = 32
+
+stats = Counter()
+
+
+class _NotConstant(Exception):
+    pass
+
+
+# results of _Scope.lookup()
+CONST, BUILTIN, PURE_FUNC = 'const', 'builtin', 'pure func'
+
+class _Scope(object):
+    def __init__(self, parent, body, paramNames=()):
+        # parent is None for the module scope
+        self.parent = parent
+        self.assignCounts = Counter(assignedNames(body))
+        self.assignCounts.update(paramNames)
+
+        # variables known to be constant from this point in the scope's body
+        self.constants = {}
+        # name -> (FuncDefStmt, _Scope it was defined in)
+        self.pureFuncs = {}
+
+    def lookup(self, name):
+        """
+        Return (kind, value) if name is known to refer to a constant, a pure
+        builtin or a pure func here, or None if it might be anything.
+        """
+
+        scope = self
+        while scope is not None:
+            if name in scope.constants:
+                return CONST, scope.constants[name]
+
+            if name in scope.pureFuncs:
+                return PURE_FUNC, scope.pureFuncs[name]
+
+            if name in scope.assignCounts:
+                return None
+
+            scope = scope.parent
+
+        if name in PURE_BUILTINS:
+            return BUILTIN, runtime.builtins[name]
+
+        return None
+
+
+def _isScalar(value):
+    # numbers, bools and strings
+    return isinstance(value, (int, long, float, basestring))
+
+def _constValue(expr):
+    """
+    Return the value of expr if it's a literal, raise _NotConstant otherwise.
+    Vector literals are returned as (new) lists.
+    """
+
+    if not isinstance(expr, ast_.LiteralExpr):
+        raise _NotConstant
+
+    if isinstance(expr.value, ast_.VectorExpr):
+        return [_constValue(elem) for elem in expr.value.exprs]
+
+    if isinstance(expr.value, ast_.Expr):
+        raise _NotConstant
+
+    return expr.value
+
+def _toExpr(value, node):
+    """
+    Make a literal with value, at node's location.
+    """
+
+    if isinstance(value, list):
+        expr = ast_.LiteralExpr(
+            ast_.VectorExpr([_toExpr(elem, node) for elem in value]))
+    elif _isScalar(value):
+        expr = ast_.LiteralExpr(value)
+    else:
+        raise _NotConstant
+
+    expr.lineno = node.lineno
+    expr.col = node.col
+    return expr
+
+def _fold(node, func, *args):
+    """
+    Replace node with a literal of func(*args), or raise _NotConstant if that
+    fails or doesn't give a value we can put in a literal.
+    """
+
+    try:
+        value = func(*args)
+    except (ArithmeticError, ValueError, TypeError, LookupError):
+        # leave it to fail at run time, as it would have
+        raise _NotConstant
+
+    expr = _toExpr(value, node)
+    stats['folded'] += 1
+    return expr
+
+
+def _callPure(funcDef, scope, args, kwargs, depth):
+    """
+    Evaluate a call to a pure func with constant arguments.
+    """
+
+    if depth > MAX_INLINE_DEPTH:
+        raise _NotConstant
+
+    paramNames = [name for (name, _) in funcDef.paramsList]
+    if len(args) > len(paramNames):
+        raise _NotConstant
+
+    env = dict(zip(paramNames, args))
+    for name, value in kwargs.iteritems():
+        if name not in paramNames or name in env:
+            raise _NotConstant
+        env[name] = value
+
+    for name, default in funcDef.paramsList:
+        if name not in env:
+            if default is None:
+                raise _NotConstant
+            env[name] = _constValue(default)
+
+    localNames = set(paramNames)
+    localNames.update(assignedNames(funcDef.block))
+
+    for stmt in funcDef.block.stmts:
+        if isinstance(stmt, ast_.AssignStmt):
+            env[stmt.lvalue.name] = _evalPure(stmt.rvalue, env, localNames,
+                scope, depth)
+        elif isinstance(stmt, ast_.ReturnStmt):
+            return _evalPure(stmt.expr, env, localNames, scope, depth)
+        else:
+            raise _NotConstant
+
+    # no return, so it returns a combination
+    raise _NotConstant
+
+def _evalPure(expr, env, localNames, scope, depth):
+    """
+    Evaluate an expression in the body of a pure func.
+    """
+
+    def evalExpr(expr):
+        return _evalPure(expr, env, localNames, scope, depth)
+
+    if isinstance(expr, ast_.LiteralExpr):
+        if isinstance(expr.value, ast_.Expr):
+            return evalExpr(expr.value)
+        return expr.value
+
+    elif isinstance(expr, ast_.VarNameExpr):
+        if expr.name in env:
+            return env[expr.name]
+
+        if expr.name not in localNames:
+            found = scope.lookup(expr.name)
+            if found is not None and found[0] == BUILTIN:
+                return found[1]
+
+    elif isinstance(expr, ast_.VectorExpr):
+        return [evalExpr(elem) for elem in expr.exprs]
+
+    elif isinstance(expr, ast_.SubscriptExpr):
+        return evalExpr(expr.arrayExpr)[int(evalExpr(expr.subscriptExpr))]
+
+    elif isinstance(expr, ast_.UnaryOpExpr):
+        return expr.OPS[expr.op](evalExpr(expr.expr))
+
+    elif isinstance(expr, ast_.BinaryOpExpr):
+        return reduce(expr.OPS[expr.op], [evalExpr(e) for e in expr.exprs])
+
+    elif (isinstance(expr, ast_.FuncCallExpr) and expr.block is None
+            and expr.funcName not in localNames):
+        args = [evalExpr(e) for e in expr.posParams]
+        kwargs = dict((nameExpr.name, evalExpr(valExpr))
+            for (nameExpr, valExpr) in expr.namedParams)
+
+        found = scope.lookup(expr.funcName)
+        if found is not None:
+            kind, value = found
+            if kind == BUILTIN and callable(value):
+                return value(None, *args, **kwargs)
+            elif kind == PURE_FUNC:
+                funcDef, defScope = value
+                return _callPure(funcDef, defScope, args, kwargs, depth + 1)
+
+    raise _NotConstant
+
+
+def _optimizeExpr(expr, scope):
+    """
+    Return an optimized version of expr. Its children may be modified.
+    """
+
+    if isinstance(expr, ast_.VarNameExpr):
+        found = scope.lookup(expr.name)
+        if found is not None:
+            kind, value = found
+            if kind == CONST or (kind == BUILTIN and _isScalar(value)):
+                stats['propagated'] += 1
+                return _toExpr(value, expr)
+
+    elif isinstance(expr, ast_.LiteralExpr):
+        pass
+
+    elif isinstance(expr, ast_.SubscriptExpr):
+        expr.arrayExpr = _optimizeExpr(expr.arrayExpr, scope)
+        expr.subscriptExpr = _optimizeExpr(expr.subscriptExpr, scope)
+
+        try:
+            array = _constValue(expr.arrayExpr)
+            subscript = _constValue(expr.subscriptExpr)
+            return _fold(expr, lambda: array[int(subscript)])
+        except _NotConstant:
+            pass
+
+    elif isinstance(expr, ast_.VectorExpr):
+        expr.exprs = [_optimizeExpr(elem, scope) for elem in expr.exprs]
+
+    elif isinstance(expr, ast_.ComprehensionExpr):
+        expr.iterableExpr = _optimizeExpr(expr.iterableExpr, scope)
+        expr.expr = _optimizeExpr(expr.expr, scope)
+
+    elif isinstance(expr, ast_.UnaryOpExpr):
+        expr.expr = _optimizeExpr(expr.expr, scope)
+
+        try:
+            return _fold(expr, expr.OPS[expr.op], _constValue(expr.expr))
+        except _NotConstant:
+            pass
+
+    elif isinstance(expr, ast_.BinaryOpExpr):
+        exprs = [_optimizeExpr(e, scope) for e in expr.exprs]
+
+        # fold the constant operands at the start. operands are reduced
+        # left to right, so that's all we can fold without reordering.
+        numConst = 0
+        for e in exprs:
+            if not e.isConstant:
+                break
+            numConst += 1
+
+        if numConst >= 2:
+            opFunc = expr.OPS[expr.op]
+            values = [e.value for e in exprs[:numConst]]
+            try:
+                folded = _fold(expr, reduce, opFunc, values)
+            except _NotConstant:
+                pass
+            else:
+                if numConst == len(exprs):
+                    return folded
+                exprs = [folded] + exprs[numConst:]
+
+        expr.exprs = exprs
+
+    elif isinstance(expr, ast_.FuncCallExpr):
+        _optimizeCallParams(expr, scope)
+
+        if expr.block is None:
+            try:
+                return _foldCall(expr, scope)
+            except _NotConstant:
+                pass
+
+    elif isinstance(expr, ast_.MethodCallExpr):
+        expr.expr = _optimizeExpr(expr.expr, scope)
+        _optimizeCallParams(expr.funcCallExpr, scope)
+
+    return expr
+
+def _optimizeCallParams(callExpr, scope):
+    callExpr.posParams = [_optimizeExpr(e, scope) for e in callExpr.posParams]
+    callExpr.namedParams = [(nameExpr, _optimizeExpr(valExpr, scope))
+        for (nameExpr, valExpr) in callExpr.namedParams]
+
+    if callExpr.block is not None:
+        _optimizeBlock(callExpr.block, scope, False)
+
+def _foldCall(callExpr, scope):
+    found = scope.lookup(callExpr.funcName)
+    if found is None:
+        raise _NotConstant
+
+    args = [_constValue(e) for e in callExpr.posParams]
+    kwargs = dict((nameExpr.name, _constValue(valExpr))
+        for (nameExpr, valExpr) in callExpr.namedParams)
+
+    kind, value = found
+    if kind == BUILTIN and callable(value):
+        return _fold(callExpr, value, None, *args, **kwargs)
+
+    elif kind == PURE_FUNC:
+        funcDef, defScope = value
+        expr = _fold(callExpr, _callPure, funcDef, defScope, args, kwargs, 0)
+        stats['inlined'] += 1
+        return expr
+
+    raise _NotConstant
+
+
+def _isPure(funcDef):
+    stmts = funcDef.block.stmts
+    return (len(stmts) > 0
+        and isinstance(stmts[-1], ast_.ReturnStmt)
+        and all(isinstance(stmt, ast_.AssignStmt) for stmt in stmts[:-1]))
+
+def _optimizeStmt(stmt, scope, isTopLevel):
+    """
+    Optimize stmt, and return a list of statements to replace it with.
+    isTopLevel means stmt is run exactly once each time its scope is run.
+    """
+
+    if isinstance(stmt, ast_.AssignStmt):
+        stmt.rvalue = _optimizeExpr(stmt.rvalue, scope)
+
+        name = stmt.lvalue.name
+        if (isTopLevel and scope.assignCounts[name] == 1
+                and stmt.rvalue.isConstant and _isScalar(stmt.rvalue.value)):
+            scope.constants[name] = stmt.rvalue.value
+
+    elif isinstance(stmt, (ast_.ExprStmt, ast_.ReturnStmt)):
+        stmt.expr = _optimizeExpr(stmt.expr, scope)
+
+    elif isinstance(stmt, ast_.IfStmt):
+        condsAndBlocks = []
+        elseBlock = stmt.elseBlock
+
+        for cond, block in stmt.condsAndBlocks:
+            cond = _optimizeExpr(cond, scope)
+
+            if cond.isConstant:
+                stats['pruned'] += 1
+                if cond.value:
+                    # always taken, so the branches after it never are
+                    elseBlock = block
+                    break
+                else:
+                    continue
+
+            _optimizeBlock(block, scope, False)
+            condsAndBlocks.append((cond, block))
+
+        if not condsAndBlocks:
+            # only one way through it. blocks don't have their own scope, so
+            # the statements can just replace the if.
+            if elseBlock is None:
+                return []
+
+            stmts = []
+            for innerStmt in elseBlock.stmts:
+                stmts.extend(_optimizeStmt(innerStmt, scope, isTopLevel))
+            return stmts
+
+        if elseBlock is not None:
+            _optimizeBlock(elseBlock, scope, False)
+
+        stmt.condsAndBlocks = condsAndBlocks
+        stmt.elseBlock = elseBlock
+
+    elif isinstance(stmt, ast_.ForStmt):
+        stmt.iterableExpr = _optimizeExpr(stmt.iterableExpr, scope)
+        _optimizeBlock(stmt.block, scope, False)
+
+    elif isinstance(stmt, ast_.FuncDefStmt):
+        funcScope = _Scope(scope, stmt.block,
+            [name for (name, _) in stmt.paramsList])
+        _optimizeBlock(stmt.block, funcScope, True)
+
+        if (isTopLevel and scope.assignCounts[stmt.funcName] == 1
+                and _isPure(stmt)):
+            scope.pureFuncs[stmt.funcName] = (stmt, scope)
+
+    return [stmt]
+
+def _optimizeBlock(block, scope, isTopLevel):
+    stmts = []
+    for stmt in block.stmts:
+        stmts.extend(_optimizeStmt(stmt, scope, isTopLevel))
+    block.stmts = stmts
+
+
+def optimize(program):
+    """
+    Optimize program (a module) in place, and return it.
+    """
+
+    _optimizeBlock(program, _Scope(None, program), True)
+    return program
+
+def statsReport():
+    return ('Optimizer: {0} expressions folded, {1} variables propagated, '
+        '{2} calls inlined, {3} branches pruned'.format(stats['folded'],
+            stats['propagated'], stats['inlined'], stats['pruned']))
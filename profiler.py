@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function, division
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import time
+import runtime
+
+
+# counters from runtime.stats that are attributed to profiled regions
+COUNTERS = ('kernel calls', 'booleans', 'booleans skipped')
+
+
+class ProfileEntry(object):
+    def __init__(self, kind, srcPath, lineno, col, desc):
+        self.kind = kind
+        self.srcPath = srcPath
+        self.lineno = lineno
+        self.col = col
+        self.desc = desc
+
+        self.count = 0
+        self.totalTime = 0.
+        self.selfTime = 0.
+        self.counters = Counter()
+
+    @property
+    def location(self):
+        return '{0}:{1}:{2}'.format(
+            os.path.basename(self.srcPath) if self.srcPath else '?',
+            self.lineno, self.col)
+
+    def asDict(self):
+        d = dict((name, getattr(self, name)) for name in
+            'kind srcPath lineno col desc count totalTime selfTime'.split())
+        d.update((name, self.counters[name]) for name in COUNTERS)
+        return d
+
+
+class _Frame(object):
+    def __init__(self, entry):
+        self.entry = entry
+        self.startTime = time.time()
+        self.startCounters = Counter(runtime.stats)
+        self.childTime = 0.
+
+
+class Profiler(object):
+    """
+    Attributes wall time and kernel work to statements, func definitions
+    and call sites.
+
+    Times and counters are inclusive, except for selfTime, which excludes
+    time spent in nested profiled regions. Recursive calls are only counted
+    once in the inclusive numbers.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._stack = []
+        self._active = Counter()
+
+    def _getEntry(self, kind, srcPath, node, desc):
+        key = (kind, srcPath, node.lineno, node.col)
+        try:
+            return self.entries[key]
+        except KeyError:
+            entry = ProfileEntry(kind, srcPath, node.lineno, node.col, desc)
+            self.entries[key] = entry
+            return entry
+
+    @contextmanager
+    def region(self, kind, srcPath, node, desc):
+        entry = self._getEntry(kind, srcPath, node, desc)
+        frame = _Frame(entry)
+        self._stack.append(frame)
+        self._active[entry] += 1
+
+        try:
+            yield
+
+        finally:
+            elapsed = time.time() - frame.startTime
+            self._stack.pop()
+            self._active[entry] -= 1
+
+            entry.count += 1
+            entry.selfTime += elapsed - frame.childTime
+            if self._stack:
+                self._stack[-1].childTime += elapsed
+
+            if self._active[entry] == 0:
+                entry.totalTime += elapsed
+                for name in COUNTERS:
+                    entry.counters[name] += (runtime.stats[name]
+                        - frame.startCounters[name])
+
+    def execStmt(self, stmt, ctx, code=None):
+        """
+        Run stmt inside a profiled region. If given, its compiled code is run
+        instead of stmt.exec_.
+        """
+
+        desc = repr(stmt).split('\n', 1)[0]
+        with self.region('stmt', ctx.srcPath, stmt, desc):
+            if code is None:
+                stmt.exec_(ctx)
+            else:
+                code(ctx)
+
+    def sortedEntries(self):
+        return sorted(self.entries.itervalues(),
+            key=lambda entry: entry.totalTime, reverse=True)
+
+    def printReport(self, file=None, limit=40):
+        entries = self.sortedEntries()
+
+        print('{0:>9} {1:>9} {2:>7} {3:>7} {4:>5}  {5:<24} {6:<4}  {7}'.format(
+            'total(s)', 'self(s)', 'count', 'kernel', 'bool',
+            'location', 'kind', 'code'), file=file)
+
+        for entry in entries[:limit]:
+            print('{0.totalTime:9.3f} {0.selfTime:9.3f} {0.count:7} '
+                '{1:7} {2:5}  {0.location:<24} {0.kind:<4}  {3}'.format(
+                    entry, entry.counters['kernel calls'],
+                    entry.counters['booleans'], entry.desc[:60]),
+                file=file)
+
+        if len(entries) > limit:
+            print('({0} more entries not shown)'.format(len(entries) - limit),
+                file=file)
+
+    def writeJSON(self, path):
+        with open(path, 'w') as f:
+            json.dump([entry.asDict() for entry in self.sortedEntries()], f,
+                indent=1)
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import re
+from bisect import bisect_right
+from ast_ import *
+
+
+# a hand-written recursive-descent parser for the same language as grammar.py.
+# it produces exactly the same trees as the pyparsing grammar, but runs in
+# time linear in the size of the source, and doesn't need packrat memoization.
+
+UNITS = {
+    'mm' : 1,
+    'cm' : 10,
+    'm' : 1000,
+    'inch' : 25.4,
+}
+
+COMPARE_OPS = frozenset('< <= == != > >='.split())
+
+
+class ParseError(Exception):
+    def __init__(self, msg, source, pos):
+        self.msg = msg
+        self.lineno = source.count('\n', 0, pos) + 1
+        self.col = pos - (source.rfind('\n', 0, pos) + 1) + 1
+        Exception.__init__(self, '{0} (at line {1}, col {2})'.format(
+            msg, self.lineno, self.col))
+
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>     \s+ | \#[^\n]* | /\*(?:.|\n)*?\*/ )
+  | (?P<num>    \d+(?:\.\d+)? )
+  | (?P<name>   [A-Za-z_][A-Za-z0-9_]* )
+  | (?P<str>    "(?:[^"\n\r\\]|\\.)*" )
+  | (?P<op>     <= | >= | == | != | [-+*/%^<>=()\[\]{},.] )
+    ''', re.VERBOSE)
+
+_ESCAPE_RE = re.compile(r'\\(.)')
+_WHITESPACE_ESCAPES = [
+    (r'\t', '\t'), (r'\n', '\n'), (r'\f', '\f'), (r'\r', '\r')]
+
+def _unescape(s):
+    """
+    Unescape the contents of a string literal, in the same steps as
+    pyparsing's QuotedString: whitespace escapes are replaced first, then
+    any other escaped character stands for itself. (so "\\\\n" is a
+    backslash and a newline, like in grammar.py.)
+    """
+
+    if '\\' in s:
+        for escape, char in _WHITESPACE_ESCAPES:
+            s = s.replace(escape, char)
+        s = _ESCAPE_RE.sub(r'\1', s)
+    return s
+
+def tokenize(source):
+    """
+    Split source into a list of (kind, value, pos) tuples, ending with an
+    'eof' token. kind is one of 'num', 'name', 'str', 'op'.
+    """
+
+    tokens = []
+    pos = 0
+    end = len(source)
+    match = _TOKEN_RE.match
+    while pos < end:
+        m = match(source, pos)
+        if m is None:
+            raise ParseError('Unexpected character {0!r}'.format(source[pos]),
+                source, pos)
+
+        kind = m.lastgroup
+        if kind == 'num':
+            tokens.append(('num', float(m.group()), pos))
+        elif kind == 'str':
+            tokens.append(('str', _unescape(m.group()[1:-1]), pos))
+        elif kind != 'ws':
+            tokens.append((kind, m.group(), pos))
+
+        pos = m.end()
+
+    tokens.append(('eof', None, end))
+    return tokens
+
+
+class Parser(object):
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+        # offsets of line starts, for converting positions to line/col
+        self._lineStarts = [0] + [m.end() for m in re.finditer('\n', source)]
+
+    # token helpers
+
+    @property
+    def _tok(self):
+        return self.tokens[self.pos]
+
+    @property
+    def _start(self):
+        return self.tokens[self.pos][2]
+
+    def _peek(self, offset=1):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def _error(self, msg):
+        raise ParseError(msg, self.source, self._start)
+
+    def _located(self, node, start):
+        # same as grammar.setLocation(): 1-based line and column
+        lineIdx = bisect_right(self._lineStarts, start) - 1
+        node.lineno = lineIdx + 1
+        node.col = start - self._lineStarts[lineIdx] + 1
+        return node
+
+    def _isOp(self, value):
+        kind, tokValue, _ = self._tok
+        return kind == 'op' and tokValue == value
+
+    def _isName(self, value):
+        kind, tokValue, _ = self._tok
+        return kind == 'name' and tokValue == value
+
+    def _next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def _expectOp(self, value):
+        if not self._isOp(value):
+            self._error('Expected "{0}"'.format(value))
+        self.pos += 1
+
+    def _expectName(self, value=None):
+        kind, tokValue, _ = self._tok
+        if kind != 'name' or (value is not None and tokValue != value):
+            self._error('Expected {0}'.format(
+                'identifier' if value is None else '"{0}"'.format(value)))
+        self.pos += 1
+        return tokValue
+
+    def _expectVarName(self):
+        start = self._start
+        return self._located(VarNameExpr(self._expectName()), start)
+
+    def _isAssignment(self):
+        # "name =" (a lone '=', not '==')
+        return self._tok[0] == 'name' and self._peek()[:2] == ('op', '=')
+
+    # statements
+
+    def parseProgram(self):
+        stmts = []
+        while self._tok[0] != 'eof':
+            if self._isOp('}'):
+                self._error('Unexpected "}"')
+            stmts.append(self.parseStmt())
+        return Program(stmts)
+
+    def parseBlock(self):
+        start = self._start
+        self._expectOp('{')
+        stmts = []
+        while not self._isOp('}'):
+            if self._tok[0] == 'eof':
+                self._error('Expected "}"')
+            stmts.append(self.parseStmt())
+        self.pos += 1
+        return self._located(BlockStmt(stmts), start)
+
+    def parseStmt(self):
+        if self._isOp('{'):
+            return self.parseBlock()
+
+        start = self._start
+        kind, value, _ = self._tok
+        if kind == 'name':
+            # keywords are only special when they aren't assigned to, just
+            # like in grammar.py (except for 'func', which always commits)
+            if value == 'func':
+                return self.parseFuncDef()
+            if self._isAssignment():
+                return self.parseAssignment()
+            if value == 'return':
+                self.pos += 1
+                return self._located(ReturnStmt(self.parseExpr()), start)
+            if value == 'if':
+                return self.parseIf()
+            if value == 'for':
+                return self.parseFor()
+            if value == 'part':
+                # grammar.py parses these, but doesn't implement them either
+                self._error('part statements are not implemented')
+            if value == 'import':
+                return self.parseImport()
+
+        return self._located(ExprStmt(self.parseExpr()), start)
+
+    def parseAssignment(self):
+        start = self._start
+        lvalue = self._expectVarName()
+        self._expectOp('=')
+        return self._located(AssignStmt(lvalue, self.parseExpr()), start)
+
+    def parseFuncDef(self):
+        start = self._start
+        self._expectName('func')
+        funcName = self._expectVarName()
+
+        params = []
+        self._expectOp('(')
+        if not self._isOp(')'):
+            while True:
+                paramName = self._expectVarName()
+                default = None
+                if self._isOp('='):
+                    self.pos += 1
+                    default = self.parseLiteral()
+                    if default is None:
+                        self._error('Expected literal')
+                params.append([paramName, default])
+
+                if not self._isOp(','):
+                    break
+                self.pos += 1
+        self._expectOp(')')
+
+        return self._located(
+            FuncDefStmt(funcName, params, self.parseBlock()), start)
+
+    def parseIf(self):
+        start = self._start
+        self._expectName('if')
+        condsAndBlocks = [(self.parseExpr(), self.parseBlock())]
+        elseBlock = None
+
+        while self._isName('else'):
+            self.pos += 1
+            if self._isName('if'):
+                self.pos += 1
+                condsAndBlocks.append((self.parseExpr(), self.parseBlock()))
+            else:
+                elseBlock = self.parseBlock()
+                break
+
+        return self._located(IfStmt(condsAndBlocks, elseBlock), start)
+
+    def parseFor(self):
+        start = self._start
+        self._expectName('for')
+        iterator = self._expectVarName()
+        self._expectName('in')
+        iterable = self.parseExpr()
+        return self._located(
+            ForStmt(iterator, iterable, self.parseBlock()), start)
+
+    def parseImport(self):
+        start = self._start
+        self._expectName('import')
+        pkgPath = [self._expectName()]
+        while self._isOp('.'):
+            self.pos += 1
+            pkgPath.append(self._expectName())
+        return self._located(ImportStmt(pkgPath), start)
+
+    # expressions, from loosest to tightest binding. these follow the
+    # operatorPrecedence() table in grammar.py, including the way its parse
+    # actions build the trees: all nodes built from a chain of operators are
+    # located at the start of the chain.
+
+    def parseExpr(self):
+        return self._parseLeftAssoc(('or',), self.parseAnd)
+
+    def parseAnd(self):
+        return self._parseLeftAssoc(('and',), self.parseNot)
+
+    def parseNot(self):
+        if self._isName('not'):
+            start = self._start
+            self.pos += 1
+            return self._located(UnaryOpExpr('not', self.parseNot()), start)
+        return self.parseComparison()
+
+    def parseComparison(self):
+        # comparison ops can be chained, i.e. x == y == z means
+        # (x == y) and (y == z)
+        start = self._start
+        a = self.parseSum()
+        comparisons = []
+        while self._tok[0] == 'op' and self._tok[1] in COMPARE_OPS:
+            op = self._next()[1]
+            b = self.parseSum()
+            comparisons.append(self._located(BinaryOpExpr(op, [a, b]), start))
+            a = b
+
+        if not comparisons:
+            return a
+
+        return reduce(
+            lambda a,b: self._located(BinaryOpExpr('and', [a,b]), start),
+            comparisons)
+
+    def parseSum(self):
+        return self._parseLeftAssoc(('+', '-'), self.parseProduct)
+
+    def parseProduct(self):
+        return self._parseLeftAssoc(('*', '/', '%'), self.parseNegation)
+
+    def parseNegation(self):
+        if self._isOp('-'):
+            start = self._start
+            self.pos += 1
+            return self._located(UnaryOpExpr('-', self.parseNegation()), start)
+        return self.parsePower()
+
+    def parsePower(self):
+        start = self._start
+        base = self.parseOperand()
+        if self._isOp('^'):
+            self.pos += 1
+            # right associative
+            return self._located(
+                BinaryOpExpr('^', [base, self.parsePower()]), start)
+        return base
+
+    def _parseLeftAssoc(self, ops, parseOperand):
+        start = self._start
+        expr = parseOperand()
+        while self._tok[0] in ('op', 'name') and self._tok[1] in ops:
+            op = self._next()[1]
+            expr = self._located(BinaryOpExpr(op, [expr, parseOperand()]),
+                start)
+        return expr
+
+    def parseOperand(self):
+        if self._isOp('('):
+            self.pos += 1
+            expr = self.parseExpr()
+            self._expectOp(')')
+            return expr
+
+        return self.parseMathAtom()
+
+    def parseMathAtom(self):
+        start = self._start
+        expr = self.parseLiteral()
+        if expr is None:
+            kind, value, _ = self._tok
+            if kind == 'name':
+                if (value in ('add', 'sub', 'mul')
+                        or self._peek()[:2] == ('op', '(')):
+                    expr = self.parseFuncCall()
+                else:
+                    expr = self._expectVarName()
+            elif self._isOp('['):
+                expr = self._parseVectorOrComprehension()
+            else:
+                self._error('Expected expression')
+
+        while True:
+            if self._isOp('.'):
+                self.pos += 1
+                expr = self._located(
+                    MethodCallExpr(expr, self.parseFuncCall()), start)
+            elif self._isOp('['):
+                self.pos += 1
+                subscript = self.parseExpr()
+                self._expectOp(']')
+                expr = self._located(SubscriptExpr(expr, subscript), start)
+            else:
+                return expr
+
+    def parseFuncCall(self):
+        start = self._start
+        funcName = self._expectName()
+
+        # add/sub/mul act like functions with no parameter list and a
+        # mandatory block
+        if funcName in ('add', 'sub', 'mul'):
+            return self._located(
+                FuncCallExpr(funcName, [], [], self.parseBlock()), start)
+
+        posParams = []
+        namedParams = []
+        self._expectOp('(')
+        if not self._isOp(')'):
+            while True:
+                if self._isAssignment():
+                    paramName = self._expectVarName()
+                    self.pos += 1
+                    namedParams.append((paramName, self.parseExpr()))
+                elif namedParams:
+                    self._error('Positional parameter after named parameter')
+                else:
+                    posParams.append(self.parseExpr())
+
+                if not self._isOp(','):
+                    break
+                self.pos += 1
+        self._expectOp(')')
+
+        block = self.parseBlock() if self._isOp('{') else None
+        return self._located(
+            FuncCallExpr(funcName, posParams, namedParams, block), start)
+
+    def _parseVectorOrComprehension(self):
+        start = self._start
+        self._expectOp('[')
+        items = []
+        if not self._isOp(']'):
+            while True:
+                items.append(self.parseExpr())
+
+                if len(items) == 1 and self._isName('for'):
+                    self.pos += 1
+                    iterator = self._expectVarName()
+                    self._expectName('in')
+                    iterable = self.parseExpr()
+                    self._expectOp(']')
+                    return self._located(
+                        ComprehensionExpr(items[0], iterator, iterable), start)
+
+                if not self._isOp(','):
+                    break
+                self.pos += 1
+        self._expectOp(']')
+        return self._located(VectorExpr(items), start)
+
+    def parseLiteral(self):
+        """
+        Parse a literal, or return None (without consuming anything) if there
+        isn't one here.
+        """
+
+        kind, value, start = self._tok
+        if kind == 'num':
+            self.pos += 1
+            kind, unitName, _ = self._tok
+            if kind == 'name' and unitName.lower() in UNITS:
+                self.pos += 1
+                value *= UNITS[unitName.lower()]
+            return self._located(LiteralExpr(value), start)
+
+        elif kind == 'str':
+            self.pos += 1
+            return self._located(LiteralExpr(value), start)
+
+        elif kind == 'name' and value in ('true', 'false'):
+            self.pos += 1
+            return self._located(LiteralExpr(value == 'true'), start)
+
+        elif self._isOp('['):
+            # vectors consisting only of literals are literals themselves.
+            # otherwise, back off and let the caller parse a VectorExpr.
+            startPos = self.pos
+            self.pos += 1
+            items = []
+            if not self._isOp(']'):
+                while True:
+                    item = self.parseLiteral()
+                    if item is None or not (self._isOp(',') or self._isOp(']')):
+                        self.pos = startPos
+                        return None
+                    items.append(item)
+                    if self._isOp(']'):
+                        break
+                    self.pos += 1
+            self.pos += 1
+            vector = self._located(VectorExpr(items), start)
+            return self._located(LiteralExpr(vector), start)
+
+        return None
+
+
+def parseString(source):
+    return Parser(source).parseProgram()
+
+def parseFile(filename):
+    with open(filename, 'rb') as f:
+        return parseString(f.read())
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import ast_
+from runtime import UNSET
+
+
+# variable names are resolved statically, when a program is loaded, instead
+# of being looked up by name in a chain of scope dicts at run time. each
+# reference gets a binding:
+#
+# * names assigned in a func (including its params, loop variables, nested
+#   funcs and imports) are locals, kept in a slot of the func's frame - a
+#   plain list, created anew for each call.
+# * names of an enclosing func's locals are free variables. they also get a
+#   slot in the frame, holding a cell (a one-item list) shared with the
+#   enclosing frame, so a closure captures only the cells it uses.
+# * everything else, including all names at module level, is a global:
+#   looked up in the module's scope dict, then in the builtins.
+#
+# a local that is read before it's first assigned falls back to the global
+# of the same name, as when scopes were looked up dynamically.
+
+
+class GlobalBinding(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'global {0}'.format(self.name)
+
+    def get(self, ctx):
+        return ctx.getVar(self.name)
+
+    def set(self, ctx, value):
+        ctx.setVar(self.name, value)
+
+    def makeGetter(self):
+        name = self.name
+        return lambda ctx: ctx.getVar(name)
+
+    def makeSetter(self):
+        name = self.name
+        return lambda ctx, value: ctx.setVar(name, value)
+
+class LocalBinding(object):
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+
+    def __repr__(self):
+        return 'local {0}@{1}'.format(self.name, self.slot)
+
+    def get(self, ctx):
+        value = ctx.frame[self.slot]
+        if value is UNSET:
+            return ctx.getVar(self.name)
+        return value
+
+    def set(self, ctx, value):
+        ctx.frame[self.slot] = value
+
+    def makeGetter(self):
+        name = self.name
+        slot = self.slot
+
+        def get(ctx):
+            value = ctx.frame[slot]
+            if value is UNSET:
+                return ctx.getVar(name)
+            return value
+
+        return get
+
+    def makeSetter(self):
+        slot = self.slot
+
+        def set_(ctx, value):
+            ctx.frame[slot] = value
+
+        return set_
+
+class CellBinding(LocalBinding):
+    def __repr__(self):
+        return 'cell {0}@{1}'.format(self.name, self.slot)
+
+    def get(self, ctx):
+        value = ctx.frame[self.slot][0]
+        if value is UNSET:
+            return ctx.getVar(self.name)
+        return value
+
+    def set(self, ctx, value):
+        ctx.frame[self.slot][0] = value
+
+    def makeGetter(self):
+        name = self.name
+        slot = self.slot
+
+        def get(ctx):
+            value = ctx.frame[slot][0]
+            if value is UNSET:
+                return ctx.getVar(name)
+            return value
+
+        return get
+
+    def makeSetter(self):
+        slot = self.slot
+
+        def set_(ctx, value):
+            ctx.frame[slot][0] = value
+
+        return set_
+
+
+class FrameLayout(object):
+    """
+    Describes the frame of a func: how many slots it has, which of them hold
+    cells, and where its params and closure cells go.
+    """
+
+    def __init__(self, numSlots, paramSlots, cellSlots, closure):
+        self.numSlots = numSlots
+        self.paramSlots = paramSlots
+        self.cellSlots = frozenset(cellSlots)
+        # list of (slot, outerSlot) - the cell in slot outerSlot of the frame
+        # the func was defined in goes into slot
+        self.closure = closure
+
+    def __repr__(self):
+        return 'frame({0.numSlots}, cells={1}, closure={0.closure})'.format(
+            self, sorted(self.cellSlots))
+
+    def captureCells(self, ctx):
+        """
+        Return the cells a func captures, when it's defined in ctx.
+        """
+
+        return [(slot, ctx.frame[outerSlot])
+            for (slot, outerSlot) in self.closure]
+
+    def newFrame(self, capturedCells):
+        frame = [UNSET] * self.numSlots
+
+        for slot in self.cellSlots:
+            frame[slot] = [UNSET]
+
+        for slot, cell in capturedCells:
+            frame[slot] = cell
+
+        return frame
+
+    def getSlot(self, frame, slot):
+        if slot in self.cellSlots:
+            return frame[slot][0]
+        else:
+            return frame[slot]
+
+    def setSlot(self, frame, slot, value):
+        if slot in self.cellSlots:
+            frame[slot][0] = value
+        else:
+            frame[slot] = value
+
+
+class _Scope(object):
+    def __init__(self, parent, localNames):
+        # parent is None for the module scope
+        self.parent = parent
+        self.slots = dict((name, slot)
+            for (slot, name) in enumerate(localNames))
+        self.cellNames = set()
+        self.freeSlots = {}
+        self.closure = []
+
+        # (node, attrName, name) for each local reference, bound once we
+        # know which locals are cells
+        self.localRefs = []
+
+    @property
+    def isFunc(self):
+        return self.parent is not None
+
+    @property
+    def numSlots(self):
+        return len(self.slots) + len(self.freeSlots)
+
+    def _cellSlot(self, name):
+        """
+        Return the slot of this func's cell for name, a local of this func or
+        of an enclosing one, or None if name is a global.
+        """
+
+        if name in self.slots:
+            self.cellNames.add(name)
+            return self.slots[name]
+
+        if name in self.freeSlots:
+            return self.freeSlots[name]
+
+        if not self.parent.isFunc:
+            return None
+
+        outerSlot = self.parent._cellSlot(name)
+        if outerSlot is None:
+            return None
+
+        slot = self.numSlots
+        self.freeSlots[name] = slot
+        self.closure.append((slot, outerSlot))
+        return slot
+
+    def bind(self, node, attrName, name):
+        if not self.isFunc:
+            setattr(node, attrName, GlobalBinding(name))
+
+        elif name in self.slots:
+            self.localRefs.append((node, attrName, name))
+
+        else:
+            slot = self._cellSlot(name)
+            if slot is None:
+                setattr(node, attrName, GlobalBinding(name))
+            else:
+                setattr(node, attrName, CellBinding(name, slot))
+
+    def finish(self):
+        for node, attrName, name in self.localRefs:
+            slot = self.slots[name]
+            bindingClass = (CellBinding if name in self.cellNames
+                else LocalBinding)
+            setattr(node, attrName, bindingClass(name, slot))
+
+
+def children(node):
+    """
+    Yield the child nodes of node that run in the same scope as node itself.
+    Names that aren't variable references (named param names, method names,
+    assignment targets) are skipped.
+    """
+
+    if isinstance(node, ast_.BlockStmt):
+        for stmt in node.stmts:
+            yield stmt
+
+    elif isinstance(node, ast_.AssignStmt):
+        yield node.rvalue
+
+    elif isinstance(node, ast_.ExprStmt):
+        yield node.expr
+
+    elif isinstance(node, ast_.ReturnStmt):
+        yield node.expr
+
+    elif isinstance(node, ast_.IfStmt):
+        for cond, block in node.condsAndBlocks:
+            yield cond
+            yield block
+
+        if node.elseBlock is not None:
+            yield node.elseBlock
+
+    elif isinstance(node, ast_.ForStmt):
+        yield node.iterableExpr
+        yield node.block
+
+    elif isinstance(node, ast_.LiteralExpr):
+        if isinstance(node.value, ast_.Expr):
+            yield node.value
+
+    elif isinstance(node, ast_.SubscriptExpr):
+        yield node.arrayExpr
+        yield node.subscriptExpr
+
+    elif isinstance(node, ast_.FuncCallExpr):
+        for expr in node.posParams:
+            yield expr
+
+        for _, expr in node.namedParams:
+            yield expr
+
+        # blocks passed to funcs run in the caller's scope
+        if node.block is not None:
+            yield node.block
+
+    elif isinstance(node, ast_.VectorExpr):
+        for expr in node.exprs:
+            yield expr
+
+    elif isinstance(node, ast_.ComprehensionExpr):
+        yield node.iterableExpr
+        yield node.expr
+
+    elif isinstance(node, ast_.UnaryOpExpr):
+        yield node.expr
+
+    elif isinstance(node, ast_.BinaryOpExpr):
+        for expr in node.exprs:
+            yield expr
+
+    elif isinstance(node, ast_.MethodCallExpr):
+        yield node.expr
+        # the method name isn't a variable, only its params are
+        for child in children(node.funcCallExpr):
+            yield child
+
+    # FuncDefStmt bodies have a scope of their own, and ImportStmt and
+    # VarNameExpr have no children
+
+def assignedNames(node):
+    """
+    Yield the names assigned in node's scope, in order.
+    """
+
+    if isinstance(node, ast_.AssignStmt):
+        yield node.lvalue.name
+
+    elif isinstance(node, ast_.ForStmt):
+        yield node.lvalue
+
+    elif isinstance(node, ast_.ComprehensionExpr):
+        yield node.iterator
+
+    elif isinstance(node, ast_.FuncDefStmt):
+        yield node.funcName
+
+    elif isinstance(node, ast_.ImportStmt):
+        yield node.pkgPath[0]
+
+    for child in children(node):
+        for name in assignedNames(child):
+            yield name
+
+def _resolve(node, scope):
+    if isinstance(node, ast_.VarNameExpr):
+        scope.bind(node, 'binding', node.name)
+
+    elif isinstance(node, ast_.FuncCallExpr):
+        scope.bind(node, 'binding', node.funcName)
+
+    elif isinstance(node, ast_.AssignStmt):
+        scope.bind(node, 'binding', node.lvalue.name)
+
+    elif isinstance(node, ast_.ForStmt):
+        scope.bind(node, 'binding', node.lvalue)
+
+    elif isinstance(node, ast_.ComprehensionExpr):
+        scope.bind(node, 'binding', node.iterator)
+
+    elif isinstance(node, ast_.ImportStmt):
+        scope.bind(node, 'binding', node.pkgPath[0])
+
+    elif isinstance(node, ast_.FuncDefStmt):
+        scope.bind(node, 'binding', node.funcName)
+        _resolveFunc(node, scope)
+
+    for child in children(node):
+        _resolve(child, scope)
+
+def _resolveFunc(funcDef, parentScope):
+    paramNames = [name for (name, _) in funcDef.paramsList]
+
+    localNames = list(paramNames)
+    for name in assignedNames(funcDef.block):
+        if name not in localNames:
+            localNames.append(name)
+
+    scope = _Scope(parentScope, localNames)
+
+    # default values are evaluated in the func's scope
+    for _, default in funcDef.paramsList:
+        if default is not None:
+            _resolve(default, scope)
+
+    _resolve(funcDef.block, scope)
+    scope.finish()
+
+    funcDef.layout = FrameLayout(scope.numSlots,
+        [scope.slots[name] for name in paramNames],
+        [scope.slots[name] for name in scope.cellNames],
+        scope.closure)
+
+def resolve(program):
+    """
+    Bind every variable reference and assignment in program (a module) to its
+    variable. Modifies the tree in place, and returns it.
+    """
+
+    _resolve(program, _Scope(None, []))
+    return program
@@ -2,25 +2,83 @@
 
 from __future__ import print_function
 from itertools import count, chain
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, Counter, OrderedDict
 from functools import wraps, partial
 from math import *
 import copy
 import os
-import numpy as np
-import textimpl
 import operator
+import time
 import _ycad
+from lazyimport import LazyModule
+
+
+# these are slow to import, and many programs never need them
+np = LazyModule('numpy')
+textimpl = LazyModule('textimpl')
+# these import ast_, which imports this module
+memo = LazyModule('memo')
+geomcache = LazyModule('geomcache')
+scheduler = LazyModule('scheduler')
+meshwriter = LazyModule('meshwriter')
 
 
 OUTPUT_TOLERANCE = 0.05        # in mm
+OUTPUT_ANGULAR_TOLERANCE = 0.5  # in radians
 DEFAULT_INCLUDE_DIR = os.path.join(os.path.dirname(__file__), 'include')
 
+# counts of geometry operations run through _ycad ('kernel calls': primitives,
+# transforms, booleans, extrusions, meshing...), of the booleans among them,
+# and of booleans skipped because their operands' bounding boxes showed they
+# didn't interact. the profiler attributes these to statements and call
+# sites.
+stats = Counter()
+
+# seconds spent in phases of run() that ycad.py reports on their own
+phaseTimes = {}
+
+
+# value of a frame slot whose variable hasn't been assigned yet
+UNSET = object()
+
+# module-wide settings, set by ycad.py according to command-line options.
+# how Combination runs booleans with more than two operands:
+# * 'multi' passes all operands to a single general-fuse run.
+# * 'tree' fuses unions pairwise, in a balanced tree of operands grouped by
+#   position. differences are run like in 'multi'.
+# * 'chain' runs them one by one, left to right.
+# intersections are always chained, since each step only shrinks the result.
+BOOLEAN_MODES = ('multi', 'tree', 'chain')
+booleanMode = 'multi'
+# skip booleans whose operands' bounding boxes show they can't interact
+prefilterBooleans = True
+# build shapes only when they're needed, see Object3D. otherwise, they're
+# built as soon as they're created.
+lazyShapes = True
+# move and rotate shapes by giving them a location that refers to the
+# original geometry, rather than by copying it. scaled shapes are always
+# copied, since locations can't scale.
+shareGeometry = True
+# extrude twisted profiles with Shape.extrudeTwisted, which sweeps all their
+# wires with one auxiliary surface and closes holes without booleans.
+# otherwise, each wire is swept on its own, and holes are cut out of the
+# outer wire's sweep.
+fastTwist = True
+# how many glyph shapes text() keeps for reuse (see textimpl.TextShapeMaker)
+maxGlyphs = 1024
+# number of threads meshing shapes, for output and for bounding boxes
+meshThreads = 1
+
 
 class ReturnException(BaseException):
     def __init__(self, value=None):
         self.value = value
 
+class NotVectorizable(Exception):
+    # raised when trying to evaluate something for a whole array of items,
+    # that can only be evaluated for one item at a time. see bulkeval.py.
+    pass
+
 class Module(object):
     def __init__(self, scope):
         self.scope = scope
@@ -49,60 +107,96 @@ class Block(object):
 class Context:
     _BlockInfo = namedtuple('_BlockInfo', 'block helperValue')
 
-    def __init__(self, outputFilename, dbTitle='ycad database'):
-        self.scopeChains = [[builtins]]
+    def __init__(self, outputFilename, dbTitle='ycad database',
+            profiler=None, compileCode=True, numWorkers=1):
+
+        # scope dict of the module currently running, and the frame of the
+        # func currently running (a list of variable slots, see resolver.py),
+        # or None at module level
+        self.globals = None
+        self.frame = None
+
         self.blocks = []
 
         self.modules = {}
 
-        self.textShapeMaker = textimpl.TextShapeMaker()
+        # set while evaluating a comprehension in bulk, see bulkeval.py
+        self.bulk = False
+
+        # source file of the code currently running
+        self.srcPath = None
+        self.profiler = profiler
+
+        # run programs as compiled closures, rather than walking the AST
+        self.compileCode = compileCode
+
+        # results of memoizable func calls, or None if memoization is off.
+        # see memo.py.
+        self.funcMemo = (memo.FuncMemo(memo.maxEntries)
+            if memo.maxEntries > 0 else None)
+        # counts calls to builtins with side effects, so that calls that make
+        # them aren't memoized
+        self.sideEffects = 0
+
+        # with more than one worker, booleans run in a process pool. see
+        # scheduler.py.
+        self.scheduler = (scheduler.Scheduler(numWorkers)
+            if numWorkers > 1 else None)
+
+        self._textShapeMaker = None
 
     def execProgram(self, srcPath, parsedProgram, moduleObjName):
+        prevSrcPath = self.srcPath
+        prevGlobals = self.globals
+        prevFrame = self.frame
+        self.srcPath = srcPath
+        self.globals = {}
+        self.frame = None
+
         try:
-            self.pushScope()
             self.setVar('__path',
                 [os.path.dirname(srcPath), DEFAULT_INCLUDE_DIR])
 
+            if self.compileCode:
+                parsedProgram = parsedProgram.compiled()
+
             output = Combination.fromBlock(self, 'add',
                 block=Block(parsedProgram), name=moduleObjName)
 
-            scope = self.popScope()
-            return scope, output
+            return self.globals, output
 
         except ReturnException:
             raise RuntimeError("return from main scope!")
 
-    @property
-    def curScopeChain(self):
-        return self.scopeChains[-1]
-    
-    @property
-    def curScope(self):
-        return self.curScopeChain[-1]
+        finally:
+            self.srcPath = prevSrcPath
+            self.globals = prevGlobals
+            self.frame = prevFrame
 
-    def pushScope(self, scopeChain=None):
-        if scopeChain is None:
-            scopeChain = self.curScopeChain + [{}]
+    @property
+    def textShapeMaker(self):
+        # creating this loads cairo, so only do it once text() is used
+        if self._textShapeMaker is None:
+            self._textShapeMaker = textimpl.TextShapeMaker(maxGlyphs)
 
-        self.scopeChains.append(scopeChain)
+        return self._textShapeMaker
 
-    def popScope(self):
-        # pop current scope chain, and return the current scope
-        scope = self.curScope
-        self.scopeChains.pop()
-        return scope
+    # getVar() and setVar() access globals. other variables are accessed
+    # through the bindings set up by resolver.py.
 
     def getVar(self, name):
-        for scope in reversed(self.curScopeChain):
-            try:
-                return scope[name]
-            except LookupError:
-                continue
+        try:
+            return self.globals[name]
+        except KeyError:
+            pass
 
-        raise NameError("variable {0} not found".format(name))
+        try:
+            return builtins[name]
+        except KeyError:
+            raise NameError("variable {0} not found".format(name))
 
     def setVar(self, name, value):
-        self.curScope[name] = value
+        self.globals[name] = value
 
     @property
     def curBlockInfo(self):
@@ -135,35 +229,163 @@ def _autoname(basename):
     return '{0}.{1}'.format(basename, next(counter))
 
 class Object3D(object):
-    def __init__(self, shape=None, name=None, basename='obj'):
-        self.shape = shape
+    """
+    A shape, built lazily. Each object is a node in an expression graph: it
+    knows how to build its shape from its operands' shapes, and the kernel
+    is only called when the shape is actually needed - for output, or for a
+    bounding box that can't be worked out from how the object was built.
+    Objects that are never used are never built.
+
+    Transforms of objects that haven't been built yet are folded: the new
+    object refers to the untransformed one, with the combined transform, so
+    a chain of moves and rotations is a single kernel call.
+    """
+
+    def __init__(self, shape=None, name=None, basename='obj', key=None):
+        self._shape = shape
+        # a scheduler.Job building the shape in the background, or None
+        self._job = None
+        # if the shape hasn't been built yet, builds it. see _setBuild().
+        self._build = None
+        self._operands = ()
+        self._cached = False
+        # if this object transforms another one that hadn't been built yet,
+        # that object, and the transform
+        self._base = None
+        self._transform = None
         self._name = _autoname(basename) if name is None else name
         self._bbox = None
+        # bounding box worked out from how the object was built, without
+        # asking the kernel, or None if unknown. it may be larger than the
+        # shape (e.g. for a sub), but never smaller.
+        self._bounds = None
+        # hash of how the object was built, or None if unknown. see
+        # geomcache.py.
+        self.key = key
 
-    def applyTransform(self, transform):
-        if self.shape is None:
-            return
+    @property
+    def shape(self):
+        self._start()
+
+        if self._job is not None:
+            self._shape = self._job.result()
+            self._job = None
+
+        return self._shape
+
+    @shape.setter
+    def shape(self, shape):
+        self._shape = shape
+        self._job = None
+        self._build = None
+
+    @property
+    def hasShape(self):
+        # doesn't build the shape, or wait for it
+        return (self._shape is not None or self._job is not None
+            or self._build is not None)
+
+    def _setBuild(self, build, operands=(), cached=False):
+        """
+        Set the shape to be built by build(), once it's needed and the
+        shapes of operands (the Object3Ds it's built from) have been
+        started. build() returns the shape, or a scheduler.Job building it.
+
+        If cached, the shape is looked up in the geometry cache before
+        anything is built, and stored there once it's built.
+        """
+
+        self._build = build
+        self._operands = operands
+        self._cached = cached
+
+        if not lazyShapes:
+            self._start()
+
+    def _start(self):
+        """
+        Start building the shape, if it hasn't been started yet, after
+        starting the shapes it's built from. With a scheduler, booleans
+        become jobs, so that all the independent booleans this shape needs
+        run concurrently.
+        """
+
+        # graphs built up in loops can be very deep, so walk them with a
+        # stack rather than recursively. each object is pushed once to start
+        # its operands, then again to start it.
+        stack = [(self, False)]
+        while stack:
+            obj, operandsStarted = stack.pop()
+            if obj._build is None:
+                continue
+
+            if operandsStarted:
+                obj._startBuild()
+                continue
 
-        if isinstance(transform, _ycad.Transform):
-            self.shape.applyTransform(transform)
+            if obj._cached:
+                shape = geomcache.lookup(obj.key)
+                if shape is not None:
+                    # its operands aren't needed at all
+                    obj.shape = shape
+                    obj._operands = ()
+                    obj._base = obj._transform = None
+                    continue
+
+            stack.append((obj, True))
+            stack.extend((operand, False) for operand in obj._operands)
+
+    def _startBuild(self):
+        build, self._build = self._build, None
+        result = build()
+        self._operands = ()
+        self._base = self._transform = None
+
+        if result is None or isinstance(result, _ycad.Shape):
+            self._shape = result
+            if self._cached:
+                geomcache.store(self.key, result)
         else:
-            self.shape.applyGTransform(transform)
+            # a scheduler.Job, which stores its result in the cache itself
+            self._job = result
 
-    def withTransform(self, transform):
-        newObj = copy.copy(self)
+    def withTransform(self, transform, desc=None):
+        """
+        Return a transformed copy of this object. desc describes the
+        transform, for the new object's key.
+        """
 
-        if isinstance(transform, _ycad.Transform):
-            shape = self.shape.withTransform(transform)
+        newObj = copy.copy(self)
+        newObj.key = geomcache.makeKey(self.key, desc)
+        newObj._bbox = None
+        newObj._bounds = _transformBox(self._bounds, desc)
+        newObj._shape = newObj._job = newObj._build = None
+        newObj._operands = ()
+        newObj._base = newObj._transform = None
+
+        if not self.hasShape:
+            return newObj
+
+        if self._base is not None and self._build is not None:
+            # fold the transforms, so that the untransformed shape is
+            # transformed once
+            stats['transforms folded'] += 1
+            base = self._base
+            transform = _ycad.composeTransforms(self._transform, transform)
         else:
-            shape = self.shape.withGTransform(transform)
+            base = self
 
-        newObj.shape = shape
-        return newObj
+        def build():
+            if base._job is not None and not base._job.done:
+                # transform it once it's built, without waiting for it
+                return base._job.scheduler.transform(base._job, transform)
 
-    def _moveApply(self, vec):
-        transform = _ycad.Transform()
-        transform.setTranslation(vec)
-        self.applyTransform(transform)
+            return transformShape(base.shape, transform)
+
+        newObj._base = base
+        newObj._transform = transform
+        newObj._setBuild(build, [base])
+        return newObj
 
     def move(self, ctx, vec=None, x=0, y=0, z=0):
         if vec is None:
@@ -173,7 +395,7 @@ class Object3D(object):
 
         transform = _ycad.Transform()
         transform.setTranslation(vec)
-        return self.withTransform(transform)
+        return self.withTransform(transform, ('move', vec))
 
     def scale(self, ctx, size=None, x=1, y=1, z=1):
         if size is not None:
@@ -187,7 +409,7 @@ class Object3D(object):
 
         transform = _ycad.GenTransform()
         transform.setScale(x, y, z)
-        return self.withTransform(transform)
+        return self.withTransform(transform, ('scale', x, y, z))
 
     def rotate(self, ctx, angle=None, axis=None, x=None, y=None, z=None):
         # TODO: support 2d version
@@ -206,7 +428,7 @@ class Object3D(object):
 
         transform = _ycad.Transform()
         transform.setRotation(axis, radians(angle))
-        return self.withTransform(transform)
+        return self.withTransform(transform, ('rotate', axis, angle))
 
     def extrude(self, ctx, *args, **kwargs):
         return LinearExtrusion(ctx, self, *args, **kwargs)
@@ -215,12 +437,19 @@ class Object3D(object):
         return Revolution(ctx, self, *args, **kwargs)
 
     def _tesselate(self, tolerance):
-        self.shape.tesselate(tolerance)
+        stats['kernel calls'] += 1
+        self.shape.tesselate(tolerance, OUTPUT_ANGULAR_TOLERANCE,
+            meshThreads > 1)
 
     @property
     def bbox(self):
+        if self._bounds is not None:
+            return self._bounds
+
+        # no way around meshing it
         if self._bbox is None:
             self._tesselate(OUTPUT_TOLERANCE)
+            stats['kernel calls'] += 1
             self._bbox = self.shape.getBoundingBox()
 
         return self._bbox
@@ -257,17 +486,27 @@ class Object3D(object):
 
 class Cube(Object3D):
     def __init__(self, ctx, s, center=False):
-        Object3D.__init__(self, basename='cube')
+        Object3D.__init__(self, basename='cube',
+            key=geomcache.makeKey('cube', s, center))
 
         if isinstance(s, float):
             x = y = z = s
         else:
             x, y, z = s
 
-        self.shape = _ycad.box(x, y, z)
+        def build():
+            stats['kernel calls'] += 1
+            shape = _ycad.box(x, y, z)
+            if center:
+                _moveShape(shape, [-x / 2., -y / 2., -z / 2.])
+            return shape
+
+        self._setBuild(build)
+        self._bounds = _boxFromPoints([(0, 0, 0), (x, y, z)])
 
         if center:
-            self._moveApply([-x / 2., -y / 2., -z / 2.])
+            self._bounds = _translateBox(self._bounds,
+                [-x / 2., -y / 2., -z / 2.])
 
 class Cylinder(Object3D):
     def __init__(self, ctx, h, d=None, d1=None, d2=None, r=None,
@@ -286,12 +525,32 @@ class Cylinder(Object3D):
         assert (d is not None) ^ (d1 is not None and d2 is not None)
 
         if d is not None:
-            self.shape = _ycad.cylinder(d/2., h)
+            self.key = geomcache.makeKey('cylinder', h, d, center)
+        else:
+            self.key = geomcache.makeKey('cone', h, d1, d2, center)
+
+        def build():
+            stats['kernel calls'] += 1
+            if d is not None:
+                shape = _ycad.cylinder(d/2., h)
+            else:
+                shape = _ycad.cone(d1/2., d2/2., h)
+
+            if center:
+                _moveShape(shape, [0, 0, -h / 2.])
+            return shape
+
+        self._setBuild(build)
+
+        if d is not None:
+            r = d / 2.
         else:
-            self.shape = _ycad.cone(d1/2., d2/2., h)
+            r = max(d1, d2) / 2.
+
+        self._bounds = _boxFromPoints([(-r, -r, 0), (r, r, h)])
 
         if center:
-            self._moveApply([0, 0, -h / 2.])
+            self._bounds = _translateBox(self._bounds, [0, 0, -h / 2.])
 
 class Sphere(Object3D):
     def __init__(self, ctx, r=None, d=None):
@@ -302,7 +561,14 @@ class Sphere(Object3D):
 
         assert isinstance(r, float)
 
-        self.shape = _ycad.sphere(r)
+        self.key = geomcache.makeKey('sphere', r)
+
+        def build():
+            stats['kernel calls'] += 1
+            return _ycad.sphere(r)
+
+        self._setBuild(build)
+        self._bounds = _boxFromPoints([(-r, -r, -r), (r, r, r)])
 
 class Polyhedron(Object3D):
     def __init__(self, ctx, points, triangles):
@@ -312,6 +578,8 @@ class Polyhedron(Object3D):
 
 class Torus(Object3D):
     def __init__(self, ctx, r1=None, r2=None, angle=None, d1=None, d2=None):
+        Object3D.__init__(self, basename='torus')
+
         if d1 is not None:
             r1 = d1 / 2.
 
@@ -331,7 +599,19 @@ class Torus(Object3D):
         #if angle1 is not None:
         #    args += [radians(angle1), radians(angle2)]
 
-        self.shape = _ycad.torus(*args)
+        self.key = geomcache.makeKey('torus', *args)
+
+        def build():
+            stats['kernel calls'] += 1
+            return _ycad.torus(*args)
+
+        self._setBuild(build)
+
+        if angle is None:
+            # around the z axis. r2 is the outer radius, and the tube's
+            # radius is r2 - r1.
+            self._bounds = _boxFromPoints(
+                [(-r2, -r2, r1 - r2), (r2, r2, r2 - r1)])
 
 class Combination(Object3D):
     def __init__(self, ctx, op, objs, name=None):
@@ -339,15 +619,46 @@ class Combination(Object3D):
         self.op = op
         self.objs = objs
 
-        if self.objs:
-            shapes = [obj.shape for obj in objs if obj.shape is not None]
-            self.shape = self.makeShape(op, shapes)
+        objsWithShapes = [obj for obj in objs if obj.hasShape]
+        if not objsWithShapes:
+            return
+
+        self.key = geomcache.makeKey(op,
+            *[obj.key for obj in objsWithShapes])
+
+        boxes = [obj._bounds for obj in objsWithShapes]
+        if op == 'add':
+            self._bounds = reduce(_boxUnion, boxes)
+        elif op == 'sub':
+            # tools can only remove material
+            self._bounds = boxes[0]
         else:
-            self.shape = None
+            knownBoxes = [box for box in boxes if box is not None]
+            if knownBoxes:
+                # empty if the boxes don't overlap. let the kernel say so.
+                self._bounds = reduce(_boxIntersection, knownBoxes)
+
+        key = self.key
+
+        def build():
+            if ctx.scheduler is not None and len(objsWithShapes) > 1:
+                # pass along the jobs of operands that are still being
+                # built, rather than waiting for them
+                return ctx.scheduler.boolean(op,
+                    [obj._job or obj._shape for obj in objsWithShapes],
+                    boxes, key=key)
+
+            return self.makeShape(op,
+                [obj.shape for obj in objsWithShapes], boxes)
+
+        self._setBuild(build, objsWithShapes, cached=True)
 
     @staticmethod
-    def makeShape(op, shapes):
-        opFunc = getattr(operator, op)
+    def makeShape(op, shapes, boxes=None):
+        """
+        Apply op to shapes. boxes are the shapes' bounding boxes, or None
+        for those that aren't known, if any are.
+        """
 
         # # BRepAlgoAPI seems not to like handling compounds containing
         # # solids so we convert them to single solids. (docs say that
@@ -367,7 +678,116 @@ class Combination(Object3D):
         #     return shape
 
         # fixedShapes = [fixCompounds(shape) for shape in shapes]
-        return reduce(opFunc, shapes)
+
+        if len(shapes) < 2 or not prefilterBooleans:
+            return Combination._runBoolean(op, shapes)
+
+        # operands whose boxes don't overlap can't interact, so some (or
+        # all) of the booleans can be skipped
+        if boxes is None:
+            boxes = [None] * len(shapes)
+        boxes = [_shapeBox(shape) if box is None else box
+            for (shape, box) in zip(shapes, boxes)]
+
+        if op == 'sub':
+            tools = [i for i in xrange(1, len(shapes))
+                if _boxesIntersect(boxes[0], boxes[i])]
+            stats['booleans skipped'] += len(shapes) - 1 - len(tools)
+            indices = [0] + tools
+
+        elif op == 'mul':
+            if reduce(_boxIntersection, boxes) is None:
+                stats['booleans skipped'] += len(shapes) - 1
+                stats['kernel calls'] += 1
+                return _ycad.compound([])
+
+            indices = range(len(shapes))
+
+        else:
+            groups = _overlappingGroups(boxes)
+            if len(groups) > 1:
+                # each group is fused separately, and the disjoint results
+                # are simply put together
+                stats['booleans skipped'] += len(groups) - 1
+                stats['kernel calls'] += 1
+                return _ycad.compound(
+                    Combination._runBoolean(op,
+                        [shapes[i] for i in group], [boxes[i] for i in group])
+                    for group in groups)
+
+            indices = range(len(shapes))
+
+        return Combination._runBoolean(op,
+            [shapes[i] for i in indices], [boxes[i] for i in indices])
+
+    @staticmethod
+    def _runBoolean(op, shapes, boxes=None):
+        """
+        Apply op to shapes, according to booleanMode. boxes are the shapes'
+        bounding boxes, if they're known.
+        """
+
+        opFunc = getattr(operator, op)
+
+        if len(shapes) < 3 or op == 'mul' or booleanMode == 'chain':
+            stats['kernel calls'] += len(shapes) - 1
+            stats['booleans'] += len(shapes) - 1
+            return reduce(opFunc, shapes)
+
+        if op == 'add' and booleanMode == 'tree':
+            return Combination._fuseTree(shapes, boxes)
+
+        stats['kernel calls'] += 1
+        stats['booleans'] += 1
+        return _ycad.boolean(op, shapes[:1], shapes[1:])
+
+    @staticmethod
+    def _fuseTree(shapes, boxes=None):
+        """
+        Fuse shapes pairwise, in a balanced tree. Shapes are ordered so that
+        nearby ones are fused first, which keeps intermediate results small.
+        """
+
+        if boxes is None:
+            boxes = [_shapeBox(shape) for shape in shapes]
+
+        centers = []
+        for box in boxes:
+            if box is None:
+                # empty
+                centers.append((0., 0., 0.))
+                continue
+
+            (x0, y0, z0), (x1, y1, z1) = box
+            centers.append(((x0 + x1) / 2., (y0 + y1) / 2., (z0 + z1) / 2.))
+
+        def order(indices):
+            # split at the median along the axis the centers are most spread
+            # out on, like a k-d tree
+            if len(indices) <= 2:
+                return indices
+
+            axis = max(xrange(3), key=lambda i:
+                max(centers[idx][i] for idx in indices)
+                - min(centers[idx][i] for idx in indices))
+            indices = sorted(indices, key=lambda idx: centers[idx][axis])
+            half = len(indices) // 2
+            return order(indices[:half]) + order(indices[half:])
+
+        level = [shapes[idx] for idx in order(range(len(shapes)))]
+        while len(level) > 1:
+            nextLevel = []
+            for i in xrange(0, len(level) - 1, 2):
+                stats['kernel calls'] += 1
+                stats['booleans'] += 1
+                nextLevel.append(level[i] + level[i + 1])
+
+            if len(level) % 2:
+                nextLevel.append(level[-1])
+
+            level = nextLevel
+
+        return level[0]
 
     @staticmethod
     def fromBlock(ctx, op, block, **kwargs):
@@ -398,14 +818,179 @@ class Combination(Object3D):
             return _ycad.TopAbs_FACE
 
 
+def transformShape(shape, transform):
+    """
+    Return a transformed copy of shape. transform is a _ycad.Transform or
+    GenTransform.
+    """
+
+    stats['kernel calls'] += 1
+    if isinstance(transform, _ycad.GenTransform):
+        return shape.withGTransform(transform)
+    elif shareGeometry:
+        return shape.withLocation(transform)
+    else:
+        return shape.withTransform(transform)
+
+def _moveShape(shape, vec):
+    """
+    Move shape by vec, in place, and return it.
+    """
+
+    transform = _ycad.Transform()
+    transform.setTranslation(vec)
+    stats['kernel calls'] += 1
+    shape.applyTransform(transform)
+    return shape
+
+def _shapeBox(shape):
+    """
+    Return a bounding box that's sure to contain shape, or None if it's
+    empty.
+    """
+
+    stats['kernel calls'] += 1
+    return shape.getBoundingBox(enlarged=True)
+
+# boxes within this distance of each other count as touching, to allow for
+# rounding errors in boxes worked out from transforms
+BOX_TOLERANCE = 1e-6
+
+def _boxFromPoints(points):
+    xs, ys, zs = zip(*points)
+    return (min(xs), min(ys), min(zs)), (max(xs), max(ys), max(zs))
+
+def _boxCorners(box):
+    (x0, y0, z0), (x1, y1, z1) = box
+    return [(x, y, z) for x in (x0, x1) for y in (y0, y1) for z in (z0, z1)]
+
+def _translateBox(box, vec):
+    (x0, y0, z0), (x1, y1, z1) = box
+    dx, dy, dz = vec
+    return (x0 + dx, y0 + dy, z0 + dz), (x1 + dx, y1 + dy, z1 + dz)
+
+def _transformBox(box, desc):
+    """
+    Return the bounding box of box transformed by desc, as passed to
+    Object3D.withTransform(). Returns None if it can't be worked out
+    exactly.
+    """
+
+    if box is None or desc is None:
+        return None
+
+    kind = desc[0]
+    if kind == 'move':
+        return _translateBox(box, desc[1])
+
+    elif kind == 'scale':
+        _, sx, sy, sz = desc
+        return _boxFromPoints([(x * sx, y * sy, z * sz)
+            for (x, y, z) in _boxCorners(box)])
+
+    elif kind == 'rotate':
+        # the box of a rotated box is bigger than the rotated shape's box,
+        # except for quarter turns around the main axes
+        _, axis, angle = desc
+        if angle % 90 != 0:
+            return None
+
+        ax, ay, az = axis
+        norm = sqrt(ax * ax + ay * ay + az * az)
+        if sorted(abs(a) for a in (ax, ay, az)) != [0, 0, norm]:
+            return None
+
+        # exact cos and sin
+        c = int(round(cos(radians(angle))))
+        s = int(round(sin(radians(angle))))
+        if ax:
+            s = s if ax > 0 else -s
+            rot = lambda x, y, z: (x, c * y - s * z, s * y + c * z)
+        elif ay:
+            s = s if ay > 0 else -s
+            rot = lambda x, y, z: (c * x + s * z, y, -s * x + c * z)
+        else:
+            s = s if az > 0 else -s
+            rot = lambda x, y, z: (c * x - s * y, s * x + c * y, z)
+
+        return _boxFromPoints([rot(*corner) for corner in _boxCorners(box)])
+
+    return None
+
+def _boxUnion(a, b):
+    """
+    Return the box containing boxes a and b, or None if either is unknown.
+    """
+
+    if a is None or b is None:
+        return None
+
+    (amin, amax), (bmin, bmax) = a, b
+    return (tuple(min(a0, b0) for (a0, b0) in zip(amin, bmin)),
+        tuple(max(a1, b1) for (a1, b1) in zip(amax, bmax)))
+
+def _boxesIntersect(a, b):
+    # touching boxes count as intersecting, since their shapes might share
+    # faces
+    return _boxIntersection(a, b) is not None
+
+def _boxIntersection(a, b):
+    """
+    Return the intersection of boxes a and b, or None if it's empty. None
+    stands for an empty box.
+    """
+
+    if a is None or b is None:
+        return None
+
+    (amin, amax), (bmin, bmax) = a, b
+    lo = tuple(max(a0, b0) for (a0, b0) in zip(amin, bmin))
+    hi = tuple(min(a1, b1) for (a1, b1) in zip(amax, bmax))
+    if any(l > h + BOX_TOLERANCE for (l, h) in zip(lo, hi)):
+        return None
+
+    return lo, hi
+
+def _overlappingGroups(boxes):
+    """
+    Group the indices of boxes into connected groups of overlapping boxes.
+    """
+
+    # union-find over a sweep along x: each box only needs to be compared
+    # with the boxes whose x range is still open
+    parents = range(len(boxes))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    order = sorted((i for i in xrange(len(boxes)) if boxes[i] is not None),
+        key=lambda i: boxes[i][0][0])
+    active = []
+    for i in order:
+        xmin = boxes[i][0][0]
+        active = [j for j in active
+            if boxes[j][1][0] + BOX_TOLERANCE >= xmin]
+        for j in active:
+            if _boxesIntersect(boxes[i], boxes[j]):
+                parents[find(j)] = find(i)
+        active.append(i)
+
+    groups = OrderedDict()
+    for i in xrange(len(boxes)):
+        groups.setdefault(find(i), []).append(i)
+    return groups.values()
+
 def regPoly(ctx, sides, r):
     assert sides == int(sides)
     sides = int(sides)
 
     # angle to each of the vertices around the center
-    angles = [i*2*pi/sides for i in xrange(sides)]
+    angles = np.arange(sides) * (2 * pi / sides)
 
-    points = [[cos(a) * r, sin(a) * r] for a in angles]
+    points = np.column_stack([np.cos(angles) * r, np.sin(angles) * r])
 
     return Polygon(ctx, points)
 
@@ -421,28 +1006,44 @@ class Circle(Object3D):
         if d is not None:
             r = d / 2.
 
-        self.shape = _ycad.circle(r)
+        self.key = geomcache.makeKey('circle', r)
+
+        def build():
+            stats['kernel calls'] += 1
+            return _ycad.circle(r)
+
+        self._setBuild(build)
+        self._bounds = _boxFromPoints([(-r, -r, 0), (r, r, 0)])
 
 class Polygon(Object3D):
     def __init__(self, ctx, points, paths=None):
         Object3D.__init__(self)
 
-        if paths is None:
-            paths = [range(len(points)) + [0]]
-        else:
-            # close loops and convert floats to ints
-            paths = [map(int, p + [p[0]]) for p in paths]
+        self.key = geomcache.makeKey('polygon', points, paths)
 
-        def pathPoints(path):
-            return [points[pidx] for pidx in path]
+        # _ycad.polygon reads these in place, so points that are already a
+        # float array (e.g. from a comprehension) aren't even copied
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if paths is not None:
+            # also converts floats to ints
+            paths = [np.ascontiguousarray(path, dtype=np.intp)
+                for path in paths]
 
-        def makeWireFromPath(path):
-            return _ycad.wire(
-                _ycad.segment((x1, y1, 0), (x2, y2, 0))
-                for ((x1, y1), (x2, y2))
-                in zip(pathPoints(path), pathPoints(path[1:])))
+        def build():
+            stats['kernel calls'] += 1
+            return _ycad.polygon(points, paths)
 
-        self.shape = _ycad.face(makeWireFromPath(path) for path in paths)
+        self._setBuild(build)
+
+        if paths is not None:
+            usedPoints = points[np.unique(np.concatenate(paths))]
+        else:
+            usedPoints = points
+
+        lo = usedPoints.min(axis=0).tolist()
+        hi = usedPoints.max(axis=0).tolist()
+        self._bounds = (tuple(lo + [0] * (3 - len(lo))),
+            tuple(hi + [0] * (3 - len(hi))))
 
 
 class Square(Polygon):
@@ -466,27 +1067,57 @@ class Text(Object3D):
     def __init__(self, ctx, string, fontName="Sans", fontSize=12,
             bold=False, italic=False):
 
-        Object3D.__init__(self)
+        Object3D.__init__(self, key=geomcache.makeKey('text', string,
+            fontName, fontSize, bold, italic))
 
-        self.shape = ctx.textShapeMaker.make(string,
-            fontName, fontSize, bold=bold, italic=italic)
+        def build():
+            stats['kernel calls'] += 1
+            return ctx.textShapeMaker.make(string,
+                fontName, fontSize, bold=bold, italic=italic)
+
+        self._setBuild(build, cached=True)
 
 class LinearExtrusion(Object3D):
     def __init__(self, ctx, obj, h, twist=0, center=False):
-        Object3D.__init__(self)
-
+        # the two twisted extrusion engines build different shapes, so they
+        # can't share cache entries
         if twist == 0:
-            self.shape = obj.shape.extrudeStraight(h)
+            key = geomcache.makeKey('extrude', obj.key, h, twist, center)
         else:
-            self._makeTwisted(obj.shape, h, twist)
+            engine = 'fast' if fastTwist else 'wires'
+            key = geomcache.makeKey('extrude', obj.key, h, twist, center,
+                engine)
+        Object3D.__init__(self, key=key)
+
+        def build():
+            if twist == 0:
+                stats['kernel calls'] += 1
+                shape = obj.shape.extrudeStraight(h)
+            elif fastTwist:
+                stats['kernel calls'] += 1
+                shape = obj.shape.extrudeTwisted(h, radians(twist),
+                    OUTPUT_TOLERANCE)
+            else:
+                shape = self._makeTwisted(obj.shape, h, twist)
 
-        if center:
-            self._moveApply([0, 0, -h / 2.])
+            if center:
+                _moveShape(shape, [0, 0, -h / 2.])
+
+            return shape
+
+        self._setBuild(build, [obj], cached=True)
+
+        if twist == 0 and obj._bounds is not None:
+            corners = _boxCorners(obj._bounds)
+            zOffset = -h / 2. if center else 0
+            self._bounds = _boxFromPoints(
+                [(x, y, z + zOffset) for (x, y, z) in corners]
+                + [(x, y, z + h + zOffset) for (x, y, z) in corners])
 
     def _makeTwisted(self, baseShape, height, twist):
         faces = baseShape.descendants(_ycad.TopAbs_FACE)
 
-        self.shape = _ycad.compound(
+        return _ycad.compound(
             self._twistFace(face, height, twist)
             for face in faces)
 
@@ -531,14 +1162,27 @@ class LinearExtrusion(Object3D):
         auxSurf = _ycad.BezierSurface(auxSurfPts)
         auxFace = auxSurf.makeFace(0, 1, 0, 1)
         spine = auxSurf.makeEdgeOnSurface((0, 0), (0, 1))
+        stats['kernel calls'] += 1
         return profile.extrudeAlongSurface(spine, auxFace,
             tolerance=OUTPUT_TOLERANCE)
 
 class Revolution(Object3D):
     def __init__(self, ctx, obj, angle=360):
-        Object3D.__init__(self)
+        Object3D.__init__(self,
+            key=geomcache.makeKey('revolve', obj.key, angle))
+
+        def build():
+            stats['kernel calls'] += 1
+            return obj.shape.revolve(radians(angle))
+
+        self._setBuild(build, [obj], cached=True)
 
-        self.shape = obj.shape.revolve(radians(angle))
+        if angle % 360 == 0 and obj._bounds is not None:
+            # around the y axis, so x and z sweep a full circle
+            corners = _boxCorners(obj._bounds)
+            r = max(hypot(x, z) for (x, _, z) in corners)
+            (_, y0, _), (_, y1, _) = obj._bounds
+            self._bounds = ((-r, y0, -r), (r, y1, r))
 
 def extrude(ctx, *args, **kwargs):
     block = kwargs.pop('block')
@@ -558,55 +1202,91 @@ def wrapPythonFunc(func):
 
     return wrapper
 
-_print = wrapPythonFunc(print)
-_range = wrapPythonFunc(np.arange)
-_range.func_name = 'range'
+def broadcasting(name, scalarFunc, arrayFunc):
+    """
+    Make a builtin that applies scalarFunc to a number, or arrayFunc to all
+    elements of a vector or array at once. Vectors give vectors, and arrays
+    give arrays.
+    """
 
-# OpenSCAD equivalent functions:
+    def builtin(ctx, n):
+        if isinstance(n, (float, int, long)):
+            return scalarFunc(n)
 
-def _cos(ctx, n):
-    return cos(radians(n))
+        result = arrayFunc(np.asanyarray(n))
+        return result if isinstance(n, np.ndarray) else result.tolist()
 
-def _sin(ctx, n):
-    return sin(radians(n))
+    builtin.func_name = name
+    builtin.broadcasts = True
+    return builtin
 
-def _tan(ctx, n):
-    return tan(radians(n))
+def _print(ctx, *args, **kwargs):
+    ctx.sideEffects += 1
+    print(*args, **kwargs)
 
-def _acos(ctx, n):
-    return degrees(acos(n))
+def _range(ctx, *args, **kwargs):
+    return np.arange(*args, **kwargs)
 
-def _asin(ctx, n):
-    return degrees(asin(n))
+# OpenSCAD equivalent functions:
 
-def _atan(ctx, n):
-    return degrees(atan(n))
+_cos = broadcasting('cos',
+    lambda n: cos(radians(n)), lambda n: np.cos(np.radians(n)))
+_sin = broadcasting('sin',
+    lambda n: sin(radians(n)), lambda n: np.sin(np.radians(n)))
+_tan = broadcasting('tan',
+    lambda n: tan(radians(n)), lambda n: np.tan(np.radians(n)))
+_acos = broadcasting('acos',
+    lambda n: degrees(acos(n)), lambda n: np.degrees(np.arccos(n)))
+_asin = broadcasting('asin',
+    lambda n: degrees(asin(n)), lambda n: np.degrees(np.arcsin(n)))
+_atan = broadcasting('atan',
+    lambda n: degrees(atan(n)), lambda n: np.degrees(np.arctan(n)))
 
 def _atan2(ctx, x, y):
-    return degrees(atan2(x, y))
+    if isinstance(x, (float, int, long)) and isinstance(y, (float, int, long)):
+        return degrees(atan2(x, y))
+
+    result = np.degrees(np.arctan2(x, y))
+    if isinstance(x, np.ndarray) or isinstance(y, np.ndarray):
+        return result
+    return result.tolist()
 
-_abs = wrapPythonFunc(abs)
-_ceil = wrapPythonFunc(ceil)
-_exp = wrapPythonFunc(exp)
-_floor = wrapPythonFunc(floor)
-_ln = wrapPythonFunc(log)
+_atan2.broadcasts = True
+
+_abs = broadcasting('abs', abs, lambda n: np.abs(n))
+_ceil = broadcasting('ceil', ceil, lambda n: np.ceil(n))
+_exp = broadcasting('exp', exp, lambda n: np.exp(n))
+_floor = broadcasting('floor', floor, lambda n: np.floor(n))
+_ln = broadcasting('ln', log, lambda n: np.log(n))
 _len = wrapPythonFunc(len)
-_log = wrapPythonFunc(log10)
+_log = broadcasting('log', log10, lambda n: np.log10(n))
 _max = wrapPythonFunc(max)
 _min = wrapPythonFunc(min)
-_norm = wrapPythonFunc(np.linalg.norm)
+
+def _norm(ctx, *args, **kwargs):
+    return np.linalg.norm(*args, **kwargs)
+
 _pow = wrapPythonFunc(pow)
 _round = wrapPythonFunc(round)
 
-def _sign(ctx, n):
-    return 0 if n == 0 else copysign(1, n)
+_sign = broadcasting('sign',
+    lambda n: 0 if n == 0 else copysign(1, n), lambda n: np.sign(n))
+_sqrt = broadcasting('sqrt', sqrt, lambda n: np.sqrt(n))
 
-_sqrt = wrapPythonFunc(sqrt)
+def _flatten(ctx, vectors):
+    """Concatenate a vector of vectors."""
+    return list(chain.from_iterable(vectors))
 
 # Missing OpenSCAD functions: lookup, rands, str, search, import (for dxf)
 
 def _read(ctx, path):
-    return Object3D(_ycad.readSTL(path))
+    def build():
+        stats['kernel calls'] += 1
+        return _ycad.readSTL(path)
+
+    obj = Object3D(key=geomcache.fileKey(path))
+    obj._setBuild(build)
+    return obj
 
 
 def makeTransformFunc(transformName):
@@ -640,7 +1320,7 @@ builtins = dict((f.func_name.lstrip('_'), f)
 
         _cos, _sin, _tan, _acos, _asin, _atan, _atan2,
         _abs, _ceil, _exp, _floor, _ln, _len, _log, _max, _min, _norm,
-        _pow, _round, _sign, _sqrt,
+        _pow, _round, _sign, _sqrt, _flatten,
 
         move, scale, rotate, extrude, revolve])
 builtins.update(_builtinClasses)
@@ -652,13 +1332,53 @@ builtins['pi'] = pi
 builtins['e'] = e
 
 
-def run(srcPath, parsedProgram, outputFilename):
-    ctx = Context(outputFilename)
-    _, obj = ctx.execProgram(srcPath, parsedProgram, moduleObjName='main')
-    
-    if obj.shape is None:
-        with open(outputFilename, 'wb'):
-            # create an empty file
-            pass
-    else:
-        _ycad.writeSTL(obj.shape, outputFilename, OUTPUT_TOLERANCE)
+def run(srcPath, parsedProgram, outputFilename, profiler=None,
+        compileCode=True, numWorkers=1):
+    ctx = Context(outputFilename, profiler=profiler, compileCode=compileCode,
+        numWorkers=numWorkers)
+
+    try:
+        _, obj = ctx.execProgram(srcPath, parsedProgram, moduleObjName='main')
+
+        if obj.shape is None:
+            with open(outputFilename, 'wb'):
+                # create an empty file
+                pass
+        elif meshwriter.isIndexedFormat(outputFilename):
+            startTime = time.time()
+            counts = meshwriter.write(obj.shape, outputFilename,
+                OUTPUT_TOLERANCE, OUTPUT_ANGULAR_TOLERANCE, meshThreads > 1)
+            phaseTimes['output'] = time.time() - startTime
+            stats['kernel calls'] += 1 + counts['faces']
+            stats['vertices written'] += counts['vertices']
+            stats['triangles written'] += counts['triangles']
+        else:
+            startTime = time.time()
+            counts = _ycad.writeSTL(obj.shape, outputFilename,
+                OUTPUT_TOLERANCE, OUTPUT_ANGULAR_TOLERANCE, meshThreads)
+            phaseTimes['output'] = time.time() - startTime
+            stats['kernel calls'] += 1
+            stats['parts meshed'] += counts['parts']
+            stats['part placements'] += counts['placements']
+            stats['triangles meshed'] += counts['uniqueTriangles']
+            stats['triangles written'] += counts['triangles']
+
+    finally:
+        if ctx.scheduler is not None:
+            ctx.scheduler.close()
+
+def statsReport():
+    report = ('Booleans: {0} run, {1} skipped by bounding box. '
+        'Transforms: {2} folded\n'.format(stats['booleans'],
+            stats['booleans skipped'], stats['transforms folded']))
+
+    if stats['vertices written']:
+        # indexed formats
+        return report + ('Output: {0} triangles, {1} welded vertices '
+            'written'.format(stats['triangles written'],
+                stats['vertices written']))
+
+    return report + ('Output: {0} triangles written, {1} meshed ({2} '
+        'distinct parts in {3} placements)'.format(
+            stats['triangles written'], stats['triangles meshed'],
+            stats['parts meshed'], stats['part placements']))
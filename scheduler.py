@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+from collections import Counter
+import multiprocessing
+import Queue
+import traceback
+import _ycad
+import geomcache
+import runtime
+
+
+# runs booleans in a pool of worker processes. when a Context has a
+# scheduler, Combinations are built by jobs rather than on the spot: once a
+# shape is needed, jobs for all the booleans it depends on are started
+# together (see Object3D._start()), and it's only waited for at the end. jobs
+# form a DAG: a job starts as soon as the jobs building its operands are
+# done, so independent subtrees of the CSG tree (e.g. unrelated parts in an
+# add {}) are built concurrently. with runtime.lazyShapes off, jobs are
+# started as objects are created, while the program keeps running.
+#
+# shapes are passed to and from workers in OCC's binary BRep format.
+# transforms of shapes that are still being built are jobs too, but they're
+# cheap, so they run in this process.
+#
+# if a worker dies (e.g. killed for running out of memory), the pool replaces
+# it, but the boolean it was running never finishes. so once any worker
+# dies, the pool is shut down, and its unfinished booleans and all later ones
+# are built in this process instead.
+
+stats = Counter()
+
+
+def _runBoolean(op, operandsData, boxes=None):
+    """
+    Run in a worker process. Returns (ok, result BRep or traceback, changes
+    to runtime.stats).
+    """
+
+    try:
+        statsBefore = Counter(runtime.stats)
+        shapes = [_ycad.shapeFromBRep(data) for data in operandsData]
+        result = runtime.Combination.makeShape(op, shapes, boxes)
+        statsDelta = Counter(runtime.stats)
+        statsDelta.subtract(statsBefore)
+        return True, _ycad.shapeToBRep(result), dict(statsDelta)
+
+    except Exception:
+        # exceptions aren't always picklable, so send the traceback instead
+        return False, traceback.format_exc(), None
+
+
+class Job(object):
+    """
+    Builds one shape from inputs, which are Shapes or other Jobs.
+    """
+
+    def __init__(self, scheduler, inputs, op=None, localFunc=None, key=None,
+            boxes=None):
+        self.scheduler = scheduler
+        self.inputs = inputs
+        # booleans run op in a worker, anything else runs localFunc here
+        self.op = op
+        # operands' bounding boxes (or Nones), for the boolean prefilter
+        self.boxes = boxes
+        self.localFunc = localFunc
+        # geometry cache key for the result
+        self.key = key
+
+        self.done = False
+        self.shape = None
+        self.dependents = []
+        self.numPending = 0
+
+    def result(self):
+        """
+        Wait for the job to finish, and return its shape.
+        """
+
+        if not self.done:
+            self.scheduler.wait(self)
+        return self.shape
+
+
+class Scheduler(object):
+    def __init__(self, numWorkers):
+        self.numWorkers = numWorkers
+        # created on first use, so that workers are forked with the settings
+        # and programs already loaded
+        self._pool = None
+        # pids of the pool's worker processes when it was created
+        self._workerPids = None
+        # set once a worker has died, see _checkWorkers()
+        self._workersLost = False
+        # booleans sent to workers that haven't finished yet
+        self._running = set()
+        # (job, result) for each finished boolean, put there by the pool's
+        # result thread
+        self._finished = Queue.Queue()
+
+    def boolean(self, op, inputs, boxes=None, key=None):
+        """
+        Return a job running op on inputs in a worker process.
+        """
+
+        return self._add(Job(self, inputs, op=op, key=key, boxes=boxes))
+
+    def transform(self, inputJob, transform):
+        """
+        Return a job transforming inputJob's shape.
+        """
+
+        def localFunc(shape):
+            return runtime.transformShape(shape, transform)
+
+        return self._add(Job(self, [inputJob], localFunc=localFunc))
+
+    def _add(self, job):
+        for inp in job.inputs:
+            if isinstance(inp, Job) and not inp.done:
+                inp.dependents.append(job)
+                job.numPending += 1
+
+        stats['jobs'] += 1
+        if job.numPending == 0:
+            self._start(job)
+
+        # handle anything that's finished meanwhile, so that its dependents
+        # can start
+        self._poll()
+        return job
+
+    @staticmethod
+    def _inputShapes(job):
+        return [inp.shape if isinstance(inp, Job) else inp
+            for inp in job.inputs]
+
+    def _start(self, job):
+        shapes = self._inputShapes(job)
+
+        if job.op is None:
+            self._finish(job, job.localFunc(*shapes))
+            return
+
+        if self._workersLost:
+            self._buildLocally(job)
+            return
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.numWorkers)
+            # Pool has no public way to list its workers
+            self._workerPids = set(p.pid for p in self._pool._pool)
+
+        def callback(result):
+            self._finished.put((job, result))
+
+        operandsData = [_ycad.shapeToBRep(shape) for shape in shapes]
+        self._running.add(job)
+        self._pool.apply_async(_runBoolean,
+            (job.op, operandsData, job.boxes), callback=callback)
+
+    def _buildLocally(self, job):
+        stats['local booleans'] += 1
+        self._finish(job, runtime.Combination.makeShape(job.op,
+            self._inputShapes(job), job.boxes))
+
+    def _finish(self, job, shape):
+        job.shape = shape
+        job.done = True
+        job.inputs = None
+        geomcache.store(job.key, shape)
+
+        for dependent in job.dependents:
+            dependent.numPending -= 1
+            if dependent.numPending == 0:
+                self._start(dependent)
+
+        job.dependents = None
+
+    def _handle(self, job, result):
+        ok, data, statsDelta = result
+        if not ok:
+            raise RuntimeError("boolean {0!r} failed in worker:\n{1}".format(
+                job.op, data))
+
+        self._running.discard(job)
+        runtime.stats.update(statsDelta)
+        stats['remote booleans'] += 1
+        self._finish(job, _ycad.shapeFromBRep(data))
+
+    def _poll(self):
+        while True:
+            try:
+                job, result = self._finished.get_nowait()
+            except Queue.Empty:
+                return
+
+            self._handle(job, result)
+
+    def _checkWorkers(self):
+        """
+        If a worker has died, shut the pool down, and build the booleans it
+        was running here.
+        """
+
+        if self._pool is None:
+            return
+
+        workers = self._pool._pool
+        if (set(p.pid for p in workers) == self._workerPids
+                and all(p.exitcode is None for p in workers)):
+            return
+
+        stats['worker deaths'] += 1
+        self._workersLost = True
+        # once terminate() returns, no more results are put in _finished,
+        # so handle the ones that made it first
+        self._pool.terminate()
+        self._pool = None
+        self._poll()
+
+        # their inputs were all built before they were started
+        lostJobs, self._running = self._running, set()
+        for job in lostJobs:
+            self._buildLocally(job)
+
+    def wait(self, job):
+        while not job.done:
+            try:
+                # with a timeout, so that ctrl-c still works
+                finishedJob, result = self._finished.get(timeout=0.5)
+            except Queue.Empty:
+                self._checkWorkers()
+                continue
+
+            self._handle(finishedJob, result)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def statsReport():
+    report = 'Scheduler: {0} jobs, {1} booleans run in workers'.format(
+        stats['jobs'], stats['remote booleans'])
+    if stats['worker deaths']:
+        report += (', {0} run here after a worker died'
+            .format(stats['local booleans']))
+    return report
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import _ycad
+except ImportError:
+    _ycad = None
+
+
+# programs compiled to closures (see Program.compiled() in ast_.py) must
+# behave exactly like the tree-walking interpreter, which is kept as the
+# reference: print the same values, leave the same globals, and build the
+# same objects.
+
+PROGRAMS = [
+    # arithmetic, and the operators' precedence and associativity
+    '''
+    print(1 + 2 * 3 - 4 / 8, 2 ^ 3 ^ 2, -2 ^ 2, 7 % 3, 10 - 2 - 3)
+    print(1 < 2 <= 2 == 2 != 3 > 1 >= 1, not 1 > 2, 1 > 2 or 2 > 1 and true)
+    print(5mm + 2cm + 1inch, sqrt(16), abs(-3), floor(2.5), ceil(2.5))
+    ''',
+    # vectors, subscripts, comprehensions, and broadcasting builtins
+    '''
+    v = [1, 2, 3]
+    w = [x * 2 for x in v]
+    print(v, w, v[0] + w[2], [[i * j for j in v] for i in w])
+    print([i for i in range(5)], len(w), sqrt([4, 9]), sin(0), cos(0))
+    ''',
+    # funcs: defaults, named params, recursion, early returns, closures
+    # over globals
+    '''
+    scale = 3
+    func fact(n) { if n <= 1 { return 1 } return n * fact(n - 1) }
+    func f(a, b=2, c=3) { return a * scale + b * 10 + c * 100 }
+    func sign(x) { if x < 0 { return -1 } else if x == 0 { return 0 }
+        else { return 1 } }
+    print(fact(6), f(1), f(1, 5), f(1, c=7), f(a=2, b=1))
+    print([sign(x) for x in [-5, 0, 5]])
+    ''',
+    # loops and assignments
+    '''
+    total = 0
+    for i in [1, 2, 3, 4] { total = total + i * i }
+    xs = []
+    for i in [1, 2, 3] { xs = xs + [i] }
+    print(total, xs)
+    ''',
+    # objects: transforms, booleans, and objects made by funcs and loops
+    '''
+    func post(h) { return cylinder(d=2, h=h).move(z=1) }
+    base = cube(10, center=true)
+    sub {
+        base.rotate(z=45).scale(2)
+        for i in [0, 1, 2] { post(i * 5 + 1).move(x=i * 3) }
+    }
+    add { cube(1) sphere(r=2).move([5, 0, 0]) }
+    mul { cube(4) cube(4).move(x=2, y=2) }
+    ''',
+]
+
+
+def objectTree(obj):
+    """
+    Describe how obj is being built: its type, key and bounds, and the same
+    for the objects it's built from.
+    """
+
+    return (type(obj).__name__, obj.key, obj._bounds,
+        [objectTree(operand) for operand in obj._operands])
+
+def describe(value):
+    """
+    Turn a value a program can hold into something that compares equal when
+    both interpreters produced the same value.
+    """
+
+    import numpy as np
+    import runtime
+
+    if isinstance(value, runtime.Object3D):
+        return objectTree(value)
+    elif isinstance(value, runtime.Module):
+        return ('module', describe(value.scope))
+    elif isinstance(value, dict):
+        return dict((k, describe(v)) for k, v in value.iteritems())
+    elif isinstance(value, np.ndarray):
+        return ('array', value.tolist())
+    elif isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+    elif callable(value):
+        return ('callable', getattr(value, 'func_name', None))
+    else:
+        return value
+
+
+@unittest.skipIf(_ycad is None, "_ycad isn't built")
+class CompilerDifferentialTest(unittest.TestCase):
+    def setUp(self):
+        import loader
+
+        self.tmpDir = tempfile.mkdtemp()
+        self.prevLoaderSettings = (loader.useCache, loader.parser)
+        loader.useCache = False
+        loader.parser = 'rd'
+
+    def tearDown(self):
+        import loader
+
+        loader.useCache, loader.parser = self.prevLoaderSettings
+        shutil.rmtree(self.tmpDir)
+
+    def runProgram(self, srcPath, compileCode):
+        """
+        Run the program at srcPath without building any geometry, and
+        return what it printed, its globals and its output object.
+        """
+
+        import loader
+        import runtime
+
+        # load it afresh for each run, so that one run can't affect the other
+        program = loader.loadFile(srcPath)
+        ctx = runtime.Context(os.path.join(self.tmpDir, 'out.stl'),
+            compileCode=compileCode)
+
+        prevStdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            scope, obj = ctx.execProgram(srcPath, program,
+                moduleObjName='main')
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = prevStdout
+
+        return printed, describe(scope), describe(obj)
+
+    def assertSameBehavior(self, srcPath):
+        walked = self.runProgram(srcPath, compileCode=False)
+        compiled = self.runProgram(srcPath, compileCode=True)
+        for what, a, b in zip(['printed output', 'globals', 'output object'],
+                walked, compiled):
+            self.assertEqual(a, b,
+                '{0}: {1} differs when compiled'.format(srcPath, what))
+
+    def test_examples(self):
+        paths = sorted(glob.glob(os.path.join(ROOT, 'examples', '*.ycad')))
+        self.assertTrue(paths)
+        for path in paths:
+            self.assertSameBehavior(path)
+
+    def test_programs(self):
+        for i, source in enumerate(PROGRAMS):
+            path = os.path.join(self.tmpDir, 'program{0}.ycad'.format(i))
+            with open(path, 'w') as f:
+                f.write(source)
+            self.assertSameBehavior(path)
+
+    def test_memoizedCallers(self):
+        # both interpreters memoize the same way, so check the output
+        # itself: f() must not be memoized, since g() reads a global that
+        # changes
+        path = os.path.join(self.tmpDir, 'memo.ycad')
+        with open(path, 'w') as f:
+            f.write('''
+            x = 1
+            func g() { return x }
+            func f() { return g() }
+            print(f())
+            x = 2
+            print(f())
+            print(g())
+            ''')
+
+        for compileCode in [False, True]:
+            printed, _, _ = self.runProgram(path, compileCode)
+            self.assertEqual(printed, '1.0\n2.0\n2.0\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
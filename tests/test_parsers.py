@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import glob
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import _ycad
+except ImportError:
+    _ycad = None
+
+
+# the two parser engines (see loader.parser) must produce the same trees,
+# down to the source locations of the nodes.
+
+EDGE_CASES = [
+    # string escapes, including the ones pyparsing turns into whitespace
+    r'print("a\nb\tc\rd\fe")',
+    r'print("quote \" backslash \\ other \x \a")',
+    r'print("\\n is a backslash and a newline, like in pyparsing")',
+    r'print("")',
+    # units, and where numbers and keywords end
+    'x = 5mm + 2cm - 1.5inch * 3m + 2INCH',
+    'x = 5mmx',
+    'notch = not ch',
+    'android = a and b or not c',
+    'iffy = 1 fortune = 2 format = 3',
+    'x = 1.5 y = 2.0.move(x=1)',
+    # operators
+    'x = 2 ^ 3 ^ 2 + -2 ^ 2 - - y',
+    'x = a < b <= c == d != e > f >= g',
+    'x = 7 % 3 * 2 / 4',
+    # comprehensions, vectors, subscripts and method calls
+    'x = [[i * j for j in [1, 2]] for i in [[3, 4] for k in [5]]]',
+    'x = [] y = [1, [2, [3]], "s", true, false]',
+    'x = a[1][b[2]].move(x=1).rotate(z=2)[0]',
+    # statements
+    'func f(a, b=2mm, c="s", d=[1, 2]) { return a + b }',
+    'if a { b() } else if c { d() } else if e { } else { f() }',
+    'for i in xs { cube(i).move(x=i * 10) }',
+    'import gears',
+    'add { cube(1) sub { cube(2) mul { cube(3) } } }',
+    'f(a=1, b=2) g(1, 2, c=3) h() { }',
+    # comments and whitespace, which only show in the locations
+    '# a comment\nx = 1 /* a\nmulti-line\ncomment */ y = 2',
+    '\tx = 1\n\t\ty = [\n\t1,\n2]',
+]
+
+
+def treeDifference(a, b, path='program'):
+    """
+    Return a description of the first difference between two parse trees,
+    or None if they're the same.
+    """
+
+    if type(a) is not type(b):
+        return '{0}: {1!r} is not {2!r}'.format(path, a, b)
+
+    if isinstance(a, (list, tuple)):
+        if len(a) != len(b):
+            return '{0}: length {1} != {2}'.format(path, len(a), len(b))
+        for i, (elemA, elemB) in enumerate(zip(a, b)):
+            diff = treeDifference(elemA, elemB, '{0}[{1}]'.format(path, i))
+            if diff is not None:
+                return diff
+        return None
+
+    if hasattr(a, '__dict__'):
+        attrsA, attrsB = vars(a), vars(b)
+        if sorted(attrsA) != sorted(attrsB):
+            return '{0}: attributes {1} != {2}'.format(path, sorted(attrsA),
+                sorted(attrsB))
+        # class attributes (e.g. lineno defaulting to None) count too
+        for name in sorted(set(attrsA) | {'lineno', 'col'}):
+            diff = treeDifference(getattr(a, name, None),
+                getattr(b, name, None), '{0}.{1}'.format(path, name))
+            if diff is not None:
+                return diff
+        return None
+
+    if a != b:
+        return '{0}: {1!r} != {2!r}'.format(path, a, b)
+    return None
+
+
+@unittest.skipIf(_ycad is None, "_ycad isn't built")
+class ParserConformanceTest(unittest.TestCase):
+    def assertSameTrees(self, source, name):
+        import grammar
+        import rdparser
+
+        expected = grammar.parseString(source)
+        actual = rdparser.parseString(source)
+        diff = treeDifference(expected, actual)
+        if diff is not None:
+            self.fail('{0}: {1}'.format(name, diff))
+
+    def test_sourceFiles(self):
+        paths = sorted(glob.glob(os.path.join(ROOT, 'examples', '*.ycad'))
+            + glob.glob(os.path.join(ROOT, 'include', '*.ycad')))
+        self.assertTrue(paths)
+
+        for path in paths:
+            with open(path) as f:
+                self.assertSameTrees(f.read(), os.path.relpath(path, ROOT))
+
+    def test_edgeCases(self):
+        for source in EDGE_CASES:
+            self.assertSameTrees(source, repr(source))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import _ycad
+except ImportError:
+    _ycad = None
+
+
+# a program that uses only cube() and cylinder() shouldn't pay for loading
+# numpy, cairo, the text subsystem or the pyparsing grammar. each check runs
+# in a fresh interpreter, so that nothing imported by the test runner (or by
+# other tests) hides a regression.
+
+# heavy modules that must only be loaded on first use
+LAZY_MODULES = ['numpy', 'cairo', 'textimpl', 'networkx', 'pyparsing',
+    'grammar']
+
+# seconds allowed for importing what ycad.py imports before parsing
+IMPORT_BUDGET = 1.0
+
+PROGRAM = '''
+sub {
+    cube(s=5mm)
+    cylinder(h=6mm, d1=7mm, d2=2mm)
+}
+'''
+
+# run in the subprocess: import the modules the way ycad.py does, time it,
+# run PROGRAM, and report which of LAZY_MODULES got loaded along the way
+SCRIPT = '''
+import json, os, sys, tempfile, time
+sys.path.insert(0, {root!r})
+startTime = time.time()
+import loader, runtime, memo, geomcache, meshwriter
+importTime = time.time() - startTime
+loader.useCache = False
+loader.parser = 'rd'
+geomcache.useCache = False
+tmpDir = tempfile.mkdtemp()
+srcPath = os.path.join(tmpDir, 'startup.ycad')
+with open(srcPath, 'w') as f:
+    f.write({program!r})
+runtime.run(srcPath, loader.loadFile(srcPath),
+    os.path.join(tmpDir, 'startup.stl'))
+print(json.dumps(dict(importTime=importTime,
+    loaded=[name for name in {lazyModules!r} if name in sys.modules])))
+'''
+
+def runScript():
+    script = SCRIPT.format(root=ROOT, program=PROGRAM,
+        lazyModules=LAZY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return json.loads(output.splitlines()[-1])
+
+
+@unittest.skipIf(_ycad is None, "_ycad isn't built")
+class StartupTest(unittest.TestCase):
+    def test_lazyModules(self):
+        result = runScript()
+        self.assertEqual(result['loaded'], [])
+
+    def test_importBudget(self):
+        # take the best of a few runs, to ignore a cold disk cache
+        importTime = min(runScript()['importTime'] for _ in xrange(3))
+        self.assertLess(importTime, IMPORT_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
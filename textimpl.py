@@ -1,12 +1,58 @@
 #!/usr/bin/env python
 
+from collections import namedtuple, Counter, OrderedDict
+import numpy as np
 import cairo
-import networkx
 import _ycad
+# only imported by runtime once text() is used, so there's no import cycle
+import runtime
 
 
+stats = Counter()
+
+
+# wires are flattened to polylines for deciding which wires are inside which.
+# each bezier curve becomes this many segments.
+_CURVE_SEGMENTS = 8
+
+# a point this close to a wire's polyline (besides the flattening error) is
+# too close to call, so the kernel classifies it
+_AMBIGUITY_MARGIN = 1e-6
+
+# a closed sub-path: its OCC wire, its start point, and its polyline, which is
+# no farther than flatness from the wire
+Loop = namedtuple('Loop', 'wire startPt polyline flatness')
+
+
+def _flattenBezier(p0, p1, p2, p3):
+    """
+    Return the points after p0 of a polyline approximating a cubic bezier
+    curve, and a bound on its distance from the curve.
+    """
+
+    ctrl = np.array([p0, p1, p2, p3], np.float64)
+    t = np.linspace(0, 1, _CURVE_SEGMENTS + 1)[1:, np.newaxis]
+    s = 1 - t
+    pts = (s**3 * ctrl[0] + 3 * s**2 * t * ctrl[1] + 3 * s * t**2 * ctrl[2]
+        + t**3 * ctrl[3])
+
+    # a segment of a curve is no farther than 1/8 * (max |B''|) * dt^2 from
+    # its chord, and |B''| is at most 6 times the largest second difference
+    # of the control points
+    secondDiffs = ctrl[:-2] - 2 * ctrl[1:-1] + ctrl[2:]
+    maxSecondDiff = np.sqrt((secondDiffs**2).sum(axis=1)).max()
+    flatness = 0.75 * maxSecondDiff / _CURVE_SEGMENTS**2
+
+    return [tuple(pt) for pt in pts], flatness
+
 def cairoPathToOccWiresAndPts(path):
+    """
+    Yield a Loop for each closed sub-path in path.
+    """
+
     edgesInCurWire = []
+    polyline = []
+    flatness = 0
 
     startPt = None
     curPt = None
@@ -18,6 +64,7 @@ def cairoPathToOccWiresAndPts(path):
             x, y = instrArgs[:2]
             curPt = (x, y)
             startPt = curPt     # move_to begins a new sub-path
+            polyline = [curPt]
 
         elif instrType == cairo.PATH_LINE_TO:
             x, y = instrArgs[:2]
@@ -28,6 +75,7 @@ def cairoPathToOccWiresAndPts(path):
                 edgesInCurWire.append(_ycad.segment2D(curPt, (x, y)))
 
                 curPt = (x, y)
+            polyline.append(curPt)
 
         elif instrType == cairo.PATH_CURVE_TO:
             x1, y1, x2, y2, x3, y3 = instrArgs[:6]
@@ -39,6 +87,12 @@ def cairoPathToOccWiresAndPts(path):
             curve = _ycad.BezierCurve(
                 [curPt, (x1, y1), (x2, y2), (x3, y3)])
             edgesInCurWire.append(curve.makeEdge())
+
+            curvePts, curveFlatness = _flattenBezier(
+                curPt, (x1, y1), (x2, y2), (x3, y3))
+            polyline.extend(curvePts)
+            flatness = max(flatness, curveFlatness)
+
             curPt = (x3, y3)
 
         elif instrType == cairo.PATH_CLOSE_PATH:
@@ -48,10 +102,13 @@ def cairoPathToOccWiresAndPts(path):
 
             if edgesInCurWire:
                 assert startPt is not None
-                yield (_ycad.wire(edgesInCurWire), startPt)
+                yield Loop(_ycad.wire(edgesInCurWire), startPt,
+                    np.array(polyline, np.float64), flatness)
 
                 # get ready for next wire
                 edgesInCurWire = []
+                polyline = []
+                flatness = 0
             
             startPt = None
     
@@ -61,83 +118,216 @@ def cairoPathToOccWiresAndPts(path):
         "Last path instruction should be a PATH_CLOSE_PATH!"
     assert not edgesInCurWire
 
-def groupNonIntersectingWiresIntoFaces(wiresAndPts):
-    # build directed graph of wires A->B where contains B
-    containmentGraph = networkx.DiGraph()
-
-    # add all wires, even those not participating in edges
-    containmentGraph.add_nodes_from(wire for (wire, _) in wiresAndPts)
-
-    containmentGraph.add_edges_from(
-        (aWire, bWire)
-        for (aWire, _) in wiresAndPts
-        for (bWire, bPt) in wiresAndPts
-        if aWire is not bWire and aWire.contains2DPoint(bPt))
+def _classifyPoints(polyline, pts):
+    """
+    Test which of pts are inside the closed polyline, by the even-odd rule.
+    Returns (inside, distance from the polyline) arrays.
+    """
+
+    a = polyline[np.newaxis, :, :]
+    b = np.roll(polyline, -1, axis=0)[np.newaxis, :, :]
+    p = pts[:, np.newaxis, :]
+
+    ax, ay = a[..., 0], a[..., 1]
+    bx, by = b[..., 0], b[..., 1]
+    px, py = p[..., 0], p[..., 1]
+
+    # count the edges crossing a ray from each point in the +x direction
+    crosses = (ay > py) != (by > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossX = ax + (py - ay) * (bx - ax) / (by - ay)
+        # (crossX is nan for horizontal edges, which never cross)
+        inside = (crosses & (px < crossX)).sum(axis=1) % 2 == 1
+
+    edge = b - a
+    edgeLenSq = (edge**2).sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((p - a) * edge).sum(axis=2) / edgeLenSq
+    t = np.where(edgeLenSq > 0, np.clip(t, 0, 1), 0)
+    closest = a + t[..., np.newaxis] * edge
+    distance = np.sqrt(((closest - p)**2).sum(axis=2)).min(axis=1)
+
+    return inside, distance
+
+def _findContainers(loops):
+    """
+    Return, for each loop, the indices of the loops containing it.
+    """
+
+    n = len(loops)
+    starts = np.array([loop.startPt for loop in loops], np.float64)
+    mins = np.array([loop.polyline.min(axis=0) for loop in loops])
+    maxs = np.array([loop.polyline.max(axis=0) for loop in loops])
+    margins = np.array([loop.flatness for loop in loops]) + _AMBIGUITY_MARGIN
+
+    # candidate containers of a loop are the loops whose boxes contain its
+    # start point. with loops sorted by min x, those are all in a prefix.
+    minX = mins[:, 0] - margins
+    order = np.argsort(minX, kind='mergesort')
+    sortedMinX = minX[order]
+    candidatesByContainer = [[] for _ in xrange(n)]
+    for inner in xrange(n):
+        x, y = starts[inner]
+        prefix = order[:np.searchsorted(sortedMinX, x, side='right')]
+        m = margins[prefix]
+        hits = prefix[(maxs[prefix, 0] + m >= x)
+            & (mins[prefix, 1] - m <= y) & (maxs[prefix, 1] + m >= y)
+            & (prefix != inner)]
+        for outer in hits:
+            candidatesByContainer[outer].append(inner)
+
+    containers = [[] for _ in xrange(n)]
+    for outer, candidates in enumerate(candidatesByContainer):
+        if not candidates:
+            continue
+
+        inside, distance = _classifyPoints(loops[outer].polyline,
+            starts[candidates])
+        for inner, isInside, dist in zip(candidates, inside, distance):
+            if dist <= margins[outer]:
+                # the point is within the flattening error of the wire,
+                # so the polyline can't tell
+                stats['kernel containment tests'] += 1
+                isInside = loops[outer].wire.contains2DPoint(
+                    loops[inner].startPt)
+
+            if isInside:
+                containers[inner].append(outer)
+
+    return containers
+
+def groupNonIntersectingWiresIntoFaces(loops):
+    """
+    Make faces from loops, which don't intersect each other: each loop that's
+    inside an even number of others is a face's outer wire, and the loops
+    directly inside it are the face's holes.
+    """
+
+    stats['wires grouped'] += len(loops)
+    containers = _findContainers(loops)
+    depths = [len(c) for c in containers]
+
+    holes = [[] for _ in loops]
+    for i, loopContainers in enumerate(containers):
+        if depths[i] % 2 == 1:
+            # the innermost container is the one inside all the others
+            parent = max(loopContainers, key=lambda j: depths[j])
+            holes[parent].append(i)
 
     faces = []
-    while True:
-        # find wires that aren't contained in any other wires
-        rootWires = [wire
-            for (wire, inDeg) in containmentGraph.in_degree_iter()
-            if inDeg == 0]
-
-        if not rootWires:
-            # we're done here
-            break
-
-        # build faces from the root wires + their inner loops. then remove
-        # all of those, so that in the next iteration, any inner inner loops
-        # can become root wires.
-        for rootWire in rootWires:
-            wiresInsideRoot = containmentGraph.successors(rootWire)
-
-            # if in-degree is >1, that means that there's another wire between
-            # the root and the inner wire, and it's the inner wire's parent,
-            # too. so let's look for inner wires with in-degree == 1.
-            wiresDirectlyInsideRoot = [w for w in wiresInsideRoot
-                if containmentGraph.in_degree(w) == 1]
-
-            orientedWires = ([rootWire.oriented(_ycad.TopAbs_FORWARD)]
-                + [w.oriented(_ycad.TopAbs_REVERSED)
-                    for w in wiresDirectlyInsideRoot])
-
+    for i, loop in enumerate(loops):
+        if depths[i] % 2 == 0:
+            orientedWires = ([loop.wire.oriented(_ycad.TopAbs_FORWARD)]
+                + [loops[j].wire.oriented(_ycad.TopAbs_REVERSED)
+                    for j in holes[i]])
             faces.append(_ycad.face(orientedWires))
 
-            # we're done with these; we've already made faces out of them
-            containmentGraph.remove_node(rootWire)
-            containmentGraph.remove_nodes_from(wiresDirectlyInsideRoot)
-
     return faces
 
 def cairoPathToOccShape(path):
-    wiresAndPts = list(cairoPathToOccWiresAndPts(path))
-    faces = groupNonIntersectingWiresIntoFaces(wiresAndPts)
+    loops = list(cairoPathToOccWiresAndPts(path))
+    faces = groupNonIntersectingWiresIntoFaces(loops)
     return _ycad.compound(faces)
 
 
 
+# a character's shape, placed at the origin (or None if it has no outline,
+# e.g. a space), and how far it moves the pen
+Glyph = namedtuple('Glyph', 'shape xAdvance yAdvance')
+
+
 class TextShapeMaker(object):
+    """
+    Makes shapes of strings out of glyph shapes, which are cached: cairo's
+    text_path() places each character at the pen position, and moves the
+    pen by its advance, so a string's shape is its characters' shapes, each
+    placed at the sum of the previous characters' advances. The placed
+    glyphs share their geometry with the cached ones, unless
+    runtime.shareGeometry is off.
+    """
+
     _SURFACE_SIZE = 1024
 
-    def __init__(self):
+    def __init__(self, maxGlyphs=1024):
         surface = cairo.SVGSurface(None, self._SURFACE_SIZE, self._SURFACE_SIZE)
         self.ctx = cairo.Context(surface)
+        # Glyphs by (font name, size, weight, slant, character), least
+        # recently used first
+        self._glyphs = OrderedDict()
+        self.maxGlyphs = maxGlyphs
 
     def make(self, text, fontName, fontSize, bold=False, italic=False):
         slant = cairo.FONT_SLANT_ITALIC if italic else cairo.FONT_SLANT_NORMAL
         weight = cairo.FONT_WEIGHT_BOLD if bold else cairo.FONT_WEIGHT_NORMAL
+        fontKey = (fontName, fontSize, weight, slant)
+
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+
+        x = y = 0
+        placedGlyphs = []
+        for char in text:
+            glyph = self._getGlyph(fontKey, char)
+
+            if glyph.shape is not None:
+                transform = _ycad.Transform()
+                transform.setTranslation((x, y, 0))
+                placedGlyphs.append(
+                    runtime.transformShape(glyph.shape, transform))
+
+            x += glyph.xAdvance
+            y += glyph.yAdvance
+
+        return _ycad.compound(placedGlyphs)
+
+    def _getGlyph(self, fontKey, char):
+        key = fontKey + (char,)
+
+        try:
+            glyph = self._glyphs.pop(key)
+        except KeyError:
+            stats['misses'] += 1
+            glyph = self._makeGlyph(fontKey, char)
+        else:
+            stats['hits'] += 1
+
+        # (re-)insert it as the most recently used
+        self._glyphs[key] = glyph
+        while len(self._glyphs) > self.maxGlyphs:
+            self._glyphs.popitem(last=False)
+            stats['evictions'] += 1
+
+        return glyph
+
+    def _makeGlyph(self, fontKey, char):
+        fontName, fontSize, weight, slant = fontKey
         self.ctx.select_font_face(fontName, slant, weight)
         self.ctx.set_font_size(fontSize)
 
-        path = self._getTextPath(text)
-        return cairoPathToOccShape(path)
+        path = list(self._getTextPath(char))
+        shape = cairoPathToOccShape(path) if path else None
+
+        _, _, _, _, xAdvance, yAdvance = self.ctx.text_extents(char)
+        # y is inverted, see _getTextPath()
+        return Glyph(shape, xAdvance, -yAdvance)
 
     def _getTextPath(self, text):
         self.ctx.new_path()
 
         self.ctx.text_path(text)
 
-        # invert y direction, to match coordinates used for 3D
+        # invert y direction, to match coordinates used for 3D. the path
+        # isn't part of the saved state, so restoring only undoes the scale.
+        self.ctx.save()
         self.ctx.scale(1, -1)
+        path = self.ctx.copy_path()
+        self.ctx.restore()
+
+        return path
+
 
-        return self.ctx.copy_path()
+def statsReport():
+    return ('Glyph cache: {0} hits, {1} misses, {2} evictions\n'
+        'Faces: {3} wires grouped, {4} kernel containment tests'.format(
+            stats['hits'], stats['misses'], stats['evictions'],
+            stats['wires grouped'], stats['kernel containment tests']))
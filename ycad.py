@@ -12,34 +12,153 @@ if __name__ == '__main__':
     parser.add_argument("filename",
         help="source file (usually ends with '.ycad')")
     parser.add_argument("-o", "--output",
-        help="STL output filename. defaults to source file with .stl extension")
+        help="output filename. its extension sets the format: .stl, or "
+            "indexed .obj, .ply or .3mf. defaults to source file with .stl "
+            "extension")
+    parser.add_argument("--no-parse-cache", action="store_true",
+        help="always parse source files, ignoring the on-disk parse cache")
+    parser.add_argument("--no-geometry-cache", action="store_true",
+        help="always build shapes, ignoring the on-disk geometry cache")
+    parser.add_argument("--geometry-cache-size", type=int, default=1024,
+        help="maximum size of the on-disk geometry cache, in MB")
+    parser.add_argument("--cache-dir",
+        help="directory for the parse and geometry caches. defaults to "
+            "~/.cache/ycad")
+    parser.add_argument("--parser", choices=['pyparsing', 'rd'],
+        default='pyparsing',
+        help="parser engine. 'rd' is a faster hand-written parser")
+    parser.add_argument("--no-optimize", action="store_true",
+        help="don't fold constants or inline pure funcs when loading programs")
+    parser.add_argument("--dump-optimized", action="store_true",
+        help="print the program's syntax tree after optimization")
+    parser.add_argument("--memo-size", type=int, default=1024,
+        help="maximum number of func calls to memoize. 0 disables "
+            "memoization")
+    parser.add_argument("--glyph-cache-size", type=int, default=1024,
+        help="maximum number of glyph shapes to keep for text()")
+    parser.add_argument("--booleans", choices=['multi', 'tree', 'chain'],
+        default='multi',
+        help="how to run booleans on more than two objects: all at once "
+            "('multi'), unions as a balanced tree of nearby objects "
+            "('tree'), or one by one ('chain')")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes to run booleans in. independent "
+            "parts of the model are built concurrently")
+    parser.add_argument("--mesh-threads", type=int, default=1,
+        help="number of threads meshing the output. distinct solids are "
+            "meshed concurrently; a single one has its faces meshed "
+            "concurrently")
+    parser.add_argument("--vertex-normals", action="store_true",
+        help="write vertex normals to .obj and .ply output")
+    parser.add_argument("--no-lazy", action="store_true",
+        help="build every shape as soon as it's created, even if it's never "
+            "used. implied by --profile")
+    parser.add_argument("--copy-transforms", action="store_true",
+        help="copy shapes' geometry when moving or rotating them, rather "
+            "than sharing it between all placements of a shape")
+    parser.add_argument("--no-fast-twist", action="store_true",
+        help="extrude twisted profiles wire by wire, cutting holes out with "
+            "booleans. slower; mostly useful for comparison")
+    parser.add_argument("--no-bbox-filter", action="store_true",
+        help="run all booleans, even when bounding boxes show that their "
+            "operands don't interact")
+    parser.add_argument("--no-compile", action="store_true",
+        help="run programs by walking the syntax tree instead of compiling "
+            "them. slower, mostly useful for debugging")
+    parser.add_argument("--profile", action="store_true",
+        help="report time and kernel calls per statement, func and call site")
+    parser.add_argument("--profile-output",
+        help="JSON profile output filename. defaults to source file with "
+            ".profile.json extension")
     args = parser.parse_args()
 
     if not args.output:
         args.output = os.path.splitext(args.filename)[0] + '.stl'
+
+    if args.profile and not args.profile_output:
+        args.profile_output = (os.path.splitext(args.filename)[0]
+            + '.profile.json')
     
     startTime = time.time()
 
     try:
         print('Initializing...', file=sys.stderr)
-        import grammar
+        import loader
         import runtime
+        import memo
+        import geomcache
+        import meshwriter
+        if args.cache_dir:
+            loader.cacheDir = geomcache.cacheDir = args.cache_dir
+        loader.useCache = not args.no_parse_cache
+        loader.parser = args.parser
+        loader.optimize = not args.no_optimize
+        memo.maxEntries = args.memo_size
+        runtime.booleanMode = args.booleans
+        runtime.prefilterBooleans = not args.no_bbox_filter
+        # the profiler attributes kernel calls to the statements running
+        # when they're made, so build shapes where they're created
+        runtime.lazyShapes = not (args.no_lazy or args.profile)
+        runtime.shareGeometry = not args.copy_transforms
+        runtime.fastTwist = not args.no_fast_twist
+        runtime.maxGlyphs = args.glyph_cache_size
+        runtime.meshThreads = args.mesh_threads
+        meshwriter.vertexNormals = args.vertex_normals
+        geomcache.useCache = not args.no_geometry_cache
+        geomcache.maxBytes = args.geometry_cache_size * 1024 * 1024
         timeAfterInit = time.time()
         print('Initialization time: {0:.2f}s'.format(timeAfterInit - startTime))
 
         print('Parsing...', file=sys.stderr)
         try:
-            parsed = grammar.parseFile(args.filename)
+            parsed = loader.loadFile(args.filename)
         finally:
             timeAfterParsing = time.time()
             print('Parse time: {0:.2f}s'.format(timeAfterParsing - timeAfterInit))
 
+        if args.dump_optimized:
+            print(repr(parsed))
+
+        if args.profile:
+            import profiler
+            prof = profiler.Profiler()
+        else:
+            prof = None
+
         print('Running...', file=sys.stderr)
         try:
-            runtime.run(os.path.abspath(args.filename), parsed, args.output)
+            runtime.run(os.path.abspath(args.filename), parsed, args.output,
+                profiler=prof, compileCode=not args.no_compile,
+                numWorkers=args.jobs)
         finally:
             timeAfterRunning = time.time()
             print('Execution time: {0:.2f}s'.format(timeAfterRunning - timeAfterParsing))
+            if 'output' in runtime.phaseTimes:
+                print('  of which meshing and output: {0:.2f}s '
+                    '({1} mesh threads)'.format(runtime.phaseTimes['output'],
+                        runtime.meshThreads))
+            print(loader.statsReport())
+            print(runtime.statsReport())
+            if loader.optimize:
+                import optimizer
+                print(optimizer.statsReport())
+            if memo.maxEntries > 0:
+                print(memo.statsReport())
+            if geomcache.useCache:
+                geomcache.trim()
+                print(geomcache.statsReport())
+            if args.jobs > 1:
+                import scheduler
+                print(scheduler.statsReport())
+            # only if text() was used, importing it loads cairo
+            if 'textimpl' in sys.modules:
+                print(sys.modules['textimpl'].statsReport())
+
+            if prof is not None:
+                print()
+                prof.printReport()
+                prof.writeJSON(args.profile_output)
+                print('Profile written to {0}'.format(args.profile_output))
     finally:
         endTime = time.time()
         print('Total time: {0:.2f}s'.format(endTime - startTime))